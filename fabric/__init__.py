@@ -1,5 +1,8 @@
 # flake8: noqa
 from ._version import __version_info__, __version__
-from .connection import Config, Connection
+from .connection import Config, Connection, SFTPPool
 from .runners import Result
-from .group import Group, SerialGroup, ThreadingGroup, GroupResult
+from .group import (
+    Group, SerialGroup, ThreadingGroup, ProcessPoolGroup, GroupResult,
+)
+from .pool import ConnectionPool
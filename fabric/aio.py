@@ -0,0 +1,235 @@
+"""
+`asyncio`-driven group execution.
+
+.. note::
+    This module requires Python 3.5 or newer, and so (unlike most of Fabric)
+    is not imported by the top level ``fabric`` package; import it explicitly,
+    e.g. ``from fabric.aio import AsyncGroup``.
+"""
+
+import asyncio
+import codecs
+import functools
+import locale
+import socket
+import sys
+
+from invoke.exceptions import UnexpectedExit
+from invoke.runners import normalize_hide
+
+from .group import Group, _collect, _pop_max_workers
+from .runners import Result
+
+
+#: Number of bytes read from a channel per ``recv`` call.
+read_chunk_size = 32768
+
+
+class AsyncGroup(Group):
+    """
+    Subclass of `.Group` whose methods are coroutines run on an event loop.
+
+    Command output for every member connection is pumped by a single event
+    loop, which watches each `~paramiko.channel.Channel` for readiness,
+    instead of by a set of reader threads per command (as `.Connection.run`
+    does). This keeps per-host overhead small when driving very large groups::
+
+        import asyncio
+        from fabric.aio import AsyncGroup
+
+        group = AsyncGroup(*hosts, max_workers=500)
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(group.run("uptime", hide=True))
+
+    Return values & exception behavior match those of other groups: a
+    `.GroupResult`, or a `.GroupException` wrapping one.
+
+    .. note::
+        Operations which are blocking within Paramiko -- connecting &
+        authenticating, opening a channel and requesting command execution,
+        and SFTP transfers (i.e. `put` and `get`) -- are handed to the event
+        loop's default executor (a thread pool), bounded by ``max_workers``.
+        Also note that each connected Paramiko `~paramiko.transport.Transport`
+        still runs its own packet-handling thread.
+    """
+    def __init__(self, *hosts, **kwargs):
+        """
+        Create a group; see `.Group.__init__` for the basics.
+
+        :param int max_workers:
+            Maximum number of connections operated on at once. Default: the
+            ``group.max_workers`` setting of the ``config`` keyword argument,
+            if given, and otherwise ``None`` (no limit).
+        """
+        max_workers = _pop_max_workers(kwargs)
+        super(AsyncGroup, self).__init__(*hosts, **kwargs)
+        #: Maximum number of connections operated on at once, or ``None``.
+        self.max_workers = max_workers
+
+    async def run(self, command, **kwargs):
+        """
+        Execute ``command`` on all member connections concurrently.
+
+        Only a subset of `.Connection.run`'s keyword arguments are supported:
+        ``warn``, ``hide``, ``encoding`` and ``env``; defaults for these are
+        taken from each connection's ``run`` config settings, as usual.
+
+        :returns: a `.GroupResult`.
+        """
+        unsupported = set(kwargs) - set(('warn', 'hide', 'encoding', 'env'))
+        if unsupported:
+            err = "AsyncGroup.run() does not support: {0}"
+            raise TypeError(err.format(", ".join(sorted(unsupported))))
+        return await self._gather(self._run_one, command, kwargs)
+
+    async def get(self, *args, **kwargs):
+        """
+        Execute `.Connection.get` on all member connections concurrently.
+
+        :returns: a `.GroupResult`.
+        """
+        return await self._gather(self._in_executor, 'get', args, kwargs)
+
+    async def put(self, *args, **kwargs):
+        """
+        Execute `.Connection.put` on all member connections concurrently.
+
+        :returns: a `.GroupResult`.
+        """
+        return await self._gather(self._in_executor, 'put', args, kwargs)
+
+    async def _gather(self, coro, *args):
+        if self.max_workers is None:
+            semaphore = None
+        else:
+            semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def guarded(cxn):
+            try:
+                if semaphore is None:
+                    return cxn, await coro(cxn, *args)
+                async with semaphore:
+                    return cxn, await coro(cxn, *args)
+            except Exception as e:
+                return cxn, e
+        return _collect(await asyncio.gather(*map(guarded, self)))
+
+    async def _in_executor(self, cxn, method, args, kwargs):
+        loop = asyncio.get_event_loop()
+        call = functools.partial(getattr(cxn, method), *args, **kwargs)
+        return await loop.run_in_executor(None, call)
+
+    async def _run_one(self, cxn, command, kwargs):
+        opts = dict(
+            warn=cxn.config.run.warn,
+            hide=cxn.config.run.hide,
+            encoding=cxn.config.run.encoding,
+            env=cxn.config.run.env,
+        )
+        opts.update(kwargs)
+        hide = normalize_hide(opts['hide'])
+        encoding = opts['encoding'] or locale.getpreferredencoding(False)
+        loop = asyncio.get_event_loop()
+        channel = await loop.run_in_executor(
+            None, _start, cxn, command, opts['env'],
+        )
+        try:
+            stdout, stderr = await _pump(
+                loop, channel, encoding, hide, cxn.config.run,
+            )
+            if channel.exit_status_ready():
+                exited = channel.recv_exit_status()
+            else:
+                exited = await loop.run_in_executor(
+                    None, channel.recv_exit_status,
+                )
+        finally:
+            channel.close()
+        result = Result(
+            stdout=stdout,
+            stderr=stderr,
+            command=command,
+            env=opts['env'],
+            exited=exited,
+            pty=False,
+            hide=hide,
+            connection=cxn,
+        )
+        if exited != 0 and not opts['warn']:
+            raise UnexpectedExit(result)
+        return result
+
+
+def _start(cxn, command, env):
+    """
+    Open a session channel on ``cxn`` & begin executing ``command``.
+
+    Blocking; meant to run within an executor.
+    """
+    channel = cxn.create_session()
+    if env:
+        channel.update_environment(env)
+    channel.exec_command(command)
+    return channel
+
+
+def _pump(loop, channel, encoding, hide, run_config):
+    """
+    Read ``channel``'s stdout & stderr until EOF, driven by ``loop``.
+
+    Output not hidden is also written to the configured (or default
+    ``sys``) streams as it arrives.
+
+    :returns:
+        A future yielding a two-tuple of decoded stdout & stderr strings.
+    """
+    future = loop.create_future()
+    streams = {}
+    for name, recv, setting, default in (
+        ('stdout', channel.recv, 'out_stream', sys.stdout),
+        ('stderr', channel.recv_stderr, 'err_stream', sys.stderr),
+    ):
+        out = getattr(run_config, setting, None) or default
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        streams[name] = dict(
+            recv=recv,
+            chunks=[],
+            decoder=decoder,
+            out=None if name in hide else out,
+            eof=False,
+        )
+    # Never block in recv(); we only read when told data is waiting.
+    channel.setblocking(0)
+    fd = channel.fileno()
+
+    def readable():
+        try:
+            for stream in streams.values():
+                while not stream['eof']:
+                    try:
+                        data = stream['recv'](read_chunk_size)
+                    except socket.timeout:
+                        break
+                    if not data:
+                        stream['eof'] = True
+                        data = b''
+                    text = stream['decoder'].decode(data, final=stream['eof'])
+                    if text:
+                        stream['chunks'].append(text)
+                        if stream['out'] is not None:
+                            stream['out'].write(text)
+                            stream['out'].flush()
+        except Exception as e:
+            loop.remove_reader(fd)
+            future.set_exception(e)
+            return
+        if all(x['eof'] for x in streams.values()):
+            loop.remove_reader(fd)
+            future.set_result(tuple(
+                u"".join(streams[x]['chunks']) for x in ('stdout', 'stderr')
+            ))
+
+    loop.add_reader(fd, readable)
+    # Data may well have arrived before we began watching.
+    readable()
+    return future
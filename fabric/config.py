@@ -191,14 +191,41 @@ class Config(InvokeConfig):
             'user': get_local_user(),
             'forward_agent': False,
             'gateway': None,
+            'group': {
+                'max_workers': None,
+            },
             'load_ssh_configs': True,
             'connect_kwargs': {},
+            'connection_pool': {
+                'idle_timeout': None,
+                'max_per_host': None,
+                'max_size': None,
+            },
             # TODO: this becomes an override once Invoke grows execution
             # timeouts (which should be timeouts.execute)
             'timeouts': {
                 'connect': None,
             },
             'ssh_config_path': None,
+            'transfer': {
+                'block_size': 32768,
+                'channel_idle_timeout': 60,
+                'channels': 4,
+                'checkpoint_size': 8388608,
+                'memory_map': False,
+                'protocol': 'sftp',
+                'retries': 0,
+                'window': None,
+                'workers': 4,
+            },
+            'tunnels': {
+                'adaptive': False,
+                'channel_chunk_size': 32768,
+                'open_workers': 4,
+                'preopen': 0,
+                'socket_chunk_size': 32768,
+                'stats_interval': 10,
+            },
             # Overrides of existing settings
             'run': {
                 'replace_env': True,
@@ -1,7 +1,8 @@
 from contextlib import contextmanager
-from threading import Event
 from invoke.vendor.six import StringIO
 import socket
+import threading
+import time
 
 from invoke.vendor.decorator import decorator
 from invoke.vendor.six import string_types
@@ -16,7 +17,8 @@ from paramiko.proxy import ProxyCommand
 from .config import Config
 from .runners import Remote
 from .transfer import Transfer
-from .tunnels import TunnelManager, Tunnel
+from .tunnels import TunnelManager
+from .util import debug
 
 
 @decorator
@@ -25,6 +27,268 @@ def opens(method, self, *args, **kwargs):
     return method(self, *args, **kwargs)
 
 
+class SFTPPool(object):
+    """
+    Hands out a `.Connection`'s SFTP channels to concurrent transfers.
+
+    A `~paramiko.sftp_client.SFTPClient` isn't safe to use from several
+    threads at once, so each `.Transfer.get` or `.Transfer.put` leases a
+    channel of its own via `acquire`, and hands it back via `release` when
+    done:
+
+    - an idle channel is reused if there is one, preferring the connection's
+      own (see `.Connection.sftp`), whose state such as
+      `~paramiko.sftp_client.SFTPClient.chdir` thus keeps applying;
+    - otherwise, another channel is opened on the connection's transport,
+      unless that would exceed ``size`` channels;
+    - otherwise, `acquire` waits for a channel to be released.
+
+    A channel is never leased to more than one caller at a time.
+
+    Extra channels left idle for longer than ``idle_timeout`` are closed.
+
+    Every `.Connection` has one of these, as its ``sftp_pool`` attribute.
+    """
+    def __init__(self, connection, size=1, idle_timeout=None):
+        """
+        :param connection: The `.Connection` whose channels are pooled.
+
+        :param int size:
+            Maximum number of SFTP channels open at once. Default: ``1``
+            (i.e. all transfers share the connection's own channel.)
+
+        :param idle_timeout:
+            Number of seconds (`int` or `float`) an extra channel may sit
+            unused before it is closed. Default: ``None`` (extra channels
+            stay open until `close` is called.)
+        """
+        if size < 1:
+            err = "size must be a positive integer, not {0!r}!"
+            raise ValueError(err.format(size))
+        self.connection = connection
+        #: Channel limit; see `__init__`.
+        self.size = size
+        #: Idle channel lifetime, in seconds; see `__init__`.
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Condition()
+        # Open channels, as [client, leases, released_at] lists.
+        self._channels = []
+        # Number of channels being opened (outside the lock) right now, and
+        # whether one of them is the connection's own.
+        self._opening = 0
+        self._opening_primary = False
+        # Channels dropped (by close) while leased, which may still come back.
+        self._discarded = set()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._channels)
+
+    def __getstate__(self):
+        # Open channels (and our lock) are of no use in another process, e.g.
+        # when a ProcessPoolGroup hands our (unopened) connection to a worker.
+        state = self.__dict__.copy()
+        for key in (
+            '_lock', '_channels', '_opening', '_opening_primary', '_discarded',
+        ):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Condition()
+        self._channels = []
+        self._opening = 0
+        self._opening_primary = False
+        self._discarded = set()
+
+    def acquire(self, blocking=True):
+        """
+        Lease an `~paramiko.sftp_client.SFTPClient`, opening one if needed.
+
+        :param bool blocking:
+            Whether to wait for a channel to be released when ``size``
+            channels are leased out already. When ``False``, ``None`` is
+            returned instead. Default: ``True``.
+
+        :returns: An SFTP client, which must later be given to `release`.
+        """
+        expired, opening = [], False
+        with self._lock:
+            while True:
+                expired.extend(self._expire())
+                entry = self._pick()
+                if entry is not None:
+                    entry[1] += 1
+                    break
+                if len(self._channels) + self._opening < self.size:
+                    # (Re)open the connection's own channel first, if need be.
+                    primary = (
+                        self.connection._sftp is None
+                        and not self._opening_primary
+                    )
+                    self._opening_primary = self._opening_primary or primary
+                    self._opening += 1
+                    opening = True
+                    break
+                if not blocking:
+                    break
+                # Everything's leased out; wait for a release.
+                self._lock.wait()
+        # Opening and closing channels is network IO; don't hold the lock for
+        # it.
+        for client in expired:
+            self._close_channel(client)
+        if entry is not None:
+            return entry[0]
+        if not opening:
+            return None
+        try:
+            if primary:
+                client = self.connection.sftp()
+            else:
+                debug("Opening extra SFTP channel to {0!r}".format(
+                    self.connection,
+                ))
+                self.connection.open()
+                client = self.connection.client.open_sftp()
+        except BaseException:
+            with self._lock:
+                self._opened(primary)
+            raise
+        with self._lock:
+            self._opened(primary)
+            entry = self._find(client)
+            if entry is None:
+                entry = [client, 0, None]
+                self._channels.append(entry)
+            entry[1] += 1
+        return client
+
+    def release(self, client, broken=False):
+        """
+        Return ``client`` (obtained via `acquire`) to the pool.
+
+        :param bool broken:
+            Whether ``client``'s channel failed, in which case it is closed &
+            discarded instead (even if it is the connection's own.)
+
+        :raises: ``ValueError`` if ``client`` was not leased from this pool.
+        """
+        with self._lock:
+            entry = self._find(client)
+            if entry is None and client in self._discarded:
+                # Leased across a call to close(); nothing left to hand back.
+                self._discarded.remove(client)
+                if broken and self.connection._sftp is client:
+                    self.connection._sftp = None
+                expired = []
+            elif entry is None or not entry[1]:
+                err = "{0!r} was not acquired from this pool!"
+                raise ValueError(err.format(client))
+            else:
+                entry[1] -= 1
+                entry[2] = time.time()
+                if broken:
+                    self._channels.remove(entry)
+                    if self.connection._sftp is client:
+                        self.connection._sftp = None
+                expired = self._expire()
+            self._lock.notify_all()
+        if broken:
+            expired.append(client)
+        for other in expired:
+            self._close_channel(other)
+
+    def prune(self):
+        """
+        Close extra channels idle for longer than ``idle_timeout``.
+
+        This happens automatically during `acquire` and `release`; calling it
+        manually is only needed to free resources sooner.
+        """
+        with self._lock:
+            expired = self._expire()
+        for client in expired:
+            self._close_channel(client)
+
+    def close(self):
+        """
+        Close all extra channels, and forget about the connection's own.
+
+        Channels currently leased out are closed too, so this is best called
+        once no transfers are running (e.g. by `.Connection.close`.) Releasing
+        them afterwards is harmless.
+        """
+        with self._lock:
+            extra = [
+                x[0] for x in self._channels
+                if x[0] is not self.connection._sftp
+            ]
+            self._discarded.update(x[0] for x in self._channels if x[1])
+            self._channels = []
+        for client in extra:
+            self._close_channel(client)
+
+    # NOTE: the below all assume self._lock is held.
+
+    def _opened(self, primary):
+        self._opening -= 1
+        if primary:
+            self._opening_primary = False
+        self._lock.notify_all()
+
+    def _find(self, client):
+        for entry in self._channels:
+            if entry[0] is client:
+                return entry
+        return None
+
+    def _pick(self):
+        # Adopt the connection's own channel if it was opened behind our back
+        # (i.e. by calling Connection.sftp directly), unless it's one we're
+        # opening ourselves, which acquire() is about to lease out.
+        primary = self.connection._sftp
+        if (
+            primary is not None
+            and not self._opening_primary
+            and self._find(primary) is None
+        ):
+            # Still leased out, if it was when close() forgot about it.
+            leases = 1 if primary in self._discarded else 0
+            self._discarded.discard(primary)
+            self._channels.insert(0, [primary, leases, None])
+        idle = [x for x in self._channels if not x[1]]
+        for entry in idle:
+            if entry[0] is primary:
+                return entry
+        if idle:
+            # Most recently used first, so the others may expire.
+            return max(idle, key=lambda x: x[2])
+        return None
+
+    def _expire(self):
+        if self.idle_timeout is None:
+            return []
+        cutoff = time.time() - self.idle_timeout
+        expired = [
+            x for x in self._channels
+            if not x[1]
+            and x[2] is not None
+            and x[2] < cutoff
+            and x[0] is not self.connection._sftp
+        ]
+        for entry in expired:
+            self._channels.remove(entry)
+        return [x[0] for x in expired]
+
+    def _close_channel(self, client):
+        try:
+            client.close()
+        except Exception as e:
+            debug("Error closing SFTP channel {0!r}: {1!r}".format(client, e))
+
+
 class Connection(Context):
     """
     A connection to an SSH daemon, with methods for commands and file transfer.
@@ -103,6 +367,9 @@ class Connection(Context):
     client = None
     transport = None
     _sftp = None
+    sftp_pool = None
+    # The remote directory SFTP sessions start in; see Transfer._cwd.
+    _sftp_home = None
     _agent_handler = None
 
     # TODO: should "reopening" an existing Connection object that has been
@@ -341,6 +608,15 @@ class Connection(Context):
         #: ``self.client.get_transport()``.
         self.transport = None
 
+        #: The `.SFTPPool` sharing out this connection's SFTP channels among
+        #: concurrent transfers; sized by the ``transfer.channels`` and
+        #: ``transfer.channel_idle_timeout`` config settings.
+        self.sftp_pool = SFTPPool(
+            self,
+            size=self.config.transfer.channels,
+            idle_timeout=self.config.transfer.channel_idle_timeout,
+        )
+
     def __repr__(self):
         # Host comes first as it's the most common differentiator by far
         bits = [('host', self.host)]
@@ -500,6 +776,7 @@ class Connection(Context):
         If no connection is open, this method does nothing.
         """
         if self.is_connected:
+            self.sftp_pool.close()
             self.client.close()
             if self.forward_agent and self._agent_handler is not None:
                 self._agent_handler.close()
@@ -565,6 +842,11 @@ class Connection(Context):
         given `.Connection` instance will only ever have a single SFTP client,
         and state (such as that managed by
         `~paramiko.sftp_client.SFTPClient.chdir`) will be preserved.
+
+        .. note::
+            Concurrent transfers may additionally use other SFTP channels,
+            handed out by `sftp_pool`; a ``chdir`` on this one applies to
+            theirs as well.
         """
         if self._sftp is None:
             self._sftp = self.client.open_sftp()
@@ -588,6 +870,61 @@ class Connection(Context):
         """
         return Transfer(self).put(*args, **kwargs)
 
+    def _tunnel_settings(
+        self,
+        socket_chunk_size,
+        channel_chunk_size,
+        adaptive,
+        stats_callback,
+        stats_interval,
+    ):
+        """
+        Fill in `.TunnelManager` settings from config where they're ``None``.
+        """
+        settings = self.config.tunnels
+        if socket_chunk_size is None:
+            socket_chunk_size = settings.socket_chunk_size
+        if channel_chunk_size is None:
+            channel_chunk_size = settings.channel_chunk_size
+        if adaptive is None:
+            adaptive = settings.adaptive
+        if stats_interval is None:
+            stats_interval = settings.stats_interval
+        for name, value in (
+            ('socket_chunk_size', socket_chunk_size),
+            ('channel_chunk_size', channel_chunk_size),
+        ):
+            if value < 1:
+                err = "{0} must be a positive integer, not {1!r}!"
+                raise ValueError(err.format(name, value))
+        if stats_interval <= 0:
+            err = "stats_interval must be positive, not {0!r}!"
+            raise ValueError(err.format(stats_interval))
+        return dict(
+            socket_chunk_size=socket_chunk_size,
+            channel_chunk_size=channel_chunk_size,
+            adaptive=adaptive,
+            stats_callback=stats_callback,
+            stats_interval=stats_interval,
+        )
+
+    def _opener_settings(self, open_workers, preopen=0):
+        """
+        Fill in `.ChannelOpener` settings from config where they're ``None``.
+        """
+        settings = self.config.tunnels
+        if open_workers is None:
+            open_workers = settings.open_workers
+        if preopen is None:
+            preopen = settings.preopen
+        if open_workers < 1:
+            err = "open_workers must be a positive integer, not {0!r}!"
+            raise ValueError(err.format(open_workers))
+        if preopen < 0:
+            err = "preopen must not be negative, not {0!r}!"
+            raise ValueError(err.format(preopen))
+        return dict(open_workers=open_workers, preopen=preopen)
+
     # TODO: yield the socket for advanced users? Other advanced use cases
     # (perhaps factor out socket creation itself)?
     # TODO: probably push some of this down into Paramiko
@@ -599,6 +936,13 @@ class Connection(Context):
         remote_port=None,
         remote_host='localhost',
         local_host='localhost',
+        socket_chunk_size=None,
+        channel_chunk_size=None,
+        adaptive=None,
+        stats_callback=None,
+        stats_interval=None,
+        open_workers=None,
+        preopen=None,
     ):
         """
         Open a tunnel connecting ``local_port`` to the server's environment.
@@ -634,56 +978,192 @@ class Connection(Context):
             The remote hostname serving the forwarded remote port. Default:
             ``localhost`` (i.e., the host this `.Connection` is connected to.)
 
+        :param int socket_chunk_size:
+            Bytes read from each local socket at a time. Default: the
+            ``tunnels.socket_chunk_size`` config setting (``32768``).
+
+        :param int channel_chunk_size:
+            Bytes read from each SSH channel at a time. Default: the
+            ``tunnels.channel_chunk_size`` config setting (``32768``).
+
+        :param bool adaptive:
+            Whether to grow reads beyond the chunk sizes above (up to the
+            channel's window) while data keeps arriving, and to drain all
+            readable data per wakeup; see `.Tunnel`. Default: the
+            ``tunnels.adaptive`` config setting (``False``).
+
+        :param stats_callback:
+            Callable given the yielded `.TunnelStats` every
+            ``stats_interval`` seconds (after updating its recent rates), from
+            the thread forwarding data; e.g. for logging which tunnels are
+            busy or stalled. Default: ``None``.
+
+        :param stats_interval:
+            Seconds between calls to ``stats_callback``. Default: the
+            ``tunnels.stats_interval`` config setting (``10``).
+
+        :param int open_workers:
+            Most channels opened at the same time. Opening a channel takes a
+            round trip to the server, which happens in the background, so
+            other clients (and data of existing ones) aren't held up by it.
+            Default: the ``tunnels.open_workers`` config setting (``4``).
+
+        :param int preopen:
+            Number of channels to open ahead of time, so new clients needn't
+            wait for that round trip: worthwhile for bursts of short-lived
+            connections (e.g. HTTP without keep-alive), provided the remote
+            end doesn't mind that many idle connections. Default: the
+            ``tunnels.preopen`` config setting (``0``).
+
         :returns:
-            Nothing; this method is only useful as a context manager affecting
-            local operating system state.
+            A `.TunnelStats`, counting the data forwarded, channels opened
+            (and how long that took) and the tunnels currently open; it's
+            updated live while the block runs.
         """
         if not remote_port:
             remote_port = local_port
+        tunnel_kwargs = self._tunnel_settings(
+            socket_chunk_size, channel_chunk_size, adaptive,
+            stats_callback, stats_interval,
+        )
+        tunnel_kwargs.update(self._opener_settings(open_workers, preopen))
 
         # TunnelManager does all of the work, sitting in the background (so we
-        # can yield) and spawning threads every time somebody connects to our
+        # can yield) and forwarding data for everybody who connects to our
         # local port.
-        finished = Event()
         manager = TunnelManager(
             local_port=local_port, local_host=local_host,
             remote_port=remote_port, remote_host=remote_host,
             # TODO: not a huge fan of handing in our transport, but...?
-            transport=self.transport, finished=finished,
+            transport=self.transport,
+            **tunnel_kwargs
         )
         manager.start()
+        # Don't hand control back until clients can actually connect.
+        manager.ready.wait()
+        if not manager.started:
+            # E.g. the local port is taken; raise right away.
+            self._stop_tunnels(manager)
 
         # Return control to caller now that things ought to be operational
         try:
-            yield
+            yield manager.stats
         # Teardown once user exits block
         finally:
-            # Signal to manager that it should close all open tunnels
-            finished.set()
-            # Then wait for it to do so
-            manager.join()
-            # Raise threading errors from within the manager, which would be
-            # one of:
-            # - an inner ThreadException, which was created by the manager on
-            # behalf of its Tunnels; this gets directly raised.
-            # - some other exception, which would thus have occurred in the
-            # manager itself; we wrap this in a new ThreadException.
-            # NOTE: in these cases, some of the metadata tracking in
-            # ExceptionHandlingThread/ExceptionWrapper/ThreadException (which
-            # is useful when dealing with multiple nearly-identical sibling IO
-            # threads) is superfluous, but it doesn't feel worth breaking
-            # things up further; we just ignore it for now.
-            wrapper = manager.exception()
-            if wrapper is not None:
-                if wrapper.type is ThreadException:
-                    raise wrapper.value
-                else:
-                    raise ThreadException([wrapper])
+            self._stop_tunnels(manager)
 
             # TODO: cancel port forward on transport? Does that even make sense
             # here (where we used direct-tcpip) vs the opposite method (which
             # is what uses forward-tcpip)?
 
+    @contextmanager
+    @opens
+    def forward_dynamic(
+        self,
+        local_port,
+        local_host='localhost',
+        socket_chunk_size=None,
+        channel_chunk_size=None,
+        adaptive=None,
+        stats_callback=None,
+        stats_interval=None,
+        open_workers=None,
+    ):
+        """
+        Run a SOCKS proxy on ``local_port``, connecting out from the server.
+
+        Where `forward_local` tunnels one local port to one remote address,
+        this lets local clients pick any destination reachable from the
+        server, per connection: e.g. to reach many internal services behind
+        a bastion host without a port forward for each::
+
+            import requests
+            from fabric import Connection
+
+            with Connection('bastion').forward_dynamic(1080):
+                proxies = {'http': 'socks5h://localhost:1080'}
+                for host in ('app1', 'app2', 'app3'):
+                    url = 'http://{0}/health'.format(host)
+                    print(requests.get(url, proxies=proxies).status_code)
+
+        SOCKS versions 4, 4a & 5 (without authentication) are understood; only
+        ``CONNECT`` requests are supported. Each request opens a
+        ``direct-tcpip`` channel over this connection's transport, so names
+        given to the proxy are resolved by the server (i.e. use
+        ``socks5h://`` or ``socks4a://`` to reach names only it knows).
+        Requests for destinations the server can't reach are refused, without
+        affecting anything else. Handshakes and forwarded data alike are
+        handled by a single `.TunnelManager` thread, no matter how many
+        clients connect.
+
+        This method is analogous to using the ``-D`` option of OpenSSH's
+        ``ssh`` program.
+
+        :param int local_port: The local port number on which to listen.
+
+        :param str local_host:
+            The local hostname/interface on which to listen. Default:
+            ``localhost``.
+
+        :param int socket_chunk_size: As in `forward_local`.
+
+        :param int channel_chunk_size: As in `forward_local`.
+
+        :param bool adaptive: As in `forward_local`.
+
+        :param stats_callback: As in `forward_local`.
+
+        :param stats_interval: As in `forward_local`.
+
+        :param int open_workers: As in `forward_local`.
+
+        :returns: A `.TunnelStats`, as in `forward_local`.
+        """
+        tunnel_kwargs = self._tunnel_settings(
+            socket_chunk_size, channel_chunk_size, adaptive,
+            stats_callback, stats_interval,
+        )
+        tunnel_kwargs.update(self._opener_settings(open_workers))
+        manager = TunnelManager(
+            local_port=local_port, local_host=local_host,
+            transport=self.transport, socks=True,
+            **tunnel_kwargs
+        )
+        manager.start()
+        manager.ready.wait()
+        if not manager.started:
+            self._stop_tunnels(manager)
+        try:
+            yield manager.stats
+        finally:
+            self._stop_tunnels(manager)
+
+    def _stop_tunnels(self, manager):
+        """
+        Stop a `.TunnelManager` (closing all its tunnels) & raise its errors.
+        """
+        # Signal to manager that it should close all open tunnels
+        manager.stop()
+        # Then wait for it to do so
+        manager.join()
+        # Raise threading errors from within the manager, which would be one
+        # of:
+        # - an inner ThreadException, which was created by the manager on
+        # behalf of its Tunnels; this gets directly raised.
+        # - some other exception, which would thus have occurred in the
+        # manager itself; we wrap this in a new ThreadException.
+        # NOTE: in these cases, some of the metadata tracking in
+        # ExceptionHandlingThread/ExceptionWrapper/ThreadException (which is
+        # useful when dealing with multiple nearly-identical sibling IO
+        # threads) is superfluous, but it doesn't feel worth breaking things
+        # up further; we just ignore it for now.
+        wrapper = manager.exception()
+        if wrapper is not None:
+            if wrapper.type is ThreadException:
+                raise wrapper.value
+            else:
+                raise ThreadException([wrapper])
+
     # TODO: probably push some of this down into Paramiko
     @contextmanager
     @opens
@@ -693,6 +1173,11 @@ class Connection(Context):
         local_port=None,
         remote_host='127.0.0.1',
         local_host='localhost',
+        socket_chunk_size=None,
+        channel_chunk_size=None,
+        adaptive=None,
+        stats_callback=None,
+        stats_interval=None,
     ):
         """
         Open a tunnel connecting ``remote_port`` to the local environment.
@@ -732,39 +1217,48 @@ class Connection(Context):
             connections. Default: ``127.0.0.1`` (i.e. only listen on the remote
             localhost).
 
-        :returns:
-            Nothing; this method is only useful as a context manager affecting
-            local operating system state.
+        :param int socket_chunk_size: As in `forward_local`.
+
+        :param int channel_chunk_size: As in `forward_local`.
+
+        :param bool adaptive: As in `forward_local`.
+
+        :param stats_callback: As in `forward_local`.
+
+        :param stats_interval: As in `forward_local`.
+
+        :returns: A `.TunnelStats`, as in `forward_local`.
         """
         if not local_port:
             local_port = remote_port
+        tunnel_kwargs = self._tunnel_settings(
+            socket_chunk_size, channel_chunk_size, adaptive,
+            stats_callback, stats_interval,
+        )
         # Callback executes on each connection to the remote port and is given
         # a Channel hooked up to said port. (We don't actually care about the
         # source/dest host/port pairs at all; only whether the channel has data
         # to read and suchlike.)
         # We then pair that channel with a new 'outbound' socket connection to
-        # the local host/port being forwarded, in a new Tunnel.
-        # That Tunnel is then added to a shared data structure so we can track
-        # & close them during shutdown.
-        #
-        # TODO: this approach is less than ideal because we have to share state
-        # between ourselves & the callback handed into the transport's own
-        # thread handling (which is roughly analogous to our self-controlled
-        # TunnelManager for local forwarding). See if we can use more of
-        # Paramiko's API (or improve it and then do so) so that isn't
-        # necessary.
-        tunnels = []
+        # the local host/port being forwarded, and hand both to a
+        # (listener-less) TunnelManager, which forwards data for all of them
+        # and closes them during shutdown.
+        manager = TunnelManager(**tunnel_kwargs)
+        manager.start()
+
         def callback(channel, src_addr_tup, dst_addr_tup):
             sock = socket.socket()
+            start = time.time()
             # TODO: handle connection failure such that channel, etc get closed
-            sock.connect((local_host, local_port))
-            # TODO: we don't actually need to generate the Events at our level,
-            # do we? Just let Tunnel.__init__ do it; all we do is "press its
-            # button" on shutdown...
-            tunnel = Tunnel(channel=channel, sock=sock, finished=Event())
-            tunnel.start()
-            # Communication between ourselves & the Paramiko handling subthread
-            tunnels.append(tunnel)
+            try:
+                sock.connect((local_host, local_port))
+            except Exception:
+                manager.stats.channel_failed()
+                raise
+            manager.stats.channel_opened(time.time() - start)
+            # NOTE: this runs in the transport's own thread; add() hands over
+            # to the manager's.
+            manager.add(channel=channel, sock=sock)
         # Ask Paramiko (really, the remote sshd) to call our callback whenever
         # connections are established on the remote iface/port.
         # transport.request_port_forward(remote_host, remote_port, callback)
@@ -774,17 +1268,12 @@ class Connection(Context):
                 port=remote_port,
                 handler=callback,
             )
-            yield
+            yield manager.stats
         finally:
-            # TODO: see above re: lack of a TunnelManager
-            # TODO: and/or also refactor with TunnelManager re: shutdown logic.
-            # E.g. maybe have a non-thread TunnelManager-alike with a method
-            # that acts as the callback? At least then there's a tiny bit more
-            # encapsulation...meh.
-            for tunnel in tunnels:
-                tunnel.finished.set()
-                tunnel.join()
-            self.transport.cancel_port_forward(
-                address=remote_host,
-                port=remote_port,
-            )
+            try:
+                self._stop_tunnels(manager)
+            finally:
+                self.transport.cancel_port_forward(
+                    address=remote_host,
+                    port=remote_port,
+                )
@@ -3,10 +3,25 @@ from invoke.util import debug
 
 from . import Connection
 from .exceptions import NothingToDo
+from .pool import ConnectionPool
 
 
 # TODO: come up w/ a better name heh
 class FabExecutor(Executor):
+    #: The `.ConnectionPool` shared by all per-host calls of the current
+    #: `execute` run; ``None`` outside of one.
+    pool = None
+
+    def execute(self, *tasks):
+        # Share connections between every task executed against a given host
+        # in this session, instead of reconnecting for each one.
+        self.pool = ConnectionPool.from_config(self.config)
+        try:
+            return super(FabExecutor, self).execute(*tasks)
+        finally:
+            self.pool.close()
+            self.pool = None
+
     def expand_calls(self, calls):
         # Generate new call list with per-host variants & Connections inserted
         ret = []
@@ -50,6 +65,7 @@ class FabExecutor(Executor):
         clone = call.clone(into=ConnectionCall)
         # TODO: using bag-of-attrs is mildly gross but whatever, I'll take it.
         clone.host = host
+        clone.pool = self.pool
         return clone
 
     def dedupe(self, tasks):
@@ -63,6 +79,19 @@ class FabExecutor(Executor):
 class ConnectionCall(Call):
     """
     Subclass of `invoke.tasks.Call` that generates `Connections <.Connection>`.
+
+    If a `.ConnectionPool` has been attached as ``pool``, the connection is
+    drawn from it, so consecutive calls against the same host share a single
+    network connection.
     """
+    pool = None
+
     def make_context(self, config):
-        return Connection(host=self.host, config=config)
+        if self.pool is None:
+            return Connection(host=self.host, config=config)
+        # Calls execute one at a time, so the connection can go straight back
+        # into the pool: nothing else will acquire it before this call's task
+        # has finished using it.
+        cxn = self.pool.acquire(host=self.host, config=config)
+        self.pool.release(cxn)
+        return cxn
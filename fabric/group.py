@@ -1,9 +1,21 @@
-from invoke.vendor.six.moves.queue import Queue
-
+from functools import partial
+from io import BytesIO, StringIO
+from multiprocessing import Pool, cpu_count
+import os
+import pickle
+import posixpath
+import stat
+import threading
+import time
+
+from invoke.vendor.six.moves.queue import Queue, Empty
+
+from invoke.exceptions import ThreadException
 from invoke.util import ExceptionHandlingThread
 
 from .connection import Connection
 from .exceptions import GroupException
+from .transfer import Result, Summary, interpolate, relay, _digest
 
 
 class Group(list):
@@ -53,25 +65,55 @@ class Group(list):
         }
 
     """
-    def __init__(self, *hosts):
+    def __init__(self, *hosts, **kwargs):
         """
         Create a group of connections from one or more shorthand strings.
 
         See `.Connection` for details on the format of these strings - they
         will be used as the first positional argument of `.Connection`
         constructors.
+
+        Any keyword arguments are also passed to the `.Connection`
+        constructors, with one exception:
+
+        :param pool:
+            A `.ConnectionPool` from which to `acquire
+            <.ConnectionPool.acquire>` the connections, instead of creating new
+            ones. They are handed back to the pool by `close`. Hosts given
+            more than once (as judged by `.ConnectionPool.key`) only get one
+            connection, since leasing a second could wait forever on the first
+            (e.g. with a ``max_per_host`` of 1.) Default: ``None``.
         """
         # TODO: #563, #388 (could be here or higher up in Program area)
-        self.extend(map(Connection, hosts))
+        pool = kwargs.pop('pool', None)
+        #: The `.ConnectionPool` our connections came from, if any.
+        self.pool = pool
+        if pool is None:
+            self.extend(Connection(host, **kwargs) for host in hosts)
+            return
+        seen = set()
+        try:
+            for host in hosts:
+                key = pool.key(Connection(host, **kwargs))
+                if key not in seen:
+                    seen.add(key)
+                    self.append(pool.acquire(host, **kwargs))
+        except BaseException:
+            # Don't leak the leases we did get.
+            self.close()
+            raise
 
     @classmethod
-    def from_connections(cls, connections):
+    def from_connections(cls, connections, **kwargs):
         """
         Alternate constructor accepting `.Connection` objects.
+
+        Keyword arguments are handed to the class' constructor, for subclasses
+        which accept their own (such as ``ThreadingGroup(max_workers=...)``).
         """
         # TODO: *args here too; or maybe just fold into __init__ and type
         # check?
-        group = cls()
+        group = cls(**kwargs)
         group.extend(connections)
         return group
 
@@ -98,6 +140,42 @@ class Group(list):
         # exception just being the signal that Shit Broke?
         raise NotImplementedError
 
+    def run_iter(self, *args, **kwargs):
+        """
+        Like `run`, but yielding results as soon as each connection finishes.
+
+        This is a generator yielding ``(connection, result)`` two-tuples in
+        order of completion (which, for concurrent subclasses, need not be
+        the order of the group's contents). ``result`` is either the return
+        value of `.Connection.run` or, in place of raising, the exception
+        encountered, just as with the values of a `.GroupResult`.
+
+        For example, to act upon early results while slower hosts are still
+        busy::
+
+            for cxn, result in group.run_iter("uptime", hide=True):
+                if isinstance(result, Exception):
+                    print("{0}: failed! {1!r}".format(cxn.host, result))
+                else:
+                    print("{0}: {1}".format(cxn.host, result.stdout.strip()))
+
+        Closing the generator early (e.g. via ``break``) prevents execution on
+        any connections not yet started; ones already in progress are allowed
+        to finish.
+        """
+        return self._iter('run', args, kwargs)
+
+    def _iter(self, method, args, kwargs):
+        """
+        Call ``method`` on all member connections, yielding as they finish.
+
+        The engine behind `run_iter`, `put` and `get`; concrete subclasses
+        implement this instead of those methods. ``method`` is either the name
+        of a `.Connection` method, or a (picklable) callable taking a
+        connection as its first argument; see `_call`.
+        """
+        raise NotImplementedError
+
     # TODO: how to handle sudo? Probably just an inner worker method that takes
     # the method name to actually call (run, sudo, etc)?
 
@@ -109,17 +187,189 @@ class Group(list):
     # would be distinct from Group. (May want to switch Group to use that,
     # though, whatever it ends up being?)
 
-    # TODO: mirror Connection's close()?
+    def close(self):
+        """
+        Close all member `Connections <.Connection>`.
 
-    def get(self, *args, **kwargs):
+        If this group was created with a ``pool``, the connections are instead
+        released back into it (where they remain open for reuse).
+        """
+        for cxn in self:
+            if self.pool is None:
+                cxn.close()
+            else:
+                self.pool.release(cxn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, remote, local=None, **kwargs):
         """
         Executes `.Connection.get` on all member `Connections <.Connection>`.
 
-        :returns: a `.GroupResult`.
+        Takes the same arguments as `.Transfer.get`; in particular, ``local``
+        paths may contain ``{host}``, ``{user}`` and ``{port}`` placeholders,
+        filled in per connection, which allow every host's copy to be stored
+        separately::
+
+            group.get('/var/log/syslog', 'logs/{host}/syslog')
+
+        When ``local`` is not given, and the group contains more than one
+        connection, it defaults to ``{host}/<remote filename>``.
+
+        :raises:
+            ``ValueError`` if several connections would download to the same
+            local path (or into the same file-like object), as they would
+            otherwise clobber one another.
+
+        :returns:
+            a `.GroupResult` of `.transfer.Result` objects, summarized by
+            `.GroupResult.transfers`.
         """
-        # TODO: probably best to suck it up & match actual get() sig?
-        # TODO: actually implement on subclasses
-        raise NotImplementedError
+        if not local and len(self) > 1:
+            local = os.path.join('{host}', posixpath.basename(remote))
+        if len(self) > 1:
+            if hasattr(local, 'write'):
+                err = "Cannot download from {0} connections into a single file-like object!" # noqa
+                raise ValueError(err.format(len(self)))
+            paths = [interpolate(local, cxn) for cxn in self]
+            if len(set(paths)) != len(paths):
+                err = "Local path {0!r} is the same for multiple connections; try adding e.g. '{{host}}' to it." # noqa
+                raise ValueError(err.format(local))
+        kwargs['local'] = local
+        return _collect(self._iter('get', (remote,), kwargs))
+
+    def put(self, local, *args, **kwargs):
+        """
+        Executes `.Connection.put` on all member `Connections <.Connection>`.
+
+        Takes the same arguments as `.Transfer.put`. A file-like ``local`` is
+        read once, up front, and each connection then uploads from its own
+        in-memory copy of those contents.
+
+        :returns:
+            a `.GroupResult` of `.transfer.Result` objects, summarized by
+            `.GroupResult.transfers`.
+        """
+        if hasattr(local, 'read') and len(self) > 1:
+            pointer = local.tell()
+            try:
+                local.seek(0)
+                data = local.read()
+            finally:
+                local.seek(pointer)
+            return _collect(self._iter(_put_copy, (data,) + args, kwargs))
+        return _collect(self._iter('put', (local,) + args, kwargs))
+
+    def broadcast(
+        self, local, remote, seeds=1, fanout=2, preserve_mode=True,
+        timeout=60, **kwargs
+    ):
+        """
+        Upload ``local`` once per seed host, then copy it host to host.
+
+        The first ``seeds`` member connections receive regular uploads, via
+        `.Connection.put` (run in parallel, with any extra ``kwargs``.) The
+        file is then relayed onwards in rounds, each host holding a copy
+        serving it to up to ``fanout`` more hosts per round -- so the number
+        of copies grows geometrically, while only ``seeds`` copies ever leave
+        the local machine. See `.transfer.relay` for how hosts copy the file
+        between themselves (in short: by ``ssh``-ing to each other, so each
+        must be able to reach and authenticate to the others non-interactively
+        -- e.g. with ``forward_agent`` enabled -- and all need ``python3`` or
+        ``python``.)
+
+        Relayed copies are verified against the local file's SHA-256 digest,
+        and given its mode (if ``preserve_mode`` is ``True``.)
+
+        :param str local: Path of the local file to upload.
+
+        :param str remote:
+            Remote path to upload to (on every host.) Relative paths are
+            resolved against the first seed's working directory.
+
+        :param int seeds: Number of hosts uploaded to directly.
+        :param int fanout: Number of hosts each copy is relayed to per round.
+
+        :param timeout:
+            Seconds a host waits to connect to the hosts it relays to.
+
+        :returns:
+            a `.GroupResult` of `.transfer.Result` objects, summarized by
+            `.GroupResult.transfers`.
+        """
+        if hasattr(local, 'read'):
+            raise ValueError("Cannot broadcast a file-like object!")
+        if seeds < 1 or fanout < 1:
+            raise ValueError("seeds & fanout must be positive integers!")
+        digest = _digest(local)
+        mode = None
+        if preserve_mode:
+            mode = stat.S_IMODE(os.stat(local).st_mode)
+        results = {}
+        pending = list(self)
+        holders = []
+        # Seeds get regular uploads.
+        seeding = pending[:seeds]
+        del pending[:seeds]
+        _threaded(
+            lambda cxn: cxn.put(
+                local, remote, preserve_mode=preserve_mode, **kwargs
+            ),
+            seeding, results,
+        )
+        for cxn in seeding:
+            if not isinstance(results[cxn], Exception):
+                holders.append(cxn)
+        if holders:
+            # Relay using the absolute path the first seed ended up with.
+            remote = results[holders[0]].remote
+        # Each round, every holder relays to up to fanout pending hosts.
+        while pending and holders:
+            rounds = []
+            for source in holders:
+                targets = pending[:fanout]
+                del pending[:fanout]
+                if targets:
+                    rounds.append((source, tuple(targets)))
+
+            def copy(pair):
+                source, targets = pair
+                start = time.time()
+                try:
+                    outcomes = relay(
+                        source, targets, remote, digest, mode, timeout,
+                    )
+                except Exception as e:
+                    outcomes = [e] * len(targets)
+                elapsed = time.time() - start
+                for target, outcome in zip(targets, outcomes):
+                    if not isinstance(outcome, Exception):
+                        outcome = Result(
+                            local=local,
+                            orig_local=local,
+                            remote=remote,
+                            orig_remote=remote,
+                            connection=target,
+                            size=outcome,
+                            elapsed=elapsed,
+                        )
+                    results[target] = outcome
+            _threaded(copy, rounds, {})
+            for _, targets in rounds:
+                holders.extend(
+                    x for x in targets if not isinstance(results[x], Exception)
+                )
+        for cxn in pending:
+            results[cxn] = RuntimeError(
+                "No host received {0!r}, so none could relay it!".format(
+                    local,
+                ),
+            )
+        return _collect((cxn, results[cxn]) for cxn in self)
 
     def execute(self, task):
         """
@@ -136,17 +386,91 @@ class SerialGroup(Group):
     Subclass of `.Group` which executes in simple, serial fashion.
     """
     def run(self, *args, **kwargs):
-        results = GroupResult()
-        excepted = False
+        return _collect(self.run_iter(*args, **kwargs))
+
+    def _iter(self, method, args, kwargs):
         for cxn in self:
             try:
-                results[cxn] = cxn.run(*args, **kwargs)
+                result = _call(cxn, method, args, kwargs)
             except Exception as e:
-                results[cxn] = e
-                excepted = True
-        if excepted:
-            raise GroupException(results)
-        return results
+                result = e
+            yield cxn, result
+
+
+def _collect(pairs):
+    """
+    Build a `.GroupResult` from ``(connection, result)`` pairs.
+
+    :raises:
+        `.GroupException` (wrapping the `.GroupResult`) if any of the results
+        were exceptions.
+    """
+    results = GroupResult()
+    excepted = False
+    for cxn, result in pairs:
+        results[cxn] = result
+        if isinstance(result, Exception):
+            excepted = True
+    if excepted:
+        raise GroupException(results)
+    return results
+
+
+def _pop_max_workers(kwargs):
+    """
+    Pop & validate a ``max_workers`` kwarg, defaulting to the ``config``
+    kwarg's ``group.max_workers`` (if any.)
+    """
+    max_workers = kwargs.pop('max_workers', None)
+    config = kwargs.get('config', None)
+    if max_workers is None and config is not None:
+        try:
+            max_workers = config.group.max_workers
+        except AttributeError:
+            pass
+    if max_workers is not None and max_workers < 1:
+        err = "max_workers must be a positive integer, not {0!r}!"
+        raise ValueError(err.format(max_workers))
+    return max_workers
+
+
+def _call(cxn, method, args, kwargs):
+    """
+    Call ``method`` (a `.Connection` method name, or a callable expecting a
+    connection as its first argument) against ``cxn``.
+    """
+    if callable(method):
+        return method(cxn, *args, **kwargs)
+    return getattr(cxn, method)(*args, **kwargs)
+
+
+def _threaded(func, items, results):
+    """
+    Call ``func`` on every one of ``items`` at once, each in its own thread.
+
+    Results (or exceptions raised) are stored in the ``results`` dict, keyed
+    by item.
+    """
+    def call(item):
+        try:
+            results[item] = func(item)
+        except Exception as e:
+            results[item] = e
+    threads = [threading.Thread(target=call, args=(x,)) for x in items]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _put_copy(cxn, data, *args, **kwargs):
+    """
+    `.Connection.put` a fresh file-like object holding ``data``.
+
+    Used by `.Group.put` so concurrent uploads don't share one file pointer.
+    """
+    local = BytesIO(data) if isinstance(data, bytes) else StringIO(data)
+    return cxn.put(local, *args, **kwargs)
 
 
 def thread_worker(cxn, queue, args, kwargs):
@@ -154,11 +478,59 @@ def thread_worker(cxn, queue, args, kwargs):
     # TODO: namedtuple or attrs object?
     queue.put((cxn, result))
 
+
+def pool_worker(cxns, queue, args, kwargs, method='run'):
+    """
+    Call ``method`` on connections taken from ``cxns`` until it is empty.
+
+    Used by `.ThreadingGroup.run_iter`, `.ThreadingGroup.put` etc (and by
+    `.ThreadingGroup.run` when ``max_workers`` is set). As each worker serves
+    many connections, exceptions are caught here and put into ``queue``
+    alongside their connection, instead of ending the thread.
+    """
+    while True:
+        try:
+            cxn = cxns.get(block=False)
+        except Empty:
+            return
+        try:
+            result = _call(cxn, method, args, kwargs)
+        except Exception as e:
+            result = e
+        queue.put((cxn, result))
+
+
 class ThreadingGroup(Group):
     """
     Subclass of `.Group` which uses threading to execute concurrently.
+
+    By default, one thread is started per member connection. For large
+    groups, where that would mean thousands of simultaneous threads & SSH
+    handshakes, a fixed-size pool of worker threads may be used instead; see
+    ``max_workers`` in `__init__`.
     """
+    def __init__(self, *hosts, **kwargs):
+        """
+        Create a group; see `.Group.__init__` for the basics.
+
+        :param int max_workers:
+            Maximum number of worker threads to use at once. Connections are
+            handed to the workers as they become free, so at most this many
+            hosts are being talked to at any given time.
+
+            Default: the ``group.max_workers`` setting of the ``config``
+            keyword argument, if one was given (settable via ``fab
+            --max-workers``), and otherwise ``None``, meaning one thread per
+            connection.
+        """
+        max_workers = _pop_max_workers(kwargs)
+        super(ThreadingGroup, self).__init__(*hosts, **kwargs)
+        #: Size of the worker thread pool, or ``None`` for thread-per-host.
+        self.max_workers = max_workers
+
     def run(self, *args, **kwargs):
+        if self.max_workers is not None:
+            return _collect(self._iter('run', args, kwargs))
         results = GroupResult()
         queue = Queue()
         threads = []
@@ -207,6 +579,195 @@ class ThreadingGroup(Group):
             raise GroupException(results)
         return results
 
+    def _iter(self, method, args, kwargs):
+        # Connections are fed to workers via a queue; with no max_workers we
+        # simply start one worker per connection.
+        cxns = Queue()
+        for cxn in self:
+            cxns.put(cxn)
+        queue = Queue()
+        threads = []
+        for _ in range(min(self.max_workers or len(self), len(self))):
+            thread = ExceptionHandlingThread(
+                target=pool_worker,
+                kwargs=dict(
+                    cxns=cxns,
+                    queue=queue,
+                    args=args,
+                    kwargs=kwargs,
+                    method=method,
+                ),
+            )
+            threads.append(thread)
+            thread.start()
+        try:
+            received = 0
+            while received < len(self):
+                try:
+                    # TODO: make configurable
+                    cxn, result = queue.get(timeout=0.1)
+                except Empty:
+                    if any(x.is_alive() for x in threads) or not queue.empty():
+                        continue
+                    # All workers are gone but some connections never
+                    # reported back: a worker itself must have died (e.g. a
+                    # BaseException escaped it).
+                    wrappers = [x.exception() for x in threads]
+                    raise ThreadException([x for x in wrappers if x])
+                received += 1
+                yield cxn, result
+        finally:
+            # If we're exiting early (error, or the caller stopped iterating)
+            # keep workers from starting on anything else, then wait for
+            # in-flight connections to wrap up.
+            while True:
+                try:
+                    cxns.get(block=False)
+                except Empty:
+                    break
+            for thread in threads:
+                thread.join()
+
+
+class ProcessPoolGroup(Group):
+    """
+    Subclass of `.Group` which spreads its connections across processes.
+
+    Member connections are split into one shard per worker process; each
+    process then runs its shard as a `.ThreadingGroup` (with its own threads
+    and Paramiko transports) and sends the results back, to be merged into a
+    single `.GroupResult`. Encryption, packet handling and output decoding
+    thus happen in parallel on multiple CPU cores instead of contending for
+    one interpreter lock, which matters for very large groups.
+
+    Some caveats arise from crossing process boundaries:
+
+    - Member connections must not be open yet, and they (including their
+      config and ``connect_kwargs``) must be picklable; they are opened
+      within the worker processes and closed again once those are done.
+    - Results must be picklable too. Any which aren't (typically exotic
+      exceptions) are replaced with a ``RuntimeError`` describing them.
+    - Results' ``connection`` attributes refer to this group's own members,
+      as usual; however, those members' state (e.g. ``is_connected``) is
+      unaffected by what happened in the workers.
+    - Output which isn't hidden is printed by the worker processes, so it
+      will interleave just as with `.ThreadingGroup`.
+    """
+    def __init__(self, *hosts, **kwargs):
+        """
+        Create a group; see `.Group.__init__` for the basics.
+
+        :param int processes:
+            Number of worker processes to use (never more than the number of
+            connections.) Default: ``None``, meaning the number of CPUs.
+
+        :param int max_workers:
+            Maximum number of threads per worker process; see
+            `.ThreadingGroup.__init__`.
+        """
+        processes = kwargs.pop('processes', None)
+        if processes is not None and processes < 1:
+            err = "processes must be a positive integer, not {0!r}!"
+            raise ValueError(err.format(processes))
+        max_workers = _pop_max_workers(kwargs)
+        super(ProcessPoolGroup, self).__init__(*hosts, **kwargs)
+        #: Number of worker processes, or ``None`` for one per CPU.
+        self.processes = processes
+        #: Per-process thread limit, or ``None`` for thread-per-host.
+        self.max_workers = max_workers
+
+    def run(self, *args, **kwargs):
+        return _collect(self._iter('run', args, kwargs))
+
+    def run_iter(self, *args, **kwargs):
+        """
+        See `.Group.run_iter`.
+
+        Results arrive in batches, one per worker process, as each process
+        finishes its entire shard. Closing the generator early terminates
+        the workers, abandoning any connections still in progress.
+        """
+        return self._iter('run', args, kwargs)
+
+    def _iter(self, method, args, kwargs):
+        if not self:
+            return
+        for cxn in self:
+            if cxn.is_connected:
+                err = "Cannot hand already-open connection {0!r} to a worker process!" # noqa
+                raise ValueError(err.format(cxn))
+        count = min(self.processes or cpu_count(), len(self))
+        indexed = list(enumerate(self))
+        shards = [indexed[x::count] for x in range(count)]
+        worker = partial(
+            process_worker,
+            args=args,
+            kwargs=kwargs,
+            max_workers=self.max_workers,
+            method=method,
+        )
+        pool = Pool(count)
+        try:
+            for pairs in pool.imap_unordered(worker, shards):
+                for index, result in pairs:
+                    cxn = self[index]
+                    _reattach(result, cxn)
+                    yield cxn, result
+        finally:
+            # NOTE: all workers are idle by now, unless we're exiting early.
+            pool.terminate()
+            pool.join()
+
+
+def process_worker(shard, args, kwargs, max_workers, method='run'):
+    """
+    Run a shard of `.ProcessPoolGroup` connections within a worker process.
+
+    :param shard: A list of ``(index, connection)`` two-tuples.
+
+    :returns:
+        A list of ``(index, result)`` two-tuples, safe to send back to the
+        parent process.
+    """
+    indices = dict((id(cxn), index) for index, cxn in shard)
+    group = ThreadingGroup.from_connections(
+        [cxn for _, cxn in shard],
+        max_workers=max_workers,
+    )
+    results = []
+    try:
+        for cxn, result in group._iter(method, args, kwargs):
+            results.append((indices[id(cxn)], _detach(result)))
+    finally:
+        group.close()
+    return results
+
+
+def _detach(result):
+    """
+    Make ``result`` fit for pickling back to a `.ProcessPoolGroup`.
+
+    Strips (unpicklable, open) ``connection`` references, which are restored
+    by `_reattach`, and replaces otherwise unpicklable values with a
+    ``RuntimeError`` describing them.
+    """
+    # UnexpectedExit & friends hold the offending Result as .result.
+    for obj in (result, getattr(result, 'result', None)):
+        if hasattr(obj, 'connection'):
+            obj.connection = None
+    try:
+        pickle.dumps(result)
+    except Exception as e:
+        err = "{0!r} could not be sent back from its worker process: {1!r}"
+        result = RuntimeError(err.format(result, e))
+    return result
+
+
+def _reattach(result, cxn):
+    for obj in (result, getattr(result, 'result', None)):
+        if hasattr(obj, 'connection') and obj.connection is None:
+            obj.connection = cxn
+
 
 class GroupResult(dict):
     """
@@ -258,3 +819,16 @@ class GroupResult(dict):
         """
         self._bifurcate()
         return self._failures
+
+    @property
+    def transfers(self):
+        """
+        A `.transfer.Summary` of the successful `.transfer.Result` values.
+
+        E.g. ``group.put('app.tar.gz').transfers.throughput`` gives the
+        combined upload rate, and ``.slowest`` the result of the host with
+        the worst link.
+        """
+        return Summary(
+            x for x in self.succeeded.values() if isinstance(x, Result)
+        )
@@ -31,6 +31,11 @@ class Fab(Program):
                 names=('H', 'hosts'),
                 help="Comma-separated host name(s) to execute tasks against.",
             ),
+            Argument(
+                names=('max-workers',),
+                kind=int,
+                help="Max number of worker threads used by ThreadingGroups.",
+            ),
         ]
         return core_args + my_args
 
@@ -63,6 +68,9 @@ class Fab(Program):
         kwargs.update(dict(
             runtime_ssh_path=self.args['ssh-config'].value,
         ))
+        if self.args['max-workers'].value:
+            group = {'max_workers': self.args['max-workers'].value}
+            kwargs['overrides']['group'] = group
         return kwargs
 
 
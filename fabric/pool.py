@@ -0,0 +1,312 @@
+"""
+Pooling & reuse of open `Connections <.Connection>`.
+"""
+
+from contextlib import contextmanager
+import threading
+import time
+
+from .connection import Connection
+from .util import debug
+
+
+def _freeze(value):
+    """
+    Return a hashable stand-in for (possibly nested) ``value``.
+
+    Used to turn ``connect_kwargs`` dicts (which may contain lists of key
+    filenames, etc) into something usable as part of a dict key.
+    """
+    # NOTE: duck-typed so nested config values (DataProxy objects) qualify.
+    if hasattr(value, 'items'):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(x) for x in value)
+    try:
+        hash(value)
+    except TypeError:
+        # Unhashable & opaque (e.g. some custom object); identity is the best
+        # we can do.
+        return id(value)
+    return value
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe store of reusable `.Connection` objects.
+
+    Connections are handed out via `acquire` (or the `connection`
+    contextmanager) and handed back via `release`; released connections stay
+    open, and a subsequent `acquire` for the same target reuses them instead
+    of performing a fresh TCP connection, key exchange and authentication.
+
+    Connections are only reused when they are equivalent, as determined by
+    `key`: the same host, user and port (see ``Connection._identity``), *and*
+    the same gateway and ``connect_kwargs``.
+
+    .. note::
+        A reused connection is the same object that was originally handed
+        out, including its `.Config`; configuration given to later `acquire`
+        calls is only used to determine the connection's `key`.
+
+    Instances are also contextmanagers, which `close` themselves on exit::
+
+        with ConnectionPool(max_per_host=2) as pool:
+            with pool.connection('web1') as cxn:
+                cxn.run('uptime')
+    """
+    def __init__(self, max_per_host=None, max_size=None, idle_timeout=None):
+        """
+        Create a new, empty pool.
+
+        :param int max_per_host:
+            Maximum number of connections (leased or idle) per pool `key`.
+            When reached, `acquire` blocks until another caller releases a
+            connection for that key. Default: ``None`` (no limit).
+
+        :param int max_size:
+            Maximum number of connections (leased or idle) in the entire pool.
+            When reached, the least recently used idle connection is closed &
+            evicted to make room; if no connections are idle, `acquire` blocks
+            as with ``max_per_host``. Default: ``None`` (no limit).
+
+        :param idle_timeout:
+            Number of seconds (`int` or `float`) a released connection may sit
+            unused before it is closed & discarded. Default: ``None`` (idle
+            connections are kept until `close` is called or they are evicted.)
+        """
+        #: Per-key connection limit; see `__init__`.
+        self.max_per_host = max_per_host
+        #: Total connection limit; see `__init__`.
+        self.max_size = max_size
+        #: Idle connection lifetime, in seconds; see `__init__`.
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Condition()
+        # Released connections, least recently used first, as
+        # (released_at, key, connection) tuples.
+        self._idle = []
+        # Number of connections (leased + idle) per key.
+        self._counts = {}
+        # Keys of connections currently leased out, by id(), so we can tell
+        # which key to file a released connection under even if its
+        # attributes were mutated in the meantime.
+        self._leased = {}
+        self._closed = False
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a pool using the ``connection_pool`` settings of ``config``.
+
+        Missing settings (e.g. if ``config`` is a vanilla Invoke config
+        object) fall back to the defaults of `__init__`.
+        """
+        try:
+            settings = config.connection_pool
+        except AttributeError:
+            return cls()
+        return cls(
+            max_per_host=settings.get('max_per_host', None),
+            max_size=settings.get('max_size', None),
+            idle_timeout=settings.get('idle_timeout', None),
+        )
+
+    @staticmethod
+    def key(cxn):
+        """
+        Return the value used to decide whether two connections are
+        interchangeable.
+
+        This is ``cxn._identity()`` (host, user and port) extended with the
+        connection's gateway and ``connect_kwargs``.
+        """
+        return (cxn._identity(), cxn.gateway, _freeze(cxn.connect_kwargs))
+
+    def __len__(self):
+        with self._lock:
+            return sum(self._counts.values())
+
+    def acquire(self, host, timeout=None, **kwargs):
+        """
+        Obtain a `.Connection` to ``host``, reusing an idle one if possible.
+
+        :param str host:
+            Host string, as given to `.Connection`.
+
+        :param timeout:
+            Seconds to wait for a slot when the pool is at capacity; ``None``
+            (the default) waits forever.
+
+        :param kwargs:
+            Any other keyword arguments are passed to `.Connection` (``user``,
+            ``port``, ``config``, ``gateway``, etc.)
+
+        :returns: A `.Connection`, which must later be given to `release`.
+
+        :raises:
+            ``RuntimeError`` if the pool has been closed, or if ``timeout``
+            elapsed without a slot becoming available.
+        """
+        # NOTE: instantiating is cheap (no network activity) and is the only
+        # reliable way to learn the real key, post-ssh_config and shorthand
+        # handling.
+        candidate = Connection(host, **kwargs)
+        key = self.key(candidate)
+        deadline = None if timeout is None else time.time() + timeout
+        to_close = []
+        try:
+            with self._lock:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("Connection pool is closed!")
+                    to_close.extend(self._expire())
+                    cxn = self._take_idle(key)
+                    if cxn is not None:
+                        debug("Reusing pooled connection {0!r}".format(cxn))
+                        break
+                    if self._per_host_ok(key):
+                        if not self._size_ok():
+                            evicted = self._evict_lru()
+                            if evicted is not None:
+                                to_close.append(evicted)
+                        if self._size_ok():
+                            cxn = candidate
+                            self._counts[key] = self._counts.get(key, 0) + 1
+                            break
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            err = "Timed out waiting for a pooled connection to {0!r}" # noqa
+                            raise RuntimeError(err.format(candidate))
+                    self._lock.wait(remaining)
+                self._leased[id(cxn)] = key
+        finally:
+            # Actually closing connections is network IO; don't hold the lock
+            # for it.
+            for evicted in to_close:
+                self._close_connection(evicted)
+        return cxn
+
+    def release(self, cxn):
+        """
+        Return ``cxn`` (obtained via `acquire`) to the pool for reuse.
+
+        If the pool has been closed in the meantime, ``cxn`` is closed instead.
+
+        :raises: ``ValueError`` if ``cxn`` was not leased from this pool.
+        """
+        with self._lock:
+            try:
+                key = self._leased.pop(id(cxn))
+            except KeyError:
+                err = "{0!r} was not acquired from this pool!"
+                raise ValueError(err.format(cxn))
+            closed = self._closed
+            if closed:
+                self._forget(key)
+            else:
+                self._idle.append((time.time(), key, cxn))
+            self._lock.notify_all()
+        if closed:
+            self._close_connection(cxn)
+
+    @contextmanager
+    def connection(self, host, **kwargs):
+        """
+        Contextmanager wrapping `acquire` and `release`.
+
+        Takes the same arguments as `acquire` and yields its result.
+        """
+        cxn = self.acquire(host, **kwargs)
+        try:
+            yield cxn
+        finally:
+            self.release(cxn)
+
+    def prune(self):
+        """
+        Close & discard idle connections older than ``idle_timeout``.
+
+        This happens automatically during `acquire`; calling it manually is
+        only needed to free resources sooner.
+        """
+        with self._lock:
+            expired = self._expire()
+        for cxn in expired:
+            self._close_connection(cxn)
+
+    def close(self):
+        """
+        Close all idle connections and stop handing out new ones.
+
+        Connections currently leased out are closed when they are released.
+        """
+        with self._lock:
+            self._closed = True
+            idle = [cxn for _, _, cxn in self._idle]
+            for _, key, _ in self._idle:
+                self._forget(key)
+            self._idle = []
+            self._lock.notify_all()
+        for cxn in idle:
+            self._close_connection(cxn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # NOTE: the below all assume self._lock is held.
+
+    def _take_idle(self, key):
+        # Most recently used first; it's the one least likely to have been
+        # dropped by the remote end or an intermediate firewall.
+        for index in range(len(self._idle) - 1, -1, -1):
+            if self._idle[index][1] == key:
+                return self._idle.pop(index)[2]
+        return None
+
+    def _per_host_ok(self, key):
+        if self.max_per_host is None:
+            return True
+        return self._counts.get(key, 0) < self.max_per_host
+
+    def _size_ok(self):
+        if self.max_size is None:
+            return True
+        return sum(self._counts.values()) < self.max_size
+
+    def _evict_lru(self):
+        if not self._idle:
+            return None
+        _, key, cxn = self._idle.pop(0)
+        self._forget(key)
+        debug("Evicting least recently used connection {0!r}".format(cxn))
+        return cxn
+
+    def _expire(self):
+        if self.idle_timeout is None:
+            return []
+        cutoff = time.time() - self.idle_timeout
+        expired = [x for x in self._idle if x[0] < cutoff]
+        self._idle = [x for x in self._idle if x[0] >= cutoff]
+        for _, key, _ in expired:
+            self._forget(key)
+        if expired:
+            self._lock.notify_all()
+        return [cxn for _, _, cxn in expired]
+
+    def _forget(self, key):
+        self._counts[key] -= 1
+        if not self._counts[key]:
+            del self._counts[key]
+
+    def _close_connection(self, cxn):
+        # TODO: log/collect errors instead of swallowing them? A connection
+        # that blows up while closing is of no further use to anybody.
+        try:
+            cxn.close()
+        except Exception as e:
+            debug("Error closing pooled connection {0!r}: {1!r}".format(cxn, e)) # noqa
@@ -2,11 +2,23 @@
 File transfer via SFTP and/or SCP.
 """
 
+from contextlib import contextmanager
+import hashlib
+import mmap
 import os
 import posixpath
 import stat
+import struct
+import tarfile
+import threading
+import time
+import zlib
 
 from invoke.util import debug # TODO: actual logging! LOL
+from invoke.vendor.six import indexbytes, string_types
+from invoke.vendor.six.moves import shlex_quote
+from invoke.vendor.six.moves.queue import Queue, Empty
+from paramiko import SSHException
 
 # TODO: figure out best way to direct folks seeking rsync, to patchwork's rsync
 # call (which needs updating to use invoke.run() & fab 2 connection methods,
@@ -16,16 +28,790 @@ from invoke.util import debug # TODO: actual logging! LOL
 # course.
 
 
+def interpolate(path, connection):
+    """
+    Fill in ``{host}``, ``{user}`` and ``{port}`` placeholders within ``path``.
+
+    Values come from the respective attributes of ``connection``. Anything
+    other than a string (such as a file-like object) is returned untouched,
+    as are any other curly-braced sections of the string.
+    """
+    if not isinstance(path, string_types):
+        return path
+    for key in ('host', 'user', 'port'):
+        value = str(getattr(connection, key))
+        path = path.replace('{' + key + '}', value)
+    return path
+
+
+def _parallel(clients, func, items):
+    """
+    Call ``func(client, item)`` for each of ``items``, using one thread per
+    client in ``clients``.
+
+    :returns: A list of ``func``'s return values, in the order of ``items``.
+
+    :raises:
+        The first exception raised by ``func``; once that happens, no further
+        items are started, though ones in progress are allowed to finish.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    queue = Queue()
+    for pair in enumerate(items):
+        queue.put(pair)
+    errors = []
+
+    def work(client):
+        while not errors:
+            try:
+                index, item = queue.get(block=False)
+            except Empty:
+                return
+            try:
+                results[index] = func(client, item)
+            except Exception as e:
+                errors.append(e)
+    threads = [
+        threading.Thread(target=work, args=(client,))
+        for client in clients[:len(items)]
+    ]
+    # Don't bother with threads when there's only one client or item.
+    if len(threads) == 1:
+        work(clients[0])
+    else:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+class _ChannelWriter(object):
+    """
+    Minimal write-only file-like object sending data to a channel's stdin.
+
+    ``progress``, if given, is called with the byte count after every write.
+    """
+    def __init__(self, channel, progress=None):
+        self.channel = channel
+        self.progress = progress
+        #: Number of bytes sent so far.
+        self.count = 0
+
+    def write(self, data):
+        self.channel.sendall(data)
+        self.count += len(data)
+        if self.progress is not None:
+            self.progress(self.count, None)
+
+    def flush(self):
+        pass
+
+
+class _ChannelReader(object):
+    """
+    Minimal read-only file-like object reading a channel's stdout.
+
+    ``progress``, if given, is called with the byte count after every read.
+    """
+    def __init__(self, channel, progress=None):
+        self.channel = channel
+        self.progress = progress
+        #: Number of bytes received so far.
+        self.count = 0
+
+    def read(self, size=-1):
+        chunks = []
+        received = 0
+        while size < 0 or received < size:
+            wanted = 32768 if size < 0 else min(32768, size - received)
+            data = self.channel.recv(wanted)
+            if not data:
+                break
+            chunks.append(data)
+            received += len(data)
+        self.count += received
+        if received and self.progress is not None:
+            self.progress(self.count, None)
+        return b''.join(chunks)
+
+
+def _shell(argv):
+    """
+    Quote & join ``argv`` into a shell command line.
+    """
+    return " ".join(shlex_quote(x) for x in argv)
+
+
+def _python(script, *args):
+    """
+    Shell command line running Python ``script`` (with ``args``) remotely.
+
+    Whichever of ``python3`` or ``python`` is found first is used; the script
+    must therefore run under both Python 2 and 3.
+    """
+    find = 'PY=$(command -v python3 || command -v python) || { echo "No Python interpreter found" >&2; exit 127; }' # noqa
+    return '{0}; exec "$PY" -c {1}'.format(
+        find, _shell((script,) + tuple(str(x) for x in args)),
+    )
+
+
+#: Remote half of delta uploads, step one: print the checksums (weak & strong)
+#: of each block of an existing file, or ``missing``.
+delta_signature_script = """
+import errno, hashlib, sys, zlib
+path, size = sys.argv[1], int(sys.argv[2])
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+try:
+    fd = open(path, 'rb')
+except (IOError, OSError) as e:
+    if e.errno != errno.ENOENT:
+        raise
+    out.write(b'missing\\n')
+    sys.exit(0)
+while True:
+    block = fd.read(size)
+    if not block:
+        break
+    weak = zlib.adler32(block) & 0xffffffff
+    line = '%d %s\\n' % (weak, hashlib.md5(block).hexdigest())
+    out.write(line.encode('ascii'))
+"""
+
+#: Remote half of delta uploads, step two: rebuild a file from its old copy
+#: plus instructions read on stdin, into a temporary file which is renamed
+#: over the original once its checksum is confirmed.
+delta_patch_script = """
+import hashlib, os, struct, sys, tempfile
+path, size, mode = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+read = getattr(sys.stdin, 'buffer', sys.stdin).read
+def exactly(count):
+    chunks = []
+    while count:
+        chunk = read(count)
+        if not chunk:
+            sys.exit('Truncated delta instruction stream')
+        chunks.append(chunk)
+        count -= len(chunk)
+    return b''.join(chunks)
+old = open(path, 'rb')
+fd, temp = tempfile.mkstemp(
+    dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.',
+)
+new = os.fdopen(fd, 'wb')
+digest = hashlib.md5()
+try:
+    while True:
+        op = exactly(1)
+        if op == b'C':
+            index, count = struct.unpack('>QQ', exactly(16))
+            old.seek(index * size)
+            remaining = count * size
+            while remaining:
+                data = old.read(min(remaining, 1048576))
+                if not data:
+                    break
+                digest.update(data)
+                new.write(data)
+                remaining -= len(data)
+        elif op == b'L':
+            data = exactly(struct.unpack('>Q', exactly(8))[0])
+            digest.update(data)
+            new.write(data)
+        else:
+            break
+    if digest.hexdigest().encode('ascii') != exactly(32):
+        sys.exit('Checksum mismatch after applying delta')
+    new.close()
+    if mode == '-':
+        mode = os.stat(path).st_mode & 4095
+    else:
+        mode = int(mode, 8)
+    os.chmod(temp, mode)
+    os.rename(temp, path)
+except BaseException:
+    new.close()
+    os.remove(temp)
+    raise
+"""
+
+
+#: Remote path canonicalization: print the real path (symlinks and ``..``
+#: resolved) of each NUL-separated path read on stdin, NUL-terminated.
+realpath_script = """
+import os, sys
+paths = getattr(sys.stdin, 'buffer', sys.stdin).read().split(b'\\0')
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+for path in paths:
+    out.write(os.path.realpath(path) + b'\\0')
+"""
+
+#: Remote file hashing: print the SHA-256 hex digest of each NUL-separated
+#: path read on stdin, one per line (``-`` if unreadable), hashing at most the
+#: number of bytes given as an argument, if any.
+digest_script = """
+import hashlib, sys
+paths = getattr(sys.stdin, 'buffer', sys.stdin).read().split(b'\\0')
+limit = int(sys.argv[1]) if len(sys.argv) > 1 else None
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+for path in paths:
+    digest = hashlib.sha256()
+    try:
+        fd = open(path, 'rb')
+    except (IOError, OSError):
+        out.write(b'-\\n')
+        continue
+    remaining = limit
+    while remaining is None or remaining > 0:
+        chunk = fd.read(1048576 if limit is None else min(remaining, 1048576))
+        if not chunk:
+            break
+        digest.update(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+    fd.close()
+    out.write(digest.hexdigest().encode('ascii') + b'\\n')
+"""
+
+
+#: Receiving half of `relay`: write stdin to a temporary file, renamed into
+#: place once its SHA-256 digest is confirmed; prints the number of bytes
+#: received.
+relay_receive_script = """
+import hashlib, os, sys
+path, expected, mode = sys.argv[1:4]
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+partial = path + '.part'
+digest = hashlib.sha256()
+size = 0
+fd = open(partial, 'wb')
+while True:
+    chunk = stdin.read(1048576)
+    if not chunk:
+        break
+    digest.update(chunk)
+    fd.write(chunk)
+    size += len(chunk)
+fd.close()
+if digest.hexdigest() != expected:
+    os.remove(partial)
+    sys.exit('Checksum mismatch after relaying')
+if mode != '-':
+    os.chmod(partial, int(mode, 8))
+os.rename(partial, path)
+sys.stdout.write('%d\\n' % size)
+"""
+
+
+def relay(source, targets, remote, digest, mode=None, timeout=60):
+    """
+    Copy file ``remote`` from ``source`` to the same path on ``targets``.
+
+    Data flows directly from host to host, over SSH: for each target,
+    ``source`` runs ``ssh`` (non-interactively, i.e. in ``BatchMode``) to the
+    target's ``host``, ``port`` and ``user``, feeding ``remote`` to a script
+    (run there by ``python3`` or ``python``) which writes it into place. Only
+    commands and their output pass through the local machine.
+
+    So ``source`` must be able to reach targets by their ``host`` values,
+    and to authenticate to them without prompting: e.g. with its own keys,
+    or with the local SSH agent, if ``source`` has ``forward_agent``
+    enabled. Host keys are checked as per ``source``'s own SSH
+    configuration.
+
+    :param source: The `.Connection` to a host holding ``remote``.
+    :param targets: `.Connection` objects to hosts to copy ``remote`` to.
+    :param str remote: Absolute path of the file, on all hosts.
+
+    :param str digest:
+        The file's SHA-256 hex digest, which targets check before renaming
+        their (temporary) copy into place.
+
+    :param int mode:
+        Mode to ``chmod`` copies to; if ``None``, they keep the targets'
+        default (umask-based) mode.
+
+    :param int timeout:
+        Seconds ``source`` waits to connect to each target (``ssh``'s
+        ``ConnectTimeout``); ``None`` leaves it up to ``ssh``.
+
+    :returns:
+        A list holding, per target, either the number of bytes it received,
+        or the exception which prevented it from doing so.
+    """
+    results = [None] * len(targets)
+    receive = _python(
+        relay_receive_script, remote, digest,
+        '-' if mode is None else "{0:o}".format(mode),
+    )
+    options = ['-o', 'BatchMode=yes']
+    if timeout is not None:
+        options += ['-o', 'ConnectTimeout={0}'.format(int(timeout))]
+
+    def send(index, target):
+        ssh = ['ssh'] + options + [
+            '-p', str(target.port), '-l', target.user, target.host, receive,
+        ]
+        command = "{0} < {1}".format(_shell(ssh), shlex_quote(remote))
+        try:
+            with Transfer(source)._exec(
+                command, label="relay to {0}".format(target.host),
+            ) as channel:
+                output = _ChannelReader(channel).read()
+            results[index] = int(output)
+        except Exception as e:
+            results[index] = e
+
+    debug("Relaying {0!r} from {1} to {2}".format(
+        remote, source.host, ", ".join(x.host for x in targets),
+    ))
+    threads = [
+        threading.Thread(target=send, args=x) for x in enumerate(targets)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _digest(path, limit=None):
+    """
+    Return the SHA-256 hex digest of local file ``path``.
+
+    Only the first ``limit`` bytes are hashed, if ``limit`` is given.
+    """
+    digest = hashlib.sha256()
+    remaining = limit
+    with open(path, 'rb') as fd:
+        while remaining is None or remaining > 0:
+            size = 1048576 if limit is None else min(remaining, 1048576)
+            chunk = fd.read(size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def _stat(sftp, path):
+    """
+    Return ``sftp.stat(path)``, or ``None`` if that fails (e.g. if missing.)
+    """
+    try:
+        return sftp.stat(path)
+    except IOError:
+        return None
+
+
+def _requests(clients):
+    """
+    Total number of requests made so far by SFTP ``clients``, or ``None`` if
+    that's unknown.
+    """
+    numbers = [getattr(x, 'request_number', None) for x in clients]
+    if not all(isinstance(x, int) for x in numbers):
+        return None
+    return sum(numbers)
+
+
+def _since(before, clients, extra=0):
+    """
+    Number of requests ``clients`` made since `_requests` returned
+    ``before``, plus ``extra``, or ``None`` if any of those is unknown.
+    """
+    after = _requests(clients)
+    if None in (before, after, extra):
+        return None
+    return after - before + extra
+
+
+class _Progress(object):
+    """
+    Combine progress reports of concurrent per-file transfers into one.
+    """
+    def __init__(self, callback, total):
+        self.callback = callback
+        self.total = total
+        self.transferred = 0
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def file(self, key):
+        """
+        Return a callback reporting progress of the file known as ``key``.
+        """
+        def update(transferred, total):
+            with self.lock:
+                self.transferred += transferred - self.files.get(key, 0)
+                self.files[key] = transferred
+                overall = self.transferred
+            self.callback(overall, self.total)
+        return update
+
+
+def _delta(data, signature, block_size, literal_size=1048576):
+    """
+    Yield instructions rebuilding ``data`` from a file with ``signature``.
+
+    This is the rsync algorithm: a (rolling, Adler-32) checksum of each
+    ``block_size`` window of ``data`` is looked up among the weak checksums in
+    ``signature`` (a list of ``(weak, strong)`` tuples, one per block of the
+    old file), confirming candidates by their MD5 hex digest. Matches become
+    copies of old blocks; anything else becomes literal data.
+
+    Unchanged stretches cost one C-level checksum per block; only changed
+    ones are rolled through byte by byte.
+
+    :param data:
+        A bytes-like object supporting slicing (e.g. `bytes` or an `mmap`).
+
+    :returns:
+        A generator of ``('C', (index, count))`` (copy ``count`` old blocks
+        starting at block ``index``) and ``('L', bytes)`` (literal data)
+        tuples.
+    """
+    table = {}
+    for index, (weak, strong) in enumerate(signature):
+        table.setdefault(weak, []).append((index, strong))
+    length = len(data)
+    pos = literal = 0
+    weak = None
+    copy = None
+    while pos < length:
+        end = min(pos + block_size, length)
+        if weak is None:
+            weak = zlib.adler32(data[pos:end]) & 0xffffffff
+        match = None
+        if weak in table:
+            strong = hashlib.md5(data[pos:end]).hexdigest()
+            for index, candidate in table[weak]:
+                if candidate == strong:
+                    match = index
+                    break
+        if match is not None:
+            if literal < pos:
+                if copy is not None:
+                    yield 'C', copy
+                    copy = None
+                yield 'L', data[literal:pos]
+            if copy is not None and copy[0] + copy[1] == match:
+                copy = (copy[0], copy[1] + 1)
+            else:
+                if copy is not None:
+                    yield 'C', copy
+                copy = (match, 1)
+            pos = literal = end
+            weak = None
+            continue
+        # Windows only shrink past this point, so nothing more can match.
+        if end == length:
+            break
+        if copy is not None:
+            yield 'C', copy
+            copy = None
+        # Roll the window forwards a byte.
+        old, new = indexbytes(data, pos), indexbytes(data, end)
+        a = ((weak & 0xffff) - old + new) % 65521
+        b = ((weak >> 16) - block_size * old + a - 1) % 65521
+        weak = (b << 16) | a
+        pos += 1
+        if pos - literal >= literal_size:
+            yield 'L', data[literal:pos]
+            literal = pos
+    if copy is not None:
+        yield 'C', copy
+    if literal < length:
+        yield 'L', data[literal:length]
+
+
+def _chunks(fd, block_size, memory_map=False):
+    """
+    Yield ``fd``'s contents (from its current position) in non-empty chunks
+    of up to ``block_size`` bytes.
+
+    Text is encoded as UTF-8. With ``memory_map``, ``fd`` (which must then be
+    a regular file) is memory-mapped instead of read, and chunks (bar the
+    last, a copy) are `memoryview` slices of the mapping, so no per-chunk
+    buffers are allocated or filled; the OS pages data in as it's sent.
+    """
+    if not memory_map:
+        while True:
+            data = fd.read(block_size)
+            if not data:
+                return
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            yield data
+    size = os.fstat(fd.fileno()).st_size
+    # NOTE: mmap refuses empty files.
+    if not size:
+        return
+    mapping = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    view = None
+    try:
+        try:
+            view = memoryview(mapping)
+        except TypeError:
+            # Python 2's mmap only offers the old buffer interface.
+            view = mapping
+        for offset in range(fd.tell(), size, block_size):
+            end = offset + block_size
+            if end < size:
+                yield view[offset:end]
+            else:
+                # A copy, so the caller's hold on the last chunk doesn't
+                # keep the mapping open once iteration ends.
+                yield bytes(view[offset:end])
+    finally:
+        # Our own view pins the mapping too; the chunks sliced from it only
+        # do so while they're referenced.
+        if isinstance(view, memoryview):
+            view.release()
+        try:
+            mapping.close()
+        except BufferError:
+            # A chunk is still referenced (e.g. by an error being raised);
+            # the mapping is then closed when that goes away.
+            pass
+
+
+def _scp_response(channel, line=False):
+    """
+    Read an scp acknowledgement (or, if ``line`` is ``True``, a line) from
+    ``channel``.
+
+    :returns: The line read (without its newline), if ``line`` is ``True``.
+
+    :raises:
+        ``IOError``, with the remote message, if scp reported a problem.
+    """
+    first = channel.recv(1)
+    if not first:
+        raise IOError("scp closed the connection unexpectedly!")
+    if first == b'\0' and not line:
+        return None
+    data = first
+    while not data.endswith(b'\n'):
+        byte = channel.recv(1)
+        if not byte:
+            break
+        data += byte
+    if first in (b'\1', b'\2'):
+        raise IOError(data[1:].decode('utf-8', 'replace').strip())
+    return data.rstrip(b'\n')
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("compress='zstd' requires the 'zstandard' package!")
+    return zstandard
+
+
+#: Supported values for the ``compress`` argument of tar-based transfers,
+#: mapped to the matching remote ``tar`` flag.
+tar_compression = {
+    None: [],
+    'gzip': ['-z'],
+    'zstd': ['--zstd'],
+}
+
+
+#: Remote half of ``'zlib'`` compressed transfers: (de)compress stdin onto
+#: stdout, needing nothing beyond Python's standard library.
+zlib_script = """
+import sys, zlib
+read = getattr(sys.stdin, 'buffer', sys.stdin).read
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+if sys.argv[1] == 'c':
+    codec = zlib.compressobj(6)
+    convert = codec.compress
+else:
+    codec = zlib.decompressobj()
+    convert = codec.decompress
+while True:
+    data = read(65536)
+    if not data:
+        break
+    out.write(convert(data))
+out.write(codec.flush())
+"""
+
+#: Supported values for the ``compress`` argument of single-file transfers,
+#: mapped to the remote commands compressing and decompressing them (``None``
+#: meaning `zlib_script`.)
+stream_compression = {
+    'gzip': (['gzip', '-c'], ['gzip', '-d', '-c']),
+    'zstd': (['zstd', '-q', '-c'], ['zstd', '-q', '-d', '-c']),
+    'lz4': (['lz4', '-q', '-c'], ['lz4', '-q', '-d', '-c']),
+    'zlib': None,
+}
+
+
+class _LZ4Compressor(object):
+    """
+    ``compressobj``-alike wrapper around ``lz4.frame.LZ4FrameCompressor``.
+    """
+    def __init__(self, frame):
+        self.compressor = frame.LZ4FrameCompressor()
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        header, self.header = self.header, b''
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        return self.compress(b'') + self.compressor.flush()
+
+
+def _lz4_frame():
+    try:
+        import lz4.frame
+    except ImportError:
+        raise ValueError("compress='lz4' requires the 'lz4' package!")
+    return lz4.frame
+
+
+def _codec(compress):
+    """
+    Validate single-file ``compress`` value, returning its canonical name.
+    """
+    if compress is True:
+        compress = 'gzip'
+    if compress not in stream_compression:
+        err = "Unknown compression {0!r}; expected one of {1}"
+        raise ValueError(err.format(compress, sorted(stream_compression)))
+    return compress
+
+
+def _compressor(codec):
+    """
+    Return a local ``compressobj``-alike for ``codec``.
+    """
+    if codec == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if codec == 'zstd':
+        return _zstandard().ZstdCompressor().compressobj()
+    if codec == 'lz4':
+        return _LZ4Compressor(_lz4_frame())
+    return zlib.compressobj(6)
+
+
+def _decompressor(codec):
+    """
+    Return a local ``decompressobj``-alike for ``codec``.
+    """
+    if codec == 'gzip':
+        return zlib.decompressobj(31)
+    if codec == 'zstd':
+        return _zstandard().ZstdDecompressor().decompressobj()
+    if codec == 'lz4':
+        return _lz4_frame().LZ4FrameDecompressor()
+    return zlib.decompressobj()
+
+
+def _remote_codec(codec, decompress=False):
+    """
+    Shell command line (de)compressing stdin onto stdout remotely.
+    """
+    commands = stream_compression[codec]
+    if commands is None:
+        return _python(zlib_script, 'd' if decompress else 'c')
+    return _shell(commands[1 if decompress else 0])
+
+
+def _tar_codec(compress):
+    """
+    Validate tar ``compress`` value, returning its canonical name.
+    """
+    if compress is True:
+        compress = 'gzip'
+    if compress not in tar_compression:
+        err = "Unknown tar compression {0!r}; expected one of {1}"
+        raise ValueError(err.format(
+            compress, sorted(x for x in tar_compression if x),
+        ))
+    return compress
+
+
+def _remote_mkdir(sftp, path):
+    try:
+        sftp.mkdir(path)
+    except IOError:
+        # Most likely it already exists; if not, stat() will say why.
+        if not stat.S_ISDIR(sftp.stat(path).st_mode):
+            raise
+
+
 class Transfer(object):
     """
     `.Connection`-wrapping class responsible for managing file upload/download.
     """
     # TODO: SFTP clear default, but how to do SCP? subclass? init kwarg?
 
-    def __init__(self, connection):
+    def __init__(self, connection, sftp=None):
+        """
+        :param connection: The `.Connection` to transfer files over.
+
+        :param sftp:
+            A `~paramiko.sftp_client.SFTPClient` to use, instead of the
+            connection's own (see `.Connection.sftp`). Used to spread
+            recursive transfers across multiple SFTP channels.
+        """
         self.connection = connection
+        self._sftp = sftp
+        # Whether get/put is running, and the SFTP client it leased from the
+        # connection's SFTPPool, if any (only done once SFTP is needed.)
+        self._leasing = False
+        self._leased = None
+
+    def sftp(self):
+        """
+        Return the `~paramiko.sftp_client.SFTPClient` used for transfers.
 
-    def get(self, remote, local=None, preserve_mode=True):
+        During `get` and `put`, that's a channel leased from the connection's
+        `.SFTPPool`; otherwise, the connection's own (see `.Connection.sftp`).
+        """
+        if self._sftp is not None:
+            return self._sftp
+        if not self._leasing:
+            return self.connection.sftp()
+        if self._leased is None:
+            self._leased = self.connection.sftp_pool.acquire()
+        return self._leased
+
+    def _release(self, broken):
+        """
+        Hand the SFTP client leased by `sftp`, if any, back to the pool.
+        """
+        self._leasing = False
+        if self._leased is None:
+            return
+        client, self._leased = self._leased, None
+        self.connection.sftp_pool.release(client, broken=broken)
+
+    def get(
+        self,
+        remote,
+        local=None,
+        preserve_mode=True,
+        window=None,
+        block_size=None,
+        recursive=False,
+        workers=None,
+        protocol=None,
+        compress=None,
+        skip_unchanged=False,
+        resume=False,
+        progress=None,
+        retries=None,
+    ):
         """
         Download a file from the current connection to the local filesystem.
 
@@ -46,6 +832,12 @@ class Transfer(object):
             or file and is subject to similar behavior as that seen by common
             Unix utilities or OpenSSH's ``sftp`` or ``scp`` tools.
 
+            Any ``{host}``, ``{user}`` or ``{port}`` placeholders within the
+            string are replaced with the connection's respective attributes
+            (see `interpolate`); if this happens, the resulting file's parent
+            directory is created if necessary. This is mostly useful when
+            downloading the same file from many hosts, e.g. via `.Group.get`.
+
             For example, if the local path is a directory, the remote path's
             base filename will be added onto it (so ``get('foo/bar/file.txt',
             '/tmp/')`` would result in creation or overwriting of
@@ -64,36 +856,276 @@ class Transfer(object):
             Whether to `os.chmod` the local file so it matches the remote
             file's mode (default: ``True``).
 
-        :returns: A `.Result` object.
+        :param int window:
+            When given, the download is pipelined: the remote file is opened
+            and ``stat``'d once (which yields both its size and, for
+            ``preserve_mode``, its mode) and then read using up to ``window``
+            outstanding read requests at a time, writing each block to
+            ``local`` as it arrives.
+
+            This keeps high-latency links busy while bounding memory use to
+            roughly ``window * block_size`` bytes. (By default Paramiko queues
+            read requests for the *entire* file up front, after a ``stat`` of
+            its own.)
+
+            Default: the ``transfer.window`` config setting (``None``, meaning
+            the default Paramiko behavior.)
+
+        :param int block_size:
+            Bytes per read request when ``window`` is in effect. Paramiko
+            splits requests larger than 32 KiB into several, each of which
+            counts toward its own outstanding request total. Default: the
+            ``transfer.block_size`` config setting (``32768``.)
+
+        :param bool recursive:
+            When ``True``, ``remote`` must be a directory, which is downloaded
+            along with everything inside it (regular files and directories;
+            anything else, such as symlinks, is skipped) to ``local``, which
+            names the resulting local copy of ``remote`` itself, and is
+            created if necessary. Modes are preserved as per
+            ``preserve_mode``, without any extra ``stat`` calls. Default:
+            ``False``.
+
+        :param int workers:
+            Number of SFTP channels (each served by its own thread) used to
+            list directories and transfer files during recursive downloads.
+            Channels share the connection's single SSH transport, and are
+            leased from its `.SFTPPool`, so at most ``transfer.channels`` are
+            used. Default: the ``transfer.workers`` config setting (``4``.)
+
+        :param str protocol:
+            How data is moved. One of:
+
+            - ``'sftp'``, as described above.
+            - ``'scp'``, which drives ``scp -f`` on the remote end over an
+              exec channel instead, for servers lacking an SFTP subsystem (or
+              links where SCP's streaming beats SFTP's request/response
+              cycle.) Relative ``remote`` paths are then left for the remote
+              end to resolve. Recursive transfers are not supported, nor are
+              ``window``, ``skip_unchanged``, ``resume`` or ``retries`` (all
+              of which raise ``ValueError``); the ``transfer.retries`` config
+              setting doesn't apply either.
+            - ``'tar'``, for recursive transfers, which runs ``tar -c`` on the
+              remote end over a single exec channel and extracts its output
+              into ``local`` as it streams in. This avoids per-file round
+              trips entirely, so is much faster for trees of many small
+              files, but requires ``tar`` on the remote end. Unsafe archive
+              members (device files, and anything which would land or, for
+              links, point outside ``local``) are skipped. ``window``,
+              ``skip_unchanged``, ``resume`` and ``retries`` are not
+              supported (raising ``ValueError``), nor does the
+              ``transfer.retries`` config setting apply. Non-recursive
+              transfers use SFTP.
+
+            Default: the ``transfer.protocol`` config setting (``'sftp'``.)
+
+        :param str compress:
+            Compress data in transit. For recursive ``'tar'`` protocol
+            transfers, the tar stream is compressed with ``'gzip'`` or
+            ``'zstd'``; the latter requires the ``zstandard`` Python package
+            locally and a ``tar`` supporting ``--zstd`` remotely.
+
+            Any other (single-file) transfer then bypasses SFTP and SCP:
+            ``remote`` is read by a remote command compressing it on the fly,
+            and decompressed locally as it arrives. Supported codecs are
+            ``'gzip'`` (``True`` is an alias for it), ``'zstd'`` and
+            ``'lz4'`` -- needing the matching command remotely, and for the
+            last two the ``zstandard`` or ``lz4`` Python package locally --
+            plus ``'zlib'``, which only needs ``python3`` or ``python``
+            remotely. ``preserve_mode`` costs an SFTP ``stat``. The ``'scp'``
+            protocol, ``window``, ``skip_unchanged``, ``resume`` and
+            ``retries`` are not supported (raising ``ValueError``); the
+            ``transfer.retries`` config setting doesn't apply either.
+            `.Result.compressed` records the bytes actually received.
+            Default: ``None``.
+
+        :param skip_unchanged:
+            When set, files which already exist at the destination and appear
+            identical to the source are not transferred: ``'mtime'`` (or
+            ``True``) compares their sizes and modification times, while
+            ``'hash'`` compares their sizes and SHA-256 digests (computed
+            remotely by ``python3`` or ``python``.) Transferred files then get
+            the source's modification time, so that later ``'mtime'``
+            comparisons work. For recursive transfers, remote sizes & times
+            come from directory listings, and all remote digests are computed
+            by a single command. Requires ``local`` to be a path. Default:
+            ``False``.
+
+        :param bool resume:
+            When ``True``, download into ``<local>.part`` (which is renamed to
+            ``local`` once complete), and if that file already exists -- e.g.
+            after an interrupted download -- continue from its end, provided
+            its contents match the start of ``remote`` (as compared by
+            SHA-256 digest, computed remotely by ``python3`` or ``python``.)
+            Data is read in batches of ``block_size``-byte requests, each
+            batch (``transfer.checkpoint_size`` bytes, by default 8 MiB)
+            flushed to disk before the next one begins. Requires ``local`` to
+            be a path. Default: ``False``.
+
+        :param progress:
+            A callable invoked as data arrives, with the number of bytes
+            transferred so far and the total expected (``None`` if unknown,
+            e.g. for compressed or ``'tar'`` streams), like Paramiko's own
+            ``callback`` arguments. Recursive transfers report the sum over
+            all their files (from several threads.) Default: ``None``.
+
+        :param int retries:
+            How many times to start over when the connection fails mid
+            transfer -- i.e. Paramiko raises ``SSHException`` or ``EOFError``,
+            or the SFTP channel closes -- each time on a fresh SFTP session.
+            Combine with ``resume`` to keep the data already transferred.
+            Downloads into file-like objects are never retried. Default: the
+            ``transfer.retries`` config setting (``0``.)
+
+        :returns:
+            A `.Result` object, recording the transfer's `.Result.elapsed`
+            time, `.Result.round_trips` and `.Result.retries`. Pipelined
+            downloads also record the number of bytes transferred, making
+            `.Result.throughput` available.
+            Recursive downloads record their total size, and a `.Result` per
+            file in `.Result.files` (SFTP), or the number of bytes streamed
+            (tar). Files left alone due to ``skip_unchanged`` have a
+            `.Result.skipped` of ``True`` (and a `.Result.size` of ``0``.)
+            Resumable downloads record their `.Result.checkpoints`, and
+            compressed ones their `.Result.compressed` size.
         """
+        protocol = self._protocol(protocol)
+        if compress is not None and not (recursive and protocol == 'tar'):
+            if protocol == 'scp':
+                raise ValueError("The scp protocol does not support compress!")
+            self._unsupported(
+                "Compressed transfers",
+                window=window,
+                skip_unchanged=skip_unchanged,
+                resume=resume,
+                retries=retries,
+            )
+            # Nor does the transfer.retries config setting apply.
+            retries = 0
+        elif protocol == 'scp':
+            self._unsupported(
+                "The scp protocol",
+                window=window,
+                skip_unchanged=skip_unchanged,
+                resume=resume,
+                retries=retries,
+            )
+            # Nor does the transfer.retries config setting apply.
+            retries = 0
+        elif recursive and protocol == 'tar':
+            self._unsupported(
+                "The tar protocol",
+                window=window,
+                skip_unchanged=skip_unchanged,
+                resume=resume,
+                retries=retries,
+            )
+            retries = 0
+        return self._retry(
+            lambda: self._get(
+                remote, local, preserve_mode, window, block_size, recursive,
+                workers, protocol, compress, skip_unchanged, resume, progress,
+            ),
+            retries=retries,
+            # Data already written into a file-like object can't be unwritten.
+            rewindable=not hasattr(local, 'write'),
+        )
+
+    def _get(
+        self, remote, local, preserve_mode, window, block_size, recursive,
+        workers, protocol, compress, skip_unchanged, resume, progress,
+    ):
         # TODO: how does this API change if we want to implement
         # remote-to-remote file transfer? (Is that even realistic?)
-        # TODO: handle v1's string interpolation bits, especially the default
-        # one, or at least think about how that would work re: split between
-        # single and multiple server targets.
-        # TODO: callback support
         # TODO: how best to allow changing the behavior/semantics of
         # remote/local (e.g. users might want 'safer' behavior that complains
         # instead of overwriting existing files) - this likely ties into the
         # "how to handle recursive/rsync" and "how to handle scp" questions
 
-        sftp = self.connection.sftp()
-
-        # Massage remote path
         if not remote:
             raise ValueError("Remote path must not be empty!")
+        protocol = self._protocol(protocol)
+        if recursive and protocol == 'tar':
+            if hasattr(local, 'write'):
+                raise ValueError("Cannot download a directory into a file-like object!") # noqa
+            orig_local = local
+            local = interpolate(local, self.connection)
+            if not local:
+                local = posixpath.basename(posixpath.normpath(remote))
+            local = os.path.abspath(local)
+            start = time.time()
+            size = self._get_tar(
+                remote, local, preserve_mode, compress, progress,
+            )
+            return Result(
+                orig_remote=remote,
+                remote=remote,
+                orig_local=orig_local,
+                local=local,
+                connection=self.connection,
+                size=size,
+                elapsed=time.time() - start,
+            )
+        if compress is not None:
+            if recursive:
+                raise ValueError(
+                    "Recursive transfers may only be compressed by the tar"
+                    " protocol!"
+                )
+            codec = _codec(compress)
+            orig_local = local
+            is_file_like = hasattr(local, 'write') and callable(local.write)
+            local = self._massage_local(local, remote, is_file_like)
+            start = time.time()
+            size, compressed = self._compressed_get(
+                remote, local, is_file_like, preserve_mode, codec, progress,
+            )
+            return Result(
+                orig_remote=remote,
+                remote=remote,
+                orig_local=orig_local,
+                local=local,
+                connection=self.connection,
+                size=size,
+                elapsed=time.time() - start,
+                compressed=compressed,
+            )
+        if protocol == 'scp':
+            if recursive:
+                raise ValueError(
+                    "The scp protocol does not support recursive transfers!"
+                )
+            orig_local = local
+            is_file_like = hasattr(local, 'write') and callable(local.write)
+            local = self._massage_local(local, remote, is_file_like)
+            start = time.time()
+            size = self._scp_get(
+                remote, local, is_file_like, preserve_mode, progress,
+            )
+            return Result(
+                orig_remote=remote,
+                remote=remote,
+                orig_local=orig_local,
+                local=local,
+                connection=self.connection,
+                size=size,
+                elapsed=time.time() - start,
+            )
+
+        sftp = self.sftp()
+        requests = _requests([sftp])
+
+        # Massage remote path
         orig_remote = remote
-        remote = posixpath.join(sftp.getcwd() or sftp.normalize('.'), remote)
+        remote = self._absolute(sftp, remote)
+        if recursive:
+            # E.g. for when trailing slashes are given.
+            remote = posixpath.normpath(remote)
 
-        # Massage local path:
-        # - handle file-ness
-        # - if path, fill with remote name if empty, & make absolute
+        # Massage local path
         orig_local = local
         is_file_like = hasattr(local, 'write') and callable(local.write)
-        if not local:
-            local = posixpath.basename(remote)
-        if not is_file_like:
-            local = os.path.abspath(local)
+        local = self._massage_local(local, remote, is_file_like)
 
         # Run Paramiko-level .get() (side-effects only. womp.)
         # TODO: push some of the path handling into Paramiko; it should be
@@ -101,18 +1133,83 @@ class Transfer(object):
         # TODO: probably preserve warning message from v1 when overwriting
         # existing files. Use logging for that obviously.
         #
-        # If local appears to be a file-like object, use sftp.getfo, not get
-        if is_file_like:
-            sftp.getfo(remotepath=remote, fl=local)
+        # If pipelining, we handle reading & writing ourselves; otherwise, if
+        # local appears to be a file-like object, use sftp.getfo, not get
+        window, block_size = self._pipelining(window, block_size)
+        skip = self._skip_mode(skip_unchanged, is_file_like)
+        if resume and is_file_like:
+            raise ValueError("resume requires a local file path, not a file-like object!") # noqa
+        size = files = attrs = checkpoints = None
+        extra = 0
+        # Paramiko's own callbacks go unused unless wanted.
+        callback = {'callback': progress} if progress else {}
+        start = time.time()
+        if skip and not recursive:
+            attrs = _stat(sftp, remote)
+            if local in self._unchanged(skip, [(local, remote, attrs)]):
+                debug("Skipping unchanged {0!r}".format(remote))
+                return Result(
+                    orig_remote=orig_remote,
+                    remote=remote,
+                    orig_local=orig_local,
+                    local=local,
+                    connection=self.connection,
+                    size=0,
+                    elapsed=time.time() - start,
+                    skipped=True,
+                    round_trips=_since(requests, [sftp]),
+                )
+        if recursive:
+            if is_file_like:
+                raise ValueError("Cannot download a directory into a file-like object!") # noqa
+            files, extra = self._get_tree(
+                sftp=sftp,
+                remote=remote,
+                local=local,
+                preserve_mode=preserve_mode,
+                workers=self._workers(workers),
+                skip=skip,
+                progress=progress,
+                window=window,
+                block_size=block_size,
+                resume=resume,
+            )
+            size = sum(x.size for x in files)
+        elif resume:
+            size, checkpoints = self._resumable_get(
+                sftp=sftp,
+                remote=remote,
+                local=local,
+                preserve_mode=preserve_mode,
+                block_size=block_size,
+                progress=progress,
+            )
+        elif window is not None:
+            size = self._pipelined_get(
+                sftp=sftp,
+                remote=remote,
+                local=local,
+                is_file_like=is_file_like,
+                preserve_mode=preserve_mode,
+                window=window,
+                block_size=block_size,
+                progress=progress,
+            )
+        elif is_file_like:
+            sftp.getfo(remotepath=remote, fl=local, **callback)
         else:
-            sftp.get(remotepath=remote, localpath=local)
+            sftp.get(remotepath=remote, localpath=local, **callback)
             # Set mode to same as remote end
             # TODO: Push this down into SFTPClient sometime (requires backwards
             # incompat release.)
             if preserve_mode:
-                remote_mode = sftp.stat(remote).st_mode
-                mode = stat.S_IMODE(remote_mode)
-                os.chmod(local, mode)
+                remote_stat = sftp.stat(remote)
+                os.chmod(local, stat.S_IMODE(remote_stat.st_mode))
+                size = remote_stat.st_size
+        if attrs is not None:
+            os.utime(local, (attrs.st_atime, attrs.st_mtime))
+        # NOTE: extra counts the requests of any extra channels opened.
+        round_trips = _since(requests, [sftp], extra)
         # Return something useful
         return Result(
             orig_remote=orig_remote,
@@ -120,9 +1217,1070 @@ class Transfer(object):
             orig_local=orig_local,
             local=local,
             connection=self.connection,
+            size=size,
+            elapsed=time.time() - start,
+            files=files,
+            checkpoints=checkpoints,
+            round_trips=round_trips,
+        )
+
+    def _massage_local(self, local, remote, is_file_like):
+        """
+        Massage download destination ``local``.
+
+        Placeholders are interpolated, an empty value is filled with
+        ``remote``'s name, and paths are made absolute (creating parent
+        directories if that path came from a template.)
+        """
+        orig_local = local
+        local = interpolate(local, self.connection)
+        interpolated = local != orig_local
+        if not local:
+            local = posixpath.basename(remote)
+        if not is_file_like:
+            local = os.path.abspath(local)
+            parent = os.path.dirname(local)
+            if interpolated and not os.path.isdir(parent):
+                debug("Creating local directory {0!r}".format(parent))
+                try:
+                    os.makedirs(parent)
+                except OSError:
+                    # Another thread/process may have beaten us to it.
+                    if not os.path.isdir(parent):
+                        raise
+        return local
+
+    def _protocol(self, protocol):
+        if protocol is None:
+            protocol = self.connection.config.transfer.protocol
+        if protocol not in ('sftp', 'scp', 'tar'):
+            err = "Unknown transfer protocol {0!r}!"
+            raise ValueError(err.format(protocol))
+        return protocol
+
+    def _unsupported(self, what, **options):
+        """
+        Raise ``ValueError`` if any of ``options`` was given (i.e. is truthy),
+        since ``what`` (e.g. a protocol) would otherwise ignore them.
+        """
+        given = sorted(name for name, value in options.items() if value)
+        if given:
+            err = "{0} does not support {1}!"
+            raise ValueError(err.format(what, ", ".join(given)))
+
+    def _retry(self, transfer, retries, rewindable):
+        """
+        Call ``transfer`` (returning a `.Result`), retrying it up to
+        ``retries`` times if the connection fails underneath it.
+
+        Each retry starts over on a channel freshly leased from the
+        connection's `.SFTPPool`, the broken one having been discarded via
+        `.SFTPPool.release`. The returned result records the number of retries
+        made, and the time taken by all tries.
+        """
+        if retries is None:
+            retries = self.connection.config.transfer.retries
+        if retries < 0:
+            err = "retries must be zero or a positive integer, not {0!r}!"
+            raise ValueError(err.format(retries))
+        start = time.time()
+        attempt = 0
+        while True:
+            self._leasing = True
+            try:
+                result = transfer()
+            except Exception as e:
+                broken = self._broken(e)
+                # A broken channel is discarded rather than handed back.
+                self._release(broken)
+                if not (rewindable and attempt < retries and broken):
+                    raise
+                attempt += 1
+                debug("Transfer failed ({0!r}), retrying ({1}/{2})".format(
+                    e, attempt, retries,
+                ))
+            except BaseException:
+                self._release(False)
+                raise
+            else:
+                self._release(False)
+                break
+        result.retries = attempt
+        result.elapsed = time.time() - start
+        return result
+
+    def _broken(self, error):
+        """
+        Whether ``error`` stems from the connection failing (rather than, say,
+        the server refusing a request, which retrying won't fix.)
+        """
+        if isinstance(error, (EOFError, SSHException)):
+            return True
+        # E.g. "Socket is closed", from writes to a dead channel.
+        client = self._sftp or self._leased or self.connection._sftp
+        return (
+            isinstance(error, EnvironmentError)
+            and client is not None
+            and client.sock.closed
+        )
+
+    @contextmanager
+    def _exec(self, command, label=None):
+        """
+        Run shell ``command`` remotely, yielding its channel.
+
+        ``label`` replaces the (perhaps unwieldy) command in error messages.
+
+        Standard error is drained in the background, so a chatty command
+        can't stall the channel.
+
+        :raises:
+            ``IOError`` (including the command's stderr) if the command exits
+            nonzero; this takes precedence over errors raised by the body of
+            the ``with``, which are usually a symptom (e.g. a truncated
+            stream) of the command failing.
+        """
+        debug("Streaming via remote command {0!r}".format(command))
+        channel = self.connection.create_session()
+        errors = []
+
+        def drain():
+            while True:
+                data = channel.recv_stderr(32768)
+                if not data:
+                    break
+                errors.append(data)
+        thread = threading.Thread(target=drain)
+        thread.daemon = True
+        error = None
+        try:
+            channel.exec_command(command)
+            thread.start()
+            try:
+                yield channel
+            except Exception as e:
+                error = e
+            channel.shutdown_write()
+            status = channel.recv_exit_status()
+        finally:
+            channel.close()
+            if thread.is_alive():
+                thread.join()
+        if status != 0:
+            stderr = b''.join(errors).decode('utf-8', 'replace').strip()
+            if not stderr and error is not None:
+                stderr = str(error)
+            err = "Remote command {0!r} exited {1}: {2}"
+            raise IOError(err.format(label or command, status, stderr))
+        if error is not None:
+            raise error
+
+    def _scp_put(
+        self, local, remote, is_file_like, preserve_mode, memory_map=False,
+        progress=None,
+    ):
+        """
+        Upload ``local`` to ``remote`` by driving a remote ``scp -t``.
+
+        :returns: The number of bytes sent.
+        """
+        if is_file_like:
+            pointer = local.tell()
+            try:
+                local.seek(0)
+                data = local.read()
+            finally:
+                local.seek(pointer)
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            size, mode, times = len(data), 0o644, None
+            name = posixpath.basename(remote)
+            chunks = iter([data])
+        else:
+            fd = open(local, 'rb')
+            local_stat = os.fstat(fd.fileno())
+            size = local_stat.st_size
+            mode = stat.S_IMODE(local_stat.st_mode)
+            times = (int(local_stat.st_mtime), int(local_stat.st_atime))
+            name = os.path.basename(local)
+            chunks = _chunks(fd, 32768, memory_map)
+        # NOTE: -p makes scp apply our mode (and times) to existing files too.
+        flags = ['-p'] if preserve_mode and times else []
+        if not preserve_mode:
+            mode = 0o644
+        try:
+            with self._exec(
+                _shell(['scp', '-t'] + flags + [remote]), label='scp -t',
+            ) as channel:
+                _scp_response(channel)
+                if flags:
+                    channel.sendall("T{0} 0 {1} 0\n".format(*times).encode('ascii')) # noqa
+                    _scp_response(channel)
+                header = "C{0:04o} {1} {2}\n".format(mode, size, name)
+                channel.sendall(header.encode('utf-8'))
+                _scp_response(channel)
+                sent = 0
+                for chunk in chunks:
+                    channel.sendall(chunk)
+                    sent += len(chunk)
+                    if progress is not None:
+                        progress(sent, size)
+                channel.sendall(b'\0')
+                _scp_response(channel)
+        finally:
+            if not is_file_like:
+                fd.close()
+        return size
+
+    def _scp_get(
+        self, remote, local, is_file_like, preserve_mode, progress=None,
+    ):
+        """
+        Download ``remote`` to ``local`` by driving a remote ``scp -f``.
+
+        :returns: The number of bytes received.
+        """
+        with self._exec(
+            _shell(['scp', '-f', remote]), label='scp -f',
+        ) as channel:
+            channel.sendall(b'\0')
+            header = _scp_response(channel, line=True)
+            if not header.startswith(b'C'):
+                err = "Unexpected scp header {0!r}"
+                raise IOError(err.format(header))
+            mode, size, _ = header[1:].split(b' ', 2)
+            mode, size = int(mode, 8), int(size)
+            channel.sendall(b'\0')
+            fd = local if is_file_like else open(local, 'wb')
+            try:
+                remaining = size
+                while remaining:
+                    data = channel.recv(min(32768, remaining))
+                    if not data:
+                        raise IOError("scp stream ended early!")
+                    fd.write(data)
+                    remaining -= len(data)
+                    if progress is not None:
+                        progress(size - remaining, size)
+            finally:
+                if not is_file_like:
+                    fd.close()
+            _scp_response(channel)
+            channel.sendall(b'\0')
+        if preserve_mode and not is_file_like:
+            os.chmod(local, stat.S_IMODE(mode))
+        return size
+
+    def _compressed_put(
+        self, local, remote, is_file_like, preserve_mode, codec, progress,
+    ):
+        """
+        Upload ``local`` to ``remote``, compressed with ``codec`` on the way
+        and decompressed by a remote command.
+
+        :returns: A ``(size, compressed)`` tuple of byte counts.
+        """
+        mode = total = None
+        if is_file_like:
+            pointer = local.tell()
+            local.seek(0)
+            fd = local
+        else:
+            fd = open(local, 'rb')
+            local_stat = os.fstat(fd.fileno())
+            total = local_stat.st_size
+            if preserve_mode:
+                mode = stat.S_IMODE(local_stat.st_mode)
+        # NOTE: subshell, as the zlib fallback exec's its interpreter.
+        command = "({0}) > {1}".format(
+            _remote_codec(codec, decompress=True), shlex_quote(remote),
         )
+        if mode is not None:
+            command += " && " + _shell(['chmod', "{0:o}".format(mode), remote])
+        compressor = _compressor(codec)
+        size = 0
+        try:
+            with self._exec(
+                command, label="{0} upload".format(codec),
+            ) as channel:
+                writer = _ChannelWriter(channel)
+                for chunk in _chunks(fd, 32768):
+                    size += len(chunk)
+                    data = compressor.compress(chunk)
+                    if data:
+                        writer.write(data)
+                    if progress is not None:
+                        progress(size, total)
+                writer.write(compressor.flush())
+        finally:
+            if is_file_like:
+                local.seek(pointer)
+            else:
+                fd.close()
+        debug("Uploaded {0} bytes to {1!r} as {2} {3} bytes".format(
+            size, remote, writer.count, codec,
+        ))
+        return size, writer.count
+
+    def _compressed_get(
+        self, remote, local, is_file_like, preserve_mode, codec, progress,
+    ):
+        """
+        Download ``remote`` to ``local``, compressed with ``codec`` by a
+        remote command and decompressed as it arrives.
+
+        :returns: A ``(size, compressed)`` tuple of byte counts.
+        """
+        command = "({0}) < {1}".format(
+            _remote_codec(codec), shlex_quote(remote),
+        )
+        decompressor = _decompressor(codec)
+        size = 0
+        fd = local if is_file_like else open(local, 'wb')
+        try:
+            with self._exec(
+                command, label="{0} download".format(codec),
+            ) as channel:
+                reader = _ChannelReader(channel)
+                while True:
+                    data = reader.read(32768)
+                    if not data:
+                        break
+                    data = decompressor.decompress(data)
+                    fd.write(data)
+                    size += len(data)
+                    if progress is not None:
+                        progress(size, None)
+                flush = getattr(decompressor, 'flush', None)
+                if flush is not None:
+                    data = flush()
+                    fd.write(data)
+                    size += len(data)
+        finally:
+            if not is_file_like:
+                fd.close()
+        if preserve_mode and not is_file_like:
+            # NOTE: no portable way to ask the remote shell; SFTP it is.
+            os.chmod(local, stat.S_IMODE(self.sftp().stat(remote).st_mode))
+        debug("Downloaded {0} bytes from {1!r} as {2} {3} bytes".format(
+            size, remote, reader.count, codec,
+        ))
+        return size, reader.count
+
+    def _put_tar(self, local, remote, preserve_mode, compress, progress):
+        """
+        Stream directory ``local`` into ``tar -x`` run remotely in ``remote``.
+
+        :returns: The number of (possibly compressed) bytes sent.
+        """
+        if not os.path.isdir(local):
+            raise ValueError("{0!r} is not a directory!".format(local))
+        compress = _tar_codec(compress)
+        flags = tar_compression[compress]
+        if preserve_mode:
+            flags = flags + ['-p']
+        command = "{0} && {1}".format(
+            _shell(['mkdir', '-p', remote]),
+            _shell(['tar', '-x', '-f', '-', '-C', remote] + flags),
+        )
+        with self._exec(command) as channel:
+            writer = _ChannelWriter(channel, progress)
+            # NOTE: 'w|' is tarfile's streaming mode: nothing is seeked, nor
+            # held in memory beyond the current block.
+            if compress == 'zstd':
+                compressor = _zstandard().ZstdCompressor()
+                stream = compressor.stream_writer(writer)
+                mode = 'w|'
+            else:
+                stream = writer
+                mode = 'w|gz' if compress == 'gzip' else 'w|'
+            archive = tarfile.open(fileobj=stream, mode=mode)
+            try:
+                archive.add(local, arcname='.')
+            finally:
+                archive.close()
+                if stream is not writer:
+                    stream.close()
+        return writer.count
+
+    def _get_tar(self, remote, local, preserve_mode, compress, progress):
+        """
+        Stream ``tar -c`` of remote directory ``remote`` into ``local``.
+
+        :returns: The number of (possibly compressed) bytes received.
+        """
+        compress = _tar_codec(compress)
+        flags = tar_compression[compress]
+        command = _shell(['tar', '-c', '-f', '-', '-C', remote] + flags + ['.']) # noqa
+        if not os.path.isdir(local):
+            os.makedirs(local)
+        umask = os.umask(0)
+        os.umask(umask)
+        root = os.path.realpath(local)
+        with self._exec(command) as channel:
+            reader = _ChannelReader(channel, progress)
+            if compress == 'zstd':
+                decompressor = _zstandard().ZstdDecompressor()
+                stream = decompressor.stream_reader(reader)
+                mode = 'r|'
+            else:
+                stream = reader
+                mode = 'r|gz' if compress == 'gzip' else 'r|'
+            archive = tarfile.open(fileobj=stream, mode=mode)
+            try:
+                for member in archive:
+                    if member.isdev() or self._escapes(member, root):
+                        debug("Skipping unsafe tar member {0!r}".format(
+                            member.name,
+                        ))
+                        continue
+                    if not preserve_mode:
+                        default = 0o777 if member.isdir() else 0o666
+                        member.mode = default & ~umask
+                    archive.extract(member, local)
+            finally:
+                archive.close()
+            # Drain anything left (e.g. tar's end-of-archive padding) so the
+            # remote end never blocks on a full channel window.
+            while reader.read(32768):
+                pass
+        return reader.count
+
+    def _escapes(self, member, root):
+        """
+        Whether tar ``member`` would land (or, if a link, point) outside
+        directory ``root`` (a real path) once extracted into it.
+
+        Paths are resolved against what's on disk, so symlinks extracted
+        earlier (or already present) are followed, as extraction would.
+        """
+        def inside(path):
+            path = os.path.realpath(path)
+            return path == root or path.startswith(os.path.join(root, ''))
+        name = posixpath.normpath(member.name)
+        if name.startswith('/') or name.split('/')[0] == '..':
+            return True
+        path = os.path.join(root, *name.split('/'))
+        parent = os.path.dirname(path)
+        if not inside(parent):
+            return True
+        if member.issym():
+            # Replaces, rather than follows, whatever is at its own path.
+            if posixpath.isabs(member.linkname):
+                return True
+            return not inside(
+                os.path.join(parent, *member.linkname.split('/')),
+            )
+        if member.islnk():
+            return not inside(os.path.join(root, *member.linkname.split('/')))
+        return not inside(path)
+
+    def _delta_put(
+        self, local, remote, preserve_mode, block_size, progress=None,
+    ):
+        """
+        Upload ``local`` over existing file ``remote`` as a delta.
+
+        :returns:
+            A two-tuple of the file's size & the number of bytes actually
+            sent, or ``None`` if ``remote`` does not exist.
+        """
+        with self._exec(_python(
+            delta_signature_script, remote, block_size,
+        ), label='delta signature') as channel:
+            lines = _ChannelReader(channel).read().decode('ascii').split()
+        if lines == ['missing']:
+            debug("{0!r} does not exist, sending all of it".format(remote))
+            return None
+        signature = [
+            (int(weak), strong) for weak, strong in zip(lines[::2], lines[1::2]) # noqa
+        ]
+        mode = '-'
+        if hasattr(local, 'read'):
+            pointer = local.tell()
+            try:
+                local.seek(0)
+                data = local.read()
+            finally:
+                local.seek(pointer)
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            source = None
+        else:
+            if preserve_mode:
+                mode = "{0:o}".format(stat.S_IMODE(os.stat(local).st_mode))
+            source = open(local, 'rb')
+            size = os.fstat(source.fileno()).st_size
+            # NOTE: mmap refuses empty files.
+            data = b''
+            if size:
+                data = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            with self._exec(_python(
+                delta_patch_script, remote, block_size, mode,
+            ), label='delta patch') as channel:
+                writer = _ChannelWriter(channel)
+                done = 0
+                for op, value in _delta(data, signature, block_size):
+                    if op == 'C':
+                        writer.write(b'C' + struct.pack('>QQ', *value))
+                        done += value[1] * block_size
+                    else:
+                        writer.write(b'L' + struct.pack('>Q', len(value)))
+                        writer.write(value)
+                        done += len(value)
+                    if progress is not None:
+                        # NOTE: the last block copied may be a short one.
+                        progress(min(done, len(data)), len(data))
+                writer.write(b'E')
+                writer.write(hashlib.md5(data).hexdigest().encode('ascii'))
+            size = len(data)
+        finally:
+            if source is not None:
+                if size:
+                    data.close()
+                source.close()
+        debug("Sent {0} bytes of delta for {1} bytes to {2!r}".format(
+            writer.count, size, remote,
+        ))
+        return size, writer.count
+
+    def _skip_mode(self, skip_unchanged, is_file_like):
+        if not skip_unchanged:
+            return None
+        if skip_unchanged is True:
+            skip_unchanged = 'mtime'
+        if skip_unchanged not in ('mtime', 'hash'):
+            err = "Unknown skip_unchanged mode {0!r}!"
+            raise ValueError(err.format(skip_unchanged))
+        if is_file_like:
+            raise ValueError("skip_unchanged requires a local file path, not a file-like object!") # noqa
+        return skip_unchanged
+
+    def _remote_digests(self, paths, limit=None):
+        """
+        Return SHA-256 hex digests of remote ``paths``, in a single command.
+
+        Only the first ``limit`` bytes of each are hashed, if ``limit`` is
+        given. Digests of unreadable (e.g. missing) files are ``None``.
+        """
+        args = () if limit is None else (limit,)
+        with self._exec(
+            _python(digest_script, *args), label='digest',
+        ) as channel:
+            _ChannelWriter(channel).write(
+                b'\0'.join(x.encode('utf-8') for x in paths),
+            )
+            channel.shutdown_write()
+            lines = _ChannelReader(channel).read().decode('ascii').split()
+        return [None if x == '-' else x for x in lines]
+
+    def _unchanged(self, skip, items):
+        """
+        Determine which of ``items`` need not be transferred.
+
+        :param str skip: ``'mtime'`` or ``'hash'``.
+
+        :param items:
+            An iterable of ``(local_path, remote_path, attrs)`` tuples,
+            ``attrs`` being the remote file's
+            `~paramiko.sftp_attr.SFTPAttributes` (or ``None`` if it doesn't
+            exist.)
+
+        :returns:
+            A `set` of the local paths of those items whose local & remote
+            files have the same size and either modification time (to the
+            second) or, for ``'hash'``, contents. All remote digests needed
+            are computed by one remote command.
+        """
+        unchanged = set()
+        candidates = []
+        for local_path, remote_path, attrs in items:
+            try:
+                local_stat = os.stat(local_path)
+            except OSError:
+                continue
+            if attrs is None or attrs.st_size != local_stat.st_size:
+                continue
+            if skip == 'hash':
+                candidates.append((local_path, remote_path))
+            elif int(attrs.st_mtime) == int(local_stat.st_mtime):
+                unchanged.add(local_path)
+        if candidates:
+            digests = self._remote_digests([x[1] for x in candidates])
+            for (local_path, _), digest in zip(candidates, digests):
+                if digest == _digest(local_path):
+                    unchanged.add(local_path)
+        return unchanged
+
+    def _checkpoint_size(self):
+        size = self.connection.config.transfer.checkpoint_size
+        if size < 1:
+            err = "checkpoint_size must be a positive integer, not {0!r}!"
+            raise ValueError(err.format(size))
+        return size
 
-    def put(self, local, remote=None, preserve_mode=True):
+    def _resumable_get(
+        self, sftp, remote, local, preserve_mode, block_size, progress=None,
+    ):
+        """
+        Download ``remote`` via ``<local>.part``, continuing any earlier try.
+
+        :returns: A two-tuple of the file's size & its list of checkpoints.
+        """
+        partial = local + '.part'
+        step = self._checkpoint_size()
+        with sftp.open(remote, 'rb') as handle:
+            attrs = handle.stat()
+            offset = 0
+            if os.path.exists(partial):
+                offset = os.path.getsize(partial)
+                if offset > attrs.st_size or offset and (
+                    self._remote_digests([remote], limit=offset)[0]
+                    != _digest(partial, limit=offset)
+                ):
+                    debug("Discarding mismatched {0!r}".format(partial))
+                    offset = 0
+            if offset:
+                debug("Resuming download of {0!r} at byte {1}".format(
+                    remote, offset,
+                ))
+            checkpoints = [offset]
+            with open(partial, 'r+b' if offset else 'wb') as fd:
+                fd.seek(offset)
+                fd.truncate()
+                while offset < attrs.st_size:
+                    end = min(offset + step, attrs.st_size)
+                    chunks = [
+                        (x, min(block_size, end - x))
+                        for x in range(offset, end, block_size)
+                    ]
+                    done = offset
+                    for data in handle.readv(chunks):
+                        fd.write(data)
+                        done += len(data)
+                        if progress is not None:
+                            progress(done, attrs.st_size)
+                    # Make sure everything up to the checkpoint is on disk.
+                    fd.flush()
+                    os.fsync(fd.fileno())
+                    offset = end
+                    checkpoints.append(offset)
+        if preserve_mode:
+            os.chmod(partial, stat.S_IMODE(attrs.st_mode))
+        # NOTE: atomic (and replaces any existing file) on POSIX.
+        os.rename(partial, local)
+        return attrs.st_size, checkpoints
+
+    def _resumable_put(
+        self, sftp, local, remote, mode, block_size, progress=None,
+    ):
+        """
+        Upload ``local`` via ``<remote>.part``, continuing any earlier try.
+
+        :returns: A two-tuple of the file's size & its list of checkpoints.
+        """
+        partial = remote + '.part'
+        step = self._checkpoint_size()
+        size = os.stat(local).st_size
+        attrs = _stat(sftp, partial)
+        offset = 0
+        if attrs is not None and 0 < attrs.st_size <= size:
+            digest = self._remote_digests([partial], limit=attrs.st_size)[0]
+            if digest == _digest(local, limit=attrs.st_size):
+                offset = attrs.st_size
+                debug("Resuming upload to {0!r} at byte {1}".format(
+                    remote, offset,
+                ))
+            else:
+                debug("Discarding mismatched {0!r}".format(partial))
+        checkpoints = [offset]
+        with open(local, 'rb') as fd:
+            # Unbuffered, so each write() below is sent immediately.
+            with sftp.open(partial, 'r+b' if offset else 'wb', 0) as handle:
+                fd.seek(offset)
+                handle.seek(offset)
+                while offset < size:
+                    data = fd.read(min(block_size, size - offset))
+                    if not data:
+                        break
+                    end = offset + len(data)
+                    # Writes are pipelined, except at checkpoints, where all
+                    # of them so far must be acknowledged by the server.
+                    boundary = end // step > offset // step or end == size
+                    handle.set_pipelined(not boundary)
+                    handle.write(data)
+                    offset = end
+                    if boundary:
+                        checkpoints.append(offset)
+                    if progress is not None:
+                        progress(offset, size)
+                if mode is not None:
+                    handle.chmod(mode)
+        sftp.posix_rename(partial, remote)
+        return size, checkpoints
+
+    def _absolute(self, sftp, path):
+        """
+        Make remote ``path`` absolute, relative to the remote CWD.
+        """
+        # Absolute paths needn't cost a round trip to find out the CWD.
+        if posixpath.isabs(path):
+            return path
+        return posixpath.join(self._cwd(sftp), path)
+
+    def _cwd(self, sftp):
+        """
+        Return the remote CWD which ``sftp`` resolves relative paths against.
+
+        That's the directory last given to
+        `~paramiko.sftp_client.SFTPClient.chdir` (on ``sftp``, or else on the
+        connection's own SFTP session, which pooled channels defer to), if
+        any; otherwise, the server's starting directory (typically the user's
+        ``$HOME``), which is only looked up once per connection, being the
+        same for all its SFTP sessions.
+        """
+        cwd = sftp.getcwd()
+        own = self.connection._sftp
+        if cwd is None and own is not None and own is not sftp:
+            cwd = own.getcwd()
+        if cwd is not None:
+            return cwd
+        if self.connection._sftp_home is None:
+            self.connection._sftp_home = sftp.normalize('.')
+        return self.connection._sftp_home
+
+    def resolve(self, paths, realpath=False):
+        """
+        Make many remote ``paths`` absolute at once.
+
+        Relative paths are joined onto the remote CWD, as `get` and `put` do;
+        that costs at most one round trip (and none at all once the CWD is
+        known.)
+
+        :param bool realpath:
+            When ``True``, also canonicalize every path remotely (resolving
+            symlinks, ``.`` and ``..``) by way of a single command run by
+            ``python3`` or ``python``. Default: ``False``.
+
+        :returns: A list of paths, in the same order as ``paths``.
+        """
+        paths = list(paths)
+        if any(not posixpath.isabs(x) for x in paths):
+            cwd = self._cwd(self.sftp())
+            paths = [posixpath.join(cwd, x) for x in paths]
+        if not realpath or not paths:
+            return paths
+        with self._exec(_python(realpath_script), label='realpath') as channel:
+            _ChannelWriter(channel).write(
+                b'\0'.join(x.encode('utf-8') for x in paths),
+            )
+            channel.shutdown_write()
+            output = _ChannelReader(channel).read()
+        return [x.decode('utf-8') for x in output.split(b'\0')[:-1]]
+
+    def _workers(self, workers):
+        if workers is None:
+            workers = self.connection.config.transfer.workers
+        if workers < 1:
+            err = "workers must be a positive integer, not {0!r}!"
+            raise ValueError(err.format(workers))
+        return workers
+
+    @contextmanager
+    def _channels(self, sftp, workers):
+        """
+        Yield a list of up to ``workers`` SFTP clients, the first being
+        ``sftp``.
+
+        The others are leased from the connection's `.SFTPPool`, without
+        waiting for any (so fewer are used when the pool is busy), and handed
+        back afterwards.
+        """
+        pool = self.connection.sftp_pool
+        clients = [sftp]
+        broken = False
+        try:
+            for _ in range(workers - 1):
+                client = pool.acquire(blocking=False)
+                if client is None:
+                    break
+                clients.append(client)
+            yield clients
+        except Exception as e:
+            # The channels share one transport; if it failed, so did they.
+            broken = self._broken(e)
+            raise
+        finally:
+            for client in clients[1:]:
+                pool.release(client, broken=broken)
+
+    def _get_tree(
+        self, sftp, remote, local, preserve_mode, workers, skip, progress,
+        **kwargs
+    ):
+        """
+        Download directory ``remote`` (recursively) as directory ``local``.
+
+        :returns:
+            A two-tuple of a list of per-file `.Result` objects & the number
+            of requests made over extra SFTP channels (see `_requests`.)
+        """
+        root = sftp.stat(remote)
+        if not stat.S_ISDIR(root.st_mode):
+            raise ValueError("{0!r} is not a directory!".format(remote))
+        directories = [(local, root.st_mode)]
+        files = []
+        with self._channels(sftp, workers) as clients:
+            opened = _requests(clients[1:])
+            # Walk the tree one level at a time, listing all of a level's
+            # directories in parallel.
+            level = [(remote, local)]
+            while level:
+                listings = _parallel(
+                    clients,
+                    lambda client, pair: client.listdir_attr(pair[0]),
+                    level,
+                )
+                deeper = []
+                for (remote_dir, local_dir), entries in zip(level, listings):
+                    for attrs in entries:
+                        paths = (
+                            posixpath.join(remote_dir, attrs.filename),
+                            os.path.join(local_dir, attrs.filename),
+                        )
+                        if stat.S_ISDIR(attrs.st_mode):
+                            deeper.append(paths)
+                            directories.append((paths[1], attrs.st_mode))
+                        elif stat.S_ISREG(attrs.st_mode):
+                            files.append(paths + (attrs,))
+                        else:
+                            debug("Skipping non-file {0!r}".format(paths[0]))
+                level = deeper
+            for path, _ in directories:
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+            unchanged = set()
+            if skip:
+                unchanged = self._unchanged(
+                    skip, [(x[1], x[0], x[2]) for x in files],
+                )
+            if progress is not None:
+                progress = _Progress(progress, sum(
+                    x[2].st_size for x in files if x[1] not in unchanged
+                ))
+
+            def download(client, item):
+                remote_path, local_path, attrs = item
+                if local_path in unchanged:
+                    return Result(
+                        orig_remote=remote_path,
+                        remote=remote_path,
+                        orig_local=local_path,
+                        local=local_path,
+                        connection=self.connection,
+                        size=0,
+                        skipped=True,
+                    )
+                result = Transfer(self.connection, sftp=client).get(
+                    remote_path,
+                    local_path,
+                    preserve_mode=False,
+                    progress=progress and progress.file(local_path),
+                    retries=0,
+                    **kwargs
+                )
+                if result.size is None:
+                    result.size = attrs.st_size
+                if preserve_mode:
+                    os.chmod(local_path, stat.S_IMODE(attrs.st_mode))
+                if skip:
+                    os.utime(local_path, (attrs.st_atime, attrs.st_mtime))
+                return result
+            results = _parallel(clients, download, files)
+            extra = _since(opened, clients[1:])
+        # Directory modes are applied last, in case any lack write permission.
+        if preserve_mode:
+            for path, mode in reversed(directories):
+                os.chmod(path, stat.S_IMODE(mode))
+        return results, extra
+
+    def _put_tree(
+        self, sftp, local, remote, preserve_mode, workers, skip, progress,
+        **kwargs
+    ):
+        """
+        Upload directory ``local`` (recursively) as directory ``remote``.
+
+        :returns: As for `_get_tree`.
+        """
+        if not os.path.isdir(local):
+            raise ValueError("{0!r} is not a directory!".format(local))
+        # Directories by depth, so parents are created before their children.
+        levels = []
+        files = []
+        for root, dirnames, filenames in os.walk(local):
+            relative = os.path.relpath(root, local)
+            parts = [] if relative == os.curdir else relative.split(os.sep)
+            remote_root = posixpath.join(remote, *parts)
+            if len(levels) <= len(parts):
+                levels.append([])
+            levels[len(parts)].append((root, remote_root))
+            for name in filenames:
+                files.append((
+                    os.path.join(root, name),
+                    posixpath.join(remote_root, name),
+                ))
+        with self._channels(sftp, workers) as clients:
+            opened = _requests(clients[1:])
+            for level in levels:
+                _parallel(
+                    clients,
+                    lambda client, pair: _remote_mkdir(client, pair[1]),
+                    level,
+                )
+
+            unchanged = set()
+            if skip:
+                # One listing per remote directory gets every file's attrs.
+                directories = [x[1] for level in levels for x in level]
+                listings = dict(zip(directories, _parallel(
+                    clients,
+                    lambda client, path: dict(
+                        (x.filename, x) for x in client.listdir_attr(path)
+                    ),
+                    directories,
+                )))
+                unchanged = self._unchanged(skip, [
+                    (
+                        local_path,
+                        remote_path,
+                        listings[posixpath.dirname(remote_path)].get(
+                            posixpath.basename(remote_path),
+                        ),
+                    )
+                    for local_path, remote_path in files
+                ])
+            if progress is not None:
+                progress = _Progress(progress, sum(
+                    os.path.getsize(x[0]) for x in files
+                    if x[0] not in unchanged
+                ))
+
+            def upload(client, pair):
+                if pair[0] in unchanged:
+                    return Result(
+                        orig_remote=pair[1],
+                        remote=pair[1],
+                        orig_local=pair[0],
+                        local=pair[0],
+                        connection=self.connection,
+                        size=0,
+                        skipped=True,
+                    )
+                result = Transfer(self.connection, sftp=client).put(
+                    pair[0],
+                    pair[1],
+                    preserve_mode=preserve_mode,
+                    progress=progress and progress.file(pair[0]),
+                    retries=0,
+                    **kwargs
+                )
+                if result.size is None:
+                    result.size = os.stat(pair[0]).st_size
+                if skip:
+                    local_stat = os.stat(pair[0])
+                    client.utime(
+                        pair[1], (local_stat.st_atime, local_stat.st_mtime),
+                    )
+                return result
+            results = _parallel(clients, upload, files)
+            # Directory modes are applied last, in case any lack write
+            # permission.
+            if preserve_mode:
+                directories = [x for level in reversed(levels) for x in level]
+                _parallel(
+                    clients,
+                    lambda client, pair: client.chmod(
+                        pair[1], stat.S_IMODE(os.stat(pair[0]).st_mode),
+                    ),
+                    directories,
+                )
+            extra = _since(opened, clients[1:])
+        return results, extra
+
+    def _pipelining(self, window, block_size):
+        """
+        Fill in ``window`` & ``block_size`` from config if they're ``None``.
+        """
+        settings = self.connection.config.transfer
+        if window is None:
+            window = settings.window
+        if block_size is None:
+            block_size = settings.block_size
+        for name, value in (('window', window), ('block_size', block_size)):
+            if value is not None and value < 1:
+                err = "{0} must be a positive integer, not {1!r}!"
+                raise ValueError(err.format(name, value))
+        return window, block_size
+
+    def _pipelined_get(
+        self, sftp, remote, local, is_file_like, preserve_mode, window,
+        block_size, progress=None,
+    ):
+        """
+        Download ``remote`` with at most ``window`` reads outstanding.
+
+        :returns: The number of bytes transferred.
+        """
+        with sftp.open(remote, 'rb') as handle:
+            # Gets us both the size & (for preserve_mode) the mode.
+            attrs = handle.stat()
+            size = attrs.st_size
+            chunks = [
+                (offset, min(block_size, size - offset))
+                for offset in range(0, size, block_size)
+            ]
+            fd = local if is_file_like else open(local, 'wb')
+            written = 0
+            try:
+                for index in range(0, len(chunks), window):
+                    # NOTE: readv() issues every read in the batch before
+                    # waiting on any of the responses.
+                    for data in handle.readv(chunks[index:index + window]):
+                        fd.write(data)
+                        written += len(data)
+                        if progress is not None:
+                            progress(written, size)
+            finally:
+                if not is_file_like:
+                    fd.close()
+        if written != size:
+            err = "size mismatch in get! {0} != {1}"
+            raise IOError(err.format(written, size))
+        if preserve_mode and not is_file_like:
+            os.chmod(local, stat.S_IMODE(attrs.st_mode))
+        debug("Downloaded {0} bytes from {1!r}".format(size, remote))
+        return size
+
+    def put(
+        self,
+        local,
+        remote=None,
+        preserve_mode=True,
+        window=None,
+        block_size=None,
+        recursive=False,
+        workers=None,
+        protocol=None,
+        compress=None,
+        delta=False,
+        skip_unchanged=False,
+        resume=False,
+        memory_map=None,
+        progress=None,
+        retries=None,
+    ):
         """
         Upload a file from the local filesystem to the current connection.
 
@@ -158,17 +2316,252 @@ class Transfer(object):
             Whether to ``chmod`` the remote file so it matches the local file's
             mode (default: ``True``).
 
-        :returns: A `.Result` object.
+        :param int window:
+            When given, the upload is pipelined: ``local`` is sent in
+            ``block_size`` writes, of which up to ``window`` are outstanding at
+            once; every ``window``-th write (and the final one) waits for the
+            server to acknowledge all writes so far, raising any errors they
+            encountered. Mode preservation is then applied to the still-open
+            remote file handle, and no further ``stat`` is performed to
+            confirm the upload's size (every write having been acknowledged.)
+
+            This bounds how much unacknowledged data is in flight, which
+            Paramiko's own (always pipelined) ``put`` does not, and saves
+            round trips at the end of each upload.
+
+            Default: the ``transfer.window`` config setting (``None``, meaning
+            the default Paramiko behavior.)
+
+        :param int block_size:
+            Bytes per write when ``window`` is in effect. Paramiko splits
+            writes larger than 32 KiB into several. Default: the
+            ``transfer.block_size`` config setting (``32768``.)
+
+        :param bool recursive:
+            When ``True``, ``local`` must be a directory, which is uploaded
+            along with everything inside it to ``remote`` (which names the
+            resulting remote copy of ``local`` itself.) Directories are
+            created one tree level at a time, and files transferred, in
+            parallel. Default: ``False``.
+
+        :param int workers:
+            Number of SFTP channels (each served by its own thread) used
+            during recursive uploads; see `get`. Default: the
+            ``transfer.workers`` config setting (``4``.)
+
+        :param str protocol:
+            ``'sftp'``, ``'scp'`` or ``'tar'``; see `get`. With ``'scp'``,
+            ``scp -t`` (with ``-p`` when preserving modes) is driven on the
+            remote end, and ``delta`` is not supported either. With
+            ``'tar'``, ``local`` is archived on the fly and piped into
+            ``tar -x`` on the remote end (after creating ``remote`` with
+            ``mkdir -p``); at no point does the archive exist on disk or in
+            memory as a whole. Neither ``delta`` nor ``memory_map`` are
+            supported then either.
+
+        :param str compress:
+            Compress data in transit; see `get`. Single files are compressed
+            locally as they're read, and decompressed into ``remote`` by a
+            remote command (which also applies ``preserve_mode``.) Cannot be
+            combined with ``delta`` either.
+
+        :param bool delta:
+            When ``True`` and ``remote`` already exists, send only the parts
+            of ``local`` which differ from it, rsync style: the remote end
+            (which must have ``python3`` or ``python`` available) checksums
+            ``remote`` in blocks of ``block_size`` bytes, and those blocks
+            found anywhere in ``local`` are copied remotely instead of being
+            sent. The new file is assembled beside ``remote`` and renamed
+            over it once its checksum is confirmed. If ``remote`` does not
+            exist, a regular upload happens instead. Applies to every file of
+            a recursive upload. Default: ``False``.
+
+        :param skip_unchanged:
+            Leave remote files which appear identical to their local
+            counterparts alone; see `get`. Default: ``False``.
+
+        :param bool resume:
+            Upload into ``<remote>.part``, continuing from the end of any
+            such file matching the start of ``local``; see `get`. Writes are
+            pipelined, waiting for the server to acknowledge all of them at
+            each checkpoint. Once complete, the file is renamed over
+            ``remote`` (using the ``posix-rename@openssh.com`` extension.)
+            Requires ``local`` to be a path, and cannot be combined with
+            ``delta``. Default: ``False``.
+
+        :param bool memory_map:
+            When ``True`` (and ``local`` is a path), memory-map ``local``
+            and hand `memoryview` slices of it straight to the SFTP (or SCP)
+            channel, instead of reading it into a fresh `bytes` object per
+            write; this keeps memory use and allocation churn flat however
+            large the file. SFTP uploads are then pipelined as if ``window``
+            were given, with no limit if it isn't. Default: the
+            ``transfer.memory_map`` config setting (``False``.)
+
+        :param progress:
+            A callable reporting bytes transferred so far; see `get`. Default:
+            ``None``.
+
+        :param int retries:
+            How many times to start over if the connection fails; see `get`.
+            Default: the ``transfer.retries`` config setting (``0``.)
+
+        :returns:
+            A `.Result` object, recording the transfer's `.Result.elapsed`
+            time, `.Result.round_trips` and `.Result.retries`. Pipelined
+            uploads also record the number of bytes transferred, making
+            `.Result.throughput` available.
+            Recursive uploads record their total size, and a `.Result` per
+            file in `.Result.files`. Delta uploads record the number of bytes
+            actually sent in `.Result.sent`. Files left alone due to
+            ``skip_unchanged`` have a `.Result.skipped` of ``True``.
+            Resumable uploads record their `.Result.checkpoints`, and
+            compressed ones their `.Result.compressed` size.
         """
+        protocol = self._protocol(protocol)
+        if compress is not None and not (recursive and protocol == 'tar'):
+            if protocol == 'scp':
+                raise ValueError("The scp protocol does not support compress!")
+            self._unsupported(
+                "Compressed transfers",
+                window=window,
+                delta=delta,
+                skip_unchanged=skip_unchanged,
+                resume=resume,
+                retries=retries,
+            )
+            # Nor does the transfer.retries config setting apply.
+            retries = 0
+        elif protocol == 'scp':
+            self._unsupported(
+                "The scp protocol",
+                window=window,
+                delta=delta,
+                skip_unchanged=skip_unchanged,
+                resume=resume,
+                retries=retries,
+            )
+            # Nor does the transfer.retries config setting apply.
+            retries = 0
+        elif recursive and protocol == 'tar':
+            self._unsupported(
+                "The tar protocol",
+                window=window,
+                delta=delta,
+                skip_unchanged=skip_unchanged,
+                resume=resume,
+                retries=retries,
+                memory_map=memory_map,
+            )
+            retries = 0
+        return self._retry(
+            lambda: self._put(
+                local, remote, preserve_mode, window, block_size, recursive,
+                workers, protocol, compress, delta, skip_unchanged, resume,
+                memory_map, progress,
+            ),
+            retries=retries,
+            rewindable=True,
+        )
+
+    def _put(
+        self, local, remote, preserve_mode, window, block_size, recursive,
+        workers, protocol, compress, delta, skip_unchanged, resume,
+        memory_map, progress,
+    ):
         # TODO: preserve honoring of  "name" attribute of file-like objects as
         # in v1, so one CAN just upload to a directory? did we just make that
         # shit up or is it an actual part of the api in newer Pythons?
-        sftp = self.connection.sftp()
-
         if not local:
             raise ValueError("Local path must not be empty!")
 
         is_file_like = hasattr(local, 'write') and callable(local.write)
+        if recursive and is_file_like:
+            raise ValueError("Cannot recursively upload a file-like object!")
+
+        protocol = self._protocol(protocol)
+        if recursive and protocol == 'tar':
+            orig_local = local
+            local = os.path.abspath(local)
+            if not remote:
+                remote = os.path.basename(local)
+            start = time.time()
+            size = self._put_tar(
+                local, remote, preserve_mode, compress, progress,
+            )
+            return Result(
+                orig_remote=remote,
+                remote=remote,
+                orig_local=orig_local,
+                local=local,
+                connection=self.connection,
+                size=size,
+                elapsed=time.time() - start,
+            )
+        if compress is not None:
+            if recursive:
+                raise ValueError(
+                    "Recursive transfers may only be compressed by the tar"
+                    " protocol!"
+                )
+            codec = _codec(compress)
+            orig_local = local
+            orig_remote = remote
+            if not is_file_like:
+                local = os.path.abspath(local)
+            if not remote:
+                if is_file_like:
+                    raise ValueError(
+                        "Must give non-empty remote path when local is a"
+                        " file-like object!"
+                    )
+                remote = os.path.basename(local)
+            start = time.time()
+            size, compressed = self._compressed_put(
+                local, remote, is_file_like, preserve_mode, codec, progress,
+            )
+            return Result(
+                orig_remote=orig_remote,
+                remote=remote,
+                orig_local=orig_local,
+                local=local,
+                connection=self.connection,
+                size=size,
+                elapsed=time.time() - start,
+                compressed=compressed,
+            )
+        if protocol == 'scp':
+            if recursive:
+                raise ValueError(
+                    "The scp protocol does not support recursive transfers!"
+                )
+            orig_local = local
+            orig_remote = remote
+            if not is_file_like:
+                local = os.path.abspath(local)
+            if not remote:
+                if is_file_like:
+                    raise ValueError("Must give non-empty remote path when local is a file-like object!") # noqa
+                remote = os.path.basename(local)
+            if memory_map is None:
+                memory_map = self.connection.config.transfer.memory_map
+            start = time.time()
+            size = self._scp_put(
+                local, remote, is_file_like, preserve_mode, memory_map,
+                progress,
+            )
+            return Result(
+                orig_remote=orig_remote,
+                remote=remote,
+                orig_local=orig_local,
+                local=local,
+                connection=self.connection,
+                size=size,
+                elapsed=time.time() - start,
+            )
+
+        sftp = self.sftp()
+        requests = _requests([sftp])
 
         # Massage remote path
         orig_remote = remote
@@ -176,10 +2569,14 @@ class Transfer(object):
             if is_file_like:
                 raise ValueError("Must give non-empty remote path when local is a file-like object!") # noqa
             else:
-                remote = os.path.basename(local)
+                # NOTE: normpath strips any trailing slash off directories.
+                name = os.path.normpath(local) if recursive else local
+                remote = os.path.basename(name)
                 debug("Massaged empty remote path into {0!r}".format(remote))
         prejoined_remote = remote
-        remote = posixpath.join(sftp.getcwd() or sftp.normalize('.'), remote)
+        remote = self._absolute(sftp, remote)
+        if recursive:
+            remote = posixpath.normpath(remote)
         if remote != prejoined_remote:
             msg = "Massaged relative remote path {0!r} into {1!r}"
             debug(msg.format(prejoined_remote, remote))
@@ -197,27 +2594,119 @@ class Transfer(object):
         # TODO: probably preserve warning message from v1 when overwriting
         # existing files. Use logging for that obviously.
         #
-        # If local appears to be a file-like object, use sftp.putfo, not put
-        if is_file_like:
+        # If pipelining, we handle reading & writing ourselves; otherwise, if
+        # local appears to be a file-like object, use sftp.putfo, not put
+        window, block_size = self._pipelining(window, block_size)
+        if memory_map is None:
+            memory_map = self.connection.config.transfer.memory_map
+        skip = self._skip_mode(skip_unchanged, is_file_like)
+        if resume and is_file_like:
+            raise ValueError("resume requires a local file path, not a file-like object!") # noqa
+        if resume and delta:
+            raise ValueError("Cannot combine resume and delta!")
+        size = files = sent = sizes = checkpoints = None
+        extra = 0
+        # Paramiko's own callbacks go unused unless wanted.
+        callback = {'callback': progress} if progress else {}
+        start = time.time()
+        if skip and not recursive:
+            attrs = _stat(sftp, remote)
+            if local in self._unchanged(skip, [(local, remote, attrs)]):
+                debug("Skipping unchanged {0!r}".format(local))
+                return Result(
+                    orig_remote=orig_remote,
+                    remote=remote,
+                    orig_local=orig_local,
+                    local=local,
+                    connection=self.connection,
+                    size=0,
+                    elapsed=time.time() - start,
+                    skipped=True,
+                    round_trips=_since(requests, [sftp]),
+                )
+        # Delta uploads fall back to the regular kind if remote is missing.
+        if delta and not recursive:
+            sizes = self._delta_put(
+                local, remote, preserve_mode, block_size, progress,
+            )
+        if sizes is not None:
+            size, sent = sizes
+        elif recursive:
+            files, extra = self._put_tree(
+                sftp=sftp,
+                local=local,
+                remote=remote,
+                preserve_mode=preserve_mode,
+                workers=self._workers(workers),
+                skip=skip,
+                progress=progress,
+                window=window,
+                block_size=block_size,
+                delta=delta,
+                resume=resume,
+                memory_map=memory_map,
+            )
+            size = sum(x.size for x in files)
+        elif is_file_like:
             msg = "Uploading file-like object {0!r} to {1!r}"
             debug(msg.format(local, remote))
             pointer = local.tell()
             try:
                 local.seek(0)
-                sftp.putfo(fl=local, remotepath=remote)
+                if window is not None:
+                    size = self._pipelined_put(
+                        sftp=sftp,
+                        fd=local,
+                        remote=remote,
+                        mode=None,
+                        window=window,
+                        block_size=block_size,
+                        progress=progress,
+                    )
+                else:
+                    sftp.putfo(fl=local, remotepath=remote, **callback)
             finally:
                 local.seek(pointer)
         else:
             debug("Uploading {0!r} to {1!r}".format(local, remote))
-            sftp.put(localpath=local, remotepath=remote)
-            # Set mode to same as local end
-            # TODO: Push this down into SFTPClient sometime (requires backwards
-            # incompat release.)
-            #
+            local_stat = os.stat(local)
+            mode = None
             if preserve_mode:
-                local_mode = os.stat(local).st_mode
-                mode = stat.S_IMODE(local_mode)
-                sftp.chmod(remote, mode)
+                mode = stat.S_IMODE(local_stat.st_mode)
+            if resume:
+                size, checkpoints = self._resumable_put(
+                    sftp=sftp,
+                    local=local,
+                    remote=remote,
+                    mode=mode,
+                    block_size=block_size,
+                    progress=progress,
+                )
+            elif window is not None or memory_map:
+                with open(local, 'rb') as fd:
+                    size = self._pipelined_put(
+                        sftp=sftp,
+                        fd=fd,
+                        remote=remote,
+                        mode=mode,
+                        window=window,
+                        block_size=block_size,
+                        memory_map=memory_map,
+                        progress=progress,
+                    )
+            else:
+                sftp.put(localpath=local, remotepath=remote, **callback)
+                # Set mode to same as local end
+                # TODO: Push this down into SFTPClient sometime (requires
+                # backwards incompat release.)
+                if mode is not None:
+                    sftp.chmod(remote, mode)
+                size = local_stat.st_size
+        if skip and not recursive:
+            local_stat = os.stat(local)
+            sftp.utime(remote, (local_stat.st_atime, local_stat.st_mtime))
+        # NOTE: extra counts the requests of any extra channels opened.
+        round_trips = _since(requests, [sftp], extra)
         # Return something useful
         return Result(
             orig_remote=orig_remote,
@@ -225,8 +2714,58 @@ class Transfer(object):
             orig_local=orig_local,
             local=local,
             connection=self.connection,
+            size=size,
+            elapsed=time.time() - start,
+            files=files,
+            sent=sent,
+            checkpoints=checkpoints,
+            round_trips=round_trips,
         )
 
+    def _pipelined_put(
+        self, sftp, fd, remote, mode, window, block_size, memory_map=False,
+        progress=None,
+    ):
+        """
+        Upload ``fd``'s contents to ``remote`` with at most ``window`` writes
+        outstanding (or, if ``None``, as many as Paramiko allows), then
+        ``chmod`` it to ``mode`` (unless ``None``.)
+
+        ``memory_map`` is handed to `_chunks`.
+
+        :returns: The number of bytes transferred.
+        """
+        size = 0
+        count = 0
+        total = None
+        if progress is not None:
+            try:
+                total = os.fstat(fd.fileno()).st_size - fd.tell()
+            except (AttributeError, EnvironmentError, ValueError):
+                pass  # E.g. an in-memory file-like object; size unknown.
+        chunks = _chunks(fd, block_size, memory_map)
+        # Unbuffered, so each write() below is sent immediately.
+        with sftp.open(remote, 'wb', 0) as handle:
+            data = next(chunks, None)
+            while data is not None:
+                following = next(chunks, None)
+                count += 1
+                # Non-pipelined writes wait for every outstanding response,
+                # raising errors from any of them.
+                handle.set_pipelined(following is not None and (
+                    window is None or count % window != 0
+                ))
+                handle.write(data)
+                size += len(data)
+                if progress is not None:
+                    progress(size, total)
+                data = following
+            if mode is not None:
+                # NOTE: fsetstat on the handle; no need to resolve the path.
+                handle.chmod(mode)
+        debug("Uploaded {0} bytes to {1!r}".format(size, remote))
+        return size
+
 
 class Result(object):
     """
@@ -243,7 +2782,23 @@ class Result(object):
     """
     # TODO: how does this differ from put vs get? field stating which? (feels
     # meh) distinct classes differing, for now, solely by name? (also meh)
-    def __init__(self, local, orig_local, remote, orig_remote, connection):
+    def __init__(
+        self,
+        local,
+        orig_local,
+        remote,
+        orig_remote,
+        connection,
+        size=None,
+        elapsed=None,
+        files=None,
+        sent=None,
+        skipped=False,
+        checkpoints=None,
+        compressed=None,
+        round_trips=None,
+        retries=0,
+    ):
         #: The local path the file was saved as, or the object it was saved
         #: into if a file-like object was given instead.
         #:
@@ -261,6 +2816,96 @@ class Result(object):
         self.orig_remote = orig_remote
         #: The `.Connection` object this result was obtained from.
         self.connection = connection
+        #: Number of bytes transferred, if known; ``None`` otherwise.
+        self.size = size
+        #: Seconds (a `float`) the transfer took, if known; ``None`` otherwise.
+        self.elapsed = elapsed
+        #: For recursive transfers, a list of `.Result` objects, one per file
+        #: transferred; ``None`` otherwise.
+        self.files = files
+        #: Number of bytes actually sent, when that differs from `.size`
+        #: (e.g. for delta uploads); ``None`` otherwise.
+        self.sent = sent
+        #: Whether the transfer was skipped, the destination already matching
+        #: the source (see the ``skip_unchanged`` option.)
+        self.skipped = skipped
+        #: For resumable transfers, a list of byte offsets up to which the
+        #: destination was known to be complete: first the offset resumed
+        #: from (``0`` if starting afresh), then each checkpoint reached.
+        #: ``None`` otherwise.
+        self.checkpoints = checkpoints
+        #: For compressed single-file transfers, the number of compressed
+        #: bytes which actually crossed the wire (`.size` counting them
+        #: uncompressed); ``None`` otherwise.
+        self.compressed = compressed
+        #: Number of SFTP requests made, each a round trip to the server
+        #: (though pipelined ones overlap), including those of recursive
+        #: transfers' extra channels; ``None`` if unknown, e.g. for transfers
+        #: streamed over a remote command.
+        self.round_trips = round_trips
+        #: Number of times the transfer was retried (see the ``retries``
+        #: option.)
+        self.retries = retries
+
+    @property
+    def throughput(self):
+        """
+        Achieved transfer rate in bytes per second, or ``None`` if unknown.
+        """
+        if self.size is None or not self.elapsed:
+            return None
+        return self.size / float(self.elapsed)
 
     # TODO: ensure str/repr makes it easily differentiable from run() or
     # local() result objects (and vice versa).
+
+
+def _total(values):
+    values = list(values)
+    if None in values:
+        return None
+    return sum(values)
+
+
+class Summary(object):
+    """
+    Aggregate metrics of several transfers' `.Result` objects, such as those
+    of a group transfer (see `.GroupResult.transfers`.)
+
+    Totals are ``None`` if any result lacks the corresponding value.
+    """
+    def __init__(self, results):
+        #: The `.Result` objects summarized.
+        self.results = list(results)
+        #: Total number of bytes transferred.
+        self.size = _total(x.size for x in self.results)
+        #: Seconds taken by the longest transfer (i.e., for transfers run in
+        #: parallel, roughly the time taken by all of them), if known.
+        elapsed = [x.elapsed for x in self.results if x.elapsed is not None]
+        self.elapsed = max(elapsed) if elapsed else None
+        #: Total number of round trips made (see `.Result.round_trips`.)
+        self.round_trips = _total(x.round_trips for x in self.results)
+        #: Total number of retries made.
+        self.retries = sum(x.retries for x in self.results)
+        #: Number of transfers skipped as unchanged.
+        self.skipped = sum(1 for x in self.results if x.skipped)
+
+    @property
+    def throughput(self):
+        """
+        Combined transfer rate in bytes per second, or ``None`` if unknown.
+        """
+        if self.size is None or not self.elapsed:
+            return None
+        return self.size / float(self.elapsed)
+
+    @property
+    def slowest(self):
+        """
+        The `.Result` with the lowest `.Result.throughput`, or ``None`` if
+        no throughput is known.
+        """
+        known = [x for x in self.results if x.throughput is not None]
+        if not known:
+            return None
+        return min(known, key=lambda x: x.throughput)
@@ -1,129 +1,1292 @@
+"""
+Port forwarding: shuttling data between local sockets and SSH channels.
+
+All of a forward's connections are served by one `TunnelManager` thread,
+which waits on every socket and channel at once (via `selectors`, so e.g.
+``epoll`` on Linux) instead of running a thread per connection. Its traffic
+is accounted for in a `TunnelStats`.
+"""
+
+from collections import namedtuple
 import errno
+from functools import partial
 import select
 import socket
+import struct
+import sys
+from threading import Event, Lock, Thread
 import time
-from threading import Event
+
+try:
+    import selectors
+except ImportError: # pragma: nocover
+    # Python < 3.4; see _SelectSelector.
+    selectors = None
 
 from invoke.exceptions import ThreadException
-from invoke.util import ExceptionHandlingThread
+from invoke.util import ExceptionHandlingThread, ExceptionWrapper
+from invoke.vendor.six.moves.queue import Queue, Empty
+
+from .util import debug
+
+
+# Same values as selectors.EVENT_READ and selectors.EVENT_WRITE.
+EVENT_READ = 1
+EVENT_WRITE = 2
+
+#: Seconds between attempts to push data into channels whose send window is
+#: full, for which Paramiko offers nothing to wait on.
+flush_interval = 0.01
+
+#: Upper bound of adaptive read sizes, when a channel's receive window can't
+#: be determined. (Paramiko's default window size.)
+max_chunk_size = 2097152
+
+
+def _would_block(error):
+    return getattr(error, 'errno', None) in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+def _hung_up(error):
+    return getattr(error, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
+
+
+_Key = namedtuple('_Key', 'fileobj events data')
+
+
+class _SelectSelector(object):
+    """
+    Minimal stand-in for `selectors.SelectSelector`, on Pythons lacking it.
+    """
+    def __init__(self):
+        self._keys = {}
+
+    def register(self, fileobj, events, data=None):
+        key = self._keys[fileobj] = _Key(fileobj, events, data)
+        return key
+
+    def modify(self, fileobj, events, data=None):
+        return self.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._keys.pop(fileobj)
+
+    def select(self, timeout=None):
+        keys = list(self._keys.values())
+        r, w, _ = select.select(
+            [x.fileobj for x in keys if x.events & EVENT_READ],
+            [x.fileobj for x in keys if x.events & EVENT_WRITE],
+            [],
+            timeout,
+        )
+        ready = []
+        for key in keys:
+            events = (
+                (EVENT_READ if key.fileobj in r else 0)
+                | (EVENT_WRITE if key.fileobj in w else 0)
+            )
+            if events:
+                ready.append((key, events))
+        return ready
+
+    def close(self):
+        self._keys.clear()
+
+
+def _selector():
+    if selectors is None:
+        return _SelectSelector()
+    return selectors.DefaultSelector()
+
+
+class Histogram(object):
+    """
+    Distribution of durations, counted in power-of-two millisecond buckets.
+    """
+    #: Upper bounds (in seconds) of all buckets but the last, unbounded, one.
+    bounds = tuple(0.001 * 2 ** x for x in range(15))
+
+    def __init__(self):
+        #: Number of durations added.
+        self.count = 0
+        #: Sum of all durations added.
+        self.total = 0.0
+        #: Shortest & longest durations added, or ``None`` while empty.
+        self.min = None
+        self.max = None
+        #: How many durations fell into each bucket (see `bounds`.)
+        self.buckets = [0] * (len(self.bounds) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        for index, bound in enumerate(self.bounds):
+            if seconds <= bound:
+                break
+        else:
+            index = len(self.bounds)
+        self.buckets[index] += 1
+
+    @property
+    def mean(self):
+        """
+        Mean duration, or ``None`` while empty.
+        """
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, fraction):
+        """
+        Approximate the duration ``fraction`` (e.g. ``0.99``) of all added
+        durations were at most; ``None`` while empty.
+
+        This is the upper bound of the bucket it falls into (but never more
+        than `max`), so may overestimate by up to a factor of two.
+        """
+        if not self.count:
+            return None
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= fraction * self.count and index < len(self.bounds):
+                return min(self.bounds[index], self.max)
+        return self.max
+
+
+class Traffic(object):
+    """
+    Bytes moved through one or more tunnels, in each direction.
+
+    Directions are from the local end's point of view: data read from local
+    sockets & written to channels is *sent*, data read from channels &
+    written to local sockets is *received*.
+    """
+    def __init__(self):
+        #: When counting started (as a `time.time` timestamp.)
+        self.started = time.time()
+        #: Bytes written to channels.
+        self.sent = 0
+        #: Bytes written to local sockets.
+        self.received = 0
+        #: Bytes per second sent & received between the last two calls to
+        #: `sample`, or ``None`` before the first.
+        self.recent_sent_rate = None
+        self.recent_received_rate = None
+        self._sampled = (self.started, 0, 0)
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def sent_rate(self):
+        """
+        Average bytes per second sent since counting started.
+        """
+        return self.sent / max(self.elapsed, 1e-9)
+
+    @property
+    def received_rate(self):
+        """
+        Average bytes per second received since counting started.
+        """
+        return self.received / max(self.elapsed, 1e-9)
+
+    def sample(self, now=None):
+        """
+        Update `recent_sent_rate` & `recent_received_rate`.
+        """
+        if now is None:
+            now = time.time()
+        then, sent, received = self._sampled
+        interval = max(now - then, 1e-9)
+        self.recent_sent_rate = (self.sent - sent) / interval
+        self.recent_received_rate = (self.received - received) / interval
+        self._sampled = (now, self.sent, self.received)
+
+
+class TunnelStats(Traffic):
+    """
+    Traffic and channel accounting for all tunnels of one forward.
+
+    This is what `.Connection.forward_local` & friends yield; it's updated
+    live by the forward's `TunnelManager`, so may be inspected at any time
+    (from any thread) to see what the forward is up to, e.g.::
+
+        with cxn.forward_local(5432) as stats:
+            do_things()
+            print(stats.sent, stats.received, stats.open_latency.mean)
+            for tunnel in stats.tunnels:
+                print(tunnel.traffic.sent_rate, tunnel.stalled)
+
+    Byte counts (see `Traffic`) include tunnels closed since.
+    """
+    def __init__(self):
+        super(TunnelStats, self).__init__()
+        #: Number of channels opened (or, for `.Connection.forward_remote`,
+        #: channels connected to the local port.)
+        self.opened = 0
+        #: Number of tunnels that failed to open: channels refused by the
+        #: remote end, or local ports refusing connections.
+        self.failed = 0
+        #: `Histogram` of seconds taken by each successful open.
+        self.open_latency = Histogram()
+        #: List of currently open `Tunnel` objects.
+        self.tunnels = []
+        #: Number of pre-opened channels currently waiting for a client.
+        self.spares = 0
+        self._lock = Lock()
+
+    @property
+    def active(self):
+        """
+        Number of tunnels currently open.
+        """
+        return len(self.tunnels)
+
+    def channel_opened(self, seconds):
+        """
+        Record a successful open, which took ``seconds``.
+        """
+        with self._lock:
+            self.opened += 1
+            self.open_latency.add(seconds)
+
+    def channel_failed(self):
+        """
+        Record a failed open.
+        """
+        with self._lock:
+            self.failed += 1
+
+    def sample(self, now=None):
+        """
+        Update recent rates, both overall and for each open tunnel.
+        """
+        if now is None:
+            now = time.time()
+        super(TunnelStats, self).sample(now)
+        for tunnel in list(self.tunnels):
+            tunnel.traffic.sample(now)
+
+
+class SOCKSError(Exception):
+    """
+    A SOCKS client sent something we can't (or won't) handle.
+
+    ``reply`` is what to tell the client before hanging up, if anything.
+    """
+    def __init__(self, message, reply=b''):
+        super(SOCKSError, self).__init__(message)
+        self.reply = reply
+
+
+class SOCKSHandshake(object):
+    """
+    Server side of a SOCKS 4, 4a or 5 handshake, for ``CONNECT`` requests.
+
+    Purely a parser: whoever owns the client's socket hands everything the
+    client sends to `feed`, writing back whatever that returns, until
+    `address` is known; then `reply` tells the client whether that address
+    could be reached. Only SOCKS 5's "no authentication" method is supported.
+    """
+    def __init__(self):
+        #: SOCKS version spoken by the client (``4`` or ``5``), once known.
+        self.version = None
+        #: ``(host, port)`` the client wants to connect to, once known.
+        self.address = None
+        #: Data the client sent after its request, for the destination.
+        self.leftover = b''
+        self._buffer = bytearray()
+        self._greeted = False
+
+    def feed(self, data):
+        """
+        Take in ``data`` from the client.
+
+        :returns: Bytes to send to the client (possibly none).
+
+        :raises:
+            `SOCKSError` if the client's messages are malformed or ask for
+            something unsupported.
+        """
+        if self.address is not None:
+            self.leftover += data
+            return b''
+        self._buffer.extend(bytearray(data))
+        buf = self._buffer
+        if not buf:
+            return b''
+        if self.version is None:
+            if buf[0] not in (4, 5):
+                raise SOCKSError("Unknown SOCKS version {0}".format(buf[0]))
+            self.version = buf[0]
+        if self.version == 4:
+            return self._parse_4(buf)
+        if not self._greeted:
+            # VER NMETHODS METHODS...
+            if len(buf) < 2 or len(buf) < 2 + buf[1]:
+                return b''
+            methods = buf[2:2 + buf[1]]
+            del buf[:2 + buf[1]]
+            if 0 not in methods:
+                raise SOCKSError(
+                    "No supported SOCKS authentication method offered",
+                    reply=b'\x05\xff',
+                )
+            self._greeted = True
+            return b'\x05\x00' + self._parse_5(buf)
+        return self._parse_5(buf)
+
+    def reply(self, success):
+        """
+        Return the final reply to the client's request.
+        """
+        if self.version == 4:
+            return b'\x00' + (b'\x5a' if success else b'\x5b') + b'\x00' * 6
+        # "General failure"; which is as much as a failed channel tells us.
+        code = b'\x00' if success else b'\x01'
+        # Bound address & port are meaningless to us; send zeroes.
+        return b'\x05' + code + b'\x00\x01' + b'\x00' * 6
+
+    def _parse_4(self, buf):
+        # VER CMD DSTPORT DSTIP USERID NUL [DOMAIN NUL] (4a)
+        end = buf.find(b'\x00', 8)
+        if len(buf) < 8 or end == -1:
+            return b''
+        if buf[1] != 1:
+            raise SOCKSError(
+                "Unsupported SOCKS command {0}".format(buf[1]),
+                reply=self.reply(False),
+            )
+        port = struct.unpack('>H', bytes(buf[2:4]))[0]
+        ip = bytes(buf[4:8])
+        if ip.startswith(b'\x00\x00\x00') and ip != b'\x00' * 4:
+            # SOCKS 4a: the server resolves a trailing domain name.
+            domain_end = buf.find(b'\x00', end + 1)
+            if domain_end == -1:
+                return b''
+            host = self._decode(buf[end + 1:domain_end])
+            end = domain_end
+        else:
+            host = socket.inet_ntoa(ip)
+        self._finish(host, port, end + 1)
+        return b''
+
+    def _parse_5(self, buf):
+        # VER CMD RSV ATYP DSTADDR DSTPORT
+        if len(buf) < 5:
+            return b''
+        if buf[0] != 5:
+            raise SOCKSError("Unknown SOCKS version {0}".format(buf[0]))
+        atyp = buf[3]
+        if atyp == 1:
+            start, end = 4, 8
+        elif atyp == 3:
+            start, end = 5, 5 + buf[4]
+        elif atyp == 4:
+            start, end = 4, 20
+        else:
+            raise SOCKSError(
+                "Unsupported SOCKS address type {0}".format(atyp),
+                reply=b'\x05\x08\x00\x01' + b'\x00' * 6,
+            )
+        if len(buf) < end + 2:
+            return b''
+        if buf[1] != 1:
+            raise SOCKSError(
+                "Unsupported SOCKS command {0}".format(buf[1]),
+                reply=b'\x05\x07\x00\x01' + b'\x00' * 6,
+            )
+        addr = bytes(buf[start:end])
+        if atyp == 1:
+            host = socket.inet_ntoa(addr)
+        elif atyp == 3:
+            host = self._decode(addr)
+        else:
+            host = socket.inet_ntop(socket.AF_INET6, addr)
+        port = struct.unpack('>H', bytes(buf[end:end + 2]))[0]
+        self._finish(host, port, end + 2)
+        return b''
+
+    def _decode(self, name):
+        try:
+            return bytes(name).decode('ascii')
+        except UnicodeDecodeError:
+            raise SOCKSError("Invalid SOCKS domain name {0!r}".format(name))
+
+    def _finish(self, host, port, length):
+        self.address = (host, port)
+        self.leftover = bytes(self._buffer[length:])
+        del self._buffer[:]
+
+
+class ChannelOpener(object):
+    """
+    Open ``direct-tcpip`` channels on worker threads.
+
+    Opening a channel takes a round trip to the server (and, on its end, a
+    TCP connection to the destination); `TunnelManager` hands that wait off
+    to us instead of blocking everything else it does. Up to ``workers``
+    opens happen at once. Worker threads are started as needed and exit
+    after ``idle_timeout`` seconds without work.
+    """
+    #: Name of worker threads.
+    thread_name = 'ChannelOpener'
+
+    def __init__(self, transport, workers=4, idle_timeout=1):
+        self.transport = transport
+        self.workers = workers
+        self.idle_timeout = idle_timeout
+        self._queue = Queue()
+        self._lock = Lock()
+        self._threads = 0
+        self._idle = 0
+
+    def open(self, dest_addr, src_addr, callback):
+        """
+        Open a channel to ``dest_addr`` in the background.
+
+        ``callback`` is called (from a worker thread) with the channel (or
+        ``None``), the ``sys.exc_info()`` of what went wrong (or ``None``)
+        and the seconds the attempt took.
+        """
+        self._queue.put((dest_addr, src_addr, callback))
+        with self._lock:
+            if self._idle or self._threads >= self.workers:
+                return
+            self._threads += 1
+            self._idle += 1
+        thread = Thread(target=self._work, name=self.thread_name)
+        # Don't hold up interpreter exit for an open that never returns.
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """
+        Make all worker threads exit once done with their current work.
+        """
+        with self._lock:
+            threads = self._threads
+        for _ in range(threads):
+            self._queue.put(None)
+
+    def _work(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.idle_timeout)
+            except Empty:
+                with self._lock:
+                    # (Work queued after our timeout, but before the queuer
+                    # saw us idle, is still ours.)
+                    if not self._queue.empty():
+                        continue
+                    self._threads -= 1
+                    self._idle -= 1
+                return
+            with self._lock:
+                self._idle -= 1
+                if item is None:
+                    self._threads -= 1
+                    return
+            dest_addr, src_addr, callback = item
+            start = time.time()
+            try:
+                channel = self.transport.open_channel(
+                    'direct-tcpip', dest_addr, src_addr,
+                )
+            except Exception:
+                callback(None, sys.exc_info(), time.time() - start)
+            else:
+                callback(channel, None, time.time() - start)
+            with self._lock:
+                self._idle += 1
 
 
 class TunnelManager(ExceptionHandlingThread):
+    """
+    Forward data between local sockets and SSH channels, in a single thread.
+
+    When given a ``local_port``, listens on it, forwarding each connection
+    made to it over a new ``direct-tcpip`` channel to ``remote_host`` and
+    ``remote_port`` (see `.Connection.forward_local`). Other pairs of socket
+    & channel may be handed over via `add` (see `.Connection.forward_remote`).
+
+    With ``socks=True``, the destination of each connection comes from the
+    client instead, which speaks SOCKS 4, 4a or 5 to the manager (see
+    `SOCKSHandshake` & `.Connection.forward_dynamic`); handshakes are carried
+    out by the same loop as everything else. A destination the channel can't
+    be opened to only fails that client's request.
+
+    Channels are opened by a `ChannelOpener` (at most ``open_workers`` at a
+    time), so accepting clients, handshakes and forwarding never wait on the
+    server. Additionally, with a ``remote_port`` & ``preopen`` above zero,
+    that many channels are opened ahead of time and handed to new clients
+    right away, being replaced as they're used; this cuts a round trip from
+    each connection, at the cost of keeping as many idle connections open to
+    the destination. (The server is told these come from the listening
+    address, not knowing the actual client yet.) Spares the destination
+    closes are dropped.
+
+    The listening socket, every `Tunnel`'s socket & channel, and a wakeup
+    socket are all multiplexed by one selector; `stop` (or `add`) writes to
+    the latter, so shutdown needs no polling or timeouts.
+
+    Errors in individual tunnels close them, without affecting the others;
+    they are raised (as a `~invoke.exceptions.ThreadException`) once the
+    manager stops.
+
+    Traffic, channel opens and their latency are recorded in `stats` (a
+    `TunnelStats`). When given a ``stats_callback``, it's called with `stats`
+    every ``stats_interval`` seconds (from the manager's thread, so it should
+    be quick), right after recent rates are sampled; errors it raises are
+    raised once the manager stops, and stop further calls.
+
+    Any ``tunnel_kwargs`` (``socket_chunk_size``, ``channel_chunk_size``,
+    ``adaptive``) are given to every `Tunnel` created.
+    """
     def __init__(self,
-        local_host, local_port,
-        remote_host, remote_port,
-        transport, finished
+        local_host=None, local_port=None,
+        remote_host=None, remote_port=None,
+        transport=None, finished=None, socks=False,
+        stats_callback=None, stats_interval=10,
+        open_workers=4, preopen=0,
+        **tunnel_kwargs
     ):
         super(TunnelManager, self).__init__()
         self.local_address = (local_host, local_port)
         self.remote_address = (remote_host, remote_port)
         self.transport = transport
+        self.socks = socks
+        self.stats_callback = stats_callback
+        self.stats_interval = stats_interval
+        self.preopen = preopen
+        self.tunnel_kwargs = tunnel_kwargs
+        self._opener = None
+        if transport is not None:
+            self._opener = ChannelOpener(transport, workers=open_workers)
+        if finished is None:
+            finished = Event()
         self.finished = finished
+        #: Set once the manager is listening (or has failed to start.)
+        self.ready = Event()
+        #: Whether the manager did start (e.g. bound its listener), once
+        #: `ready` is set; if not, its `exception` explains why.
+        self.started = False
+        #: Tunnels currently open.
+        self.tunnels = []
+        #: Accounting for all tunnels, past and present.
+        self.stats = TunnelStats()
+        # (Which watches our list of tunnels, so it's only updated in place.)
+        self.stats.tunnels = self.tunnels
+        # Tunnels added from other threads, and results of channel opens,
+        # waiting for the loop to pick them up.
+        self._lock = Lock()
+        self._added = []
+        self._opened = []
+        # Clients waiting for a channel: socket -> SOCKSHandshake or None.
+        self._waiting = {}
+        # Pre-opened channels, the ones we're watching for the destination
+        # hanging up, and how many more are being opened.
+        self._spares = []
+        self._watched = set()
+        self._spare_opens = 0
+        # Where the listening socket ended up.
+        self._listening_address = None
+        # Errors from individual tunnels, raised once we stop.
+        self._exceptions = []
+        # SOCKS clients whose handshake is underway, by socket.
+        self._handshakes = {}
+        self._selector = None
+        # Writing a byte to one end wakes up the loop waiting on the other.
+        self._waker, self._wakee = socket.socketpair()
+        for sock in (self._waker, self._wakee):
+            sock.setblocking(0)
 
-    def _run(self):
-        # Track each tunnel that gets opened during our lifetime
-        tunnels = []
+    def add(self, channel, sock):
+        """
+        Start forwarding between ``channel`` and ``sock``.
+
+        Safe to call from any thread.
+        """
+        with self._lock:
+            if self.finished.is_set():
+                # Too late; nobody would ever close these.
+                channel.close()
+                sock.close()
+                return
+            self._added.append(self._tunnel(channel, sock))
+        self._wake()
+
+    def stop(self):
+        """
+        Close all tunnels and the listening socket, ending the thread.
+
+        Safe to call from any thread; use ``join`` to wait for the shutdown.
+        """
+        with self._lock:
+            self.finished.set()
+        self._wake()
+
+    def _wake(self):
+        with self._lock:
+            # Nothing to wake up if the loop is gone already.
+            if self._waker is None:
+                return
+            try:
+                self._waker.send(b'\0')
+            except socket.error as e:
+                # A full buffer means a wakeup is pending anyway.
+                if not _would_block(e):
+                    raise
 
+    def _listen(self):
         # Set up OS-level listener socket on forwarded port
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # TODO: why do we want REUSEADDR exactly? and is it portable?
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # NOTE: choosing to deal with nonblocking semantics and a fast loop,
-        # versus an older approach which blocks & expects outer scope to cause
-        # a socket exception by close()ing the socket.
         sock.setblocking(0)
         sock.bind(self.local_address)
-        sock.listen(1)
+        # Bursts of connections are accepted in one go (see _accept), so
+        # there's no need to keep the backlog short.
+        sock.listen(socket.SOMAXCONN)
+        return sock
 
-        while not self.finished.is_set():
-            # Main loop-wait: accept connections on the local listener
-            # NOTE: EAGAIN means "you're nonblocking and nobody happened to
-            # connect at this point in time"
+    def _run(self):
+        self._selector = _selector()
+        sock = None
+        try:
+            self._selector.register(self._wakee, EVENT_READ, self._woken)
+            if self.local_address[1] is not None:
+                sock = self._listen()
+                self._listening_address = sock.getsockname()
+                self._selector.register(sock, EVENT_READ, self._accept)
+                self._replenish()
+            self.started = True
+            self.ready.set()
+            report = None
+            if self.stats_callback is not None:
+                report = time.time() + self.stats_interval
+            while not self.finished.is_set():
+                blocked = [x for x in self.tunnels if x.blocked]
+                timeout = self._timeout(blocked, report)
+                for key, events in self._selector.select(timeout):
+                    self._dispatch(key, events)
+                for tunnel in blocked:
+                    self._call(tunnel, tunnel.flush)
+                self.tunnels[:] = [x for x in self.tunnels if not x.closed]
+                if report is not None and time.time() >= report:
+                    report = self._report()
+        finally:
+            self.ready.set()
+            # Shut down all tunnels, then our own sockets.
+            # TODO: would be nice to have some output or at least logging
+            # here, especially for "sets up a handful of tunnels" use cases
+            # like forwarding nontrivial HTTP traffic.
+            with self._lock:
+                # (Anything added from now on is closed right away.)
+                self.finished.set()
+                self.tunnels.extend(self._added)
+                self._added = []
+                opened, self._opened = self._opened, []
+                self._waker.close()
+                self._waker = None
+            for tunnel in self.tunnels:
+                self._call(tunnel, tunnel.close)
+            del self.tunnels[:]
+            for client in list(self._handshakes):
+                self._drop(client)
+            # (Opens still underway get closed as they finish; see
+            # _opened_for.)
+            for _, channel, _, _ in opened:
+                if channel is not None:
+                    channel.close()
+            for client in self._waiting:
+                client.close()
+            self._waiting = {}
+            for channel in self._spares:
+                channel.close()
+            self._spares = []
+            self.stats.spares = 0
+            if self._opener is not None:
+                self._opener.stop()
+            if sock is not None:
+                sock.close()
+            self._selector.close()
+            self._wakee.close()
+        # Handle exceptions
+        if self._exceptions:
+            raise ThreadException(self._exceptions)
+
+    def _timeout(self, blocked, report):
+        """
+        Seconds to wait for events: forever, unless tunnels are `blocked` or
+        a `report` is due.
+        """
+        timeouts = []
+        if blocked:
+            timeouts.append(flush_interval)
+        if report is not None:
+            timeouts.append(max(report - time.time(), 0))
+        return min(timeouts) if timeouts else None
+
+    def _report(self):
+        """
+        Sample & hand `stats` to the callback, returning when to next do so.
+        """
+        self.stats.sample()
+        try:
+            self.stats_callback(self.stats)
+        except Exception:
+            self._exceptions.append(ExceptionWrapper({}, *sys.exc_info()))
+            return None
+        return time.time() + self.stats_interval
+
+    def _dispatch(self, key, events):
+        handler = key.data
+        # Tunnels' handlers are bound methods; record their errors instead of
+        # letting one connection take down the rest.
+        tunnel = getattr(handler, '__self__', None)
+        if isinstance(tunnel, Tunnel):
+            # Both ends may be ready, but handling the first closed the lot.
+            if not tunnel.closed:
+                self._call(tunnel, handler, key.fileobj, events)
+        else:
+            handler(key.fileobj, events)
+
+    def _call(self, tunnel, method, *args):
+        try:
+            method(*args)
+        except Exception:
+            self._exceptions.append(ExceptionWrapper({}, *sys.exc_info()))
+            if method != tunnel.close:
+                self._call(tunnel, tunnel.close)
+
+    def _woken(self, sock, events):
+        try:
+            while sock.recv(4096):
+                pass
+        except socket.error as e:
+            if not _would_block(e):
+                raise
+        with self._lock:
+            added, self._added = self._added, []
+            opened, self._opened = self._opened, []
+        for tunnel in added:
+            self._start(tunnel)
+        for result in opened:
+            self._finish_open(*result)
+
+    def _accept(self, sock, events):
+        # Accept everything pending, not just one connection per wakeup.
+        while True:
             try:
                 tun_sock, local_addr = sock.accept()
-                # Set TCP_NODELAY to match OpenSSH's forwarding socket behavior
-                tun_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             except socket.error as e:
-                if e.errno is errno.EAGAIN:
-                    # TODO: make configurable
-                    time.sleep(0.01)
-                    continue
+                if _would_block(e):
+                    break
                 raise
-
+            # Set TCP_NODELAY to match OpenSSH's forwarding socket behavior
+            tun_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.socks:
+                # Where to, we'll only know once the client tells us.
+                tun_sock.setblocking(0)
+                self._handshakes[tun_sock] = SOCKSHandshake()
+                self._selector.register(tun_sock, EVENT_READ, self._negotiate)
+                continue
+            channel = self._take_spare()
+            if channel is not None:
+                self._start(self._tunnel(channel, tun_sock))
+                continue
             # Set up direct-tcpip channel on server end
             # TODO: refactor w/ what's used for gateways
-            channel = self.transport.open_channel(
-                'direct-tcpip',
-                self.remote_address,
-                local_addr,
-            )
+            self._open(tun_sock, self.remote_address, local_addr)
+        self._replenish()
 
-            # Set up 'worker' thread for this specific connection to our
-            # tunnel, plus its dedicated signal event (which will appear as a
-            # public attr, no need to track both independently).
-            finished = Event()
-            tunnel = Tunnel(channel=channel, sock=tun_sock, finished=finished)
-            tunnel.start()
-            tunnels.append(tunnel)
-
-        exceptions = []
-        # Propogate shutdown signal to all tunnels & wait for closure
-        # TODO: would be nice to have some output or at least logging here,
-        # especially for "sets up a handful of tunnels" use cases like
-        # forwarding nontrivial HTTP traffic.
-        for tunnel in tunnels:
-            tunnel.finished.set()
-            tunnel.join()
-            wrapper = tunnel.exception()
-            if wrapper:
-                exceptions.append(wrapper)
-        # Handle exceptions
-        if exceptions:
-            raise ThreadException(exceptions)
+    def _open(self, sock, dest_addr, src_addr, handshake=None):
+        """
+        Open a channel for client ``sock`` in the background.
+
+        A ``sock`` of ``None`` means opening a spare.
+        """
+        if sock is None:
+            self._spare_opens += 1
+        else:
+            self._waiting[sock] = handshake
+        self._opener.open(dest_addr, src_addr, partial(self._opened_for, sock))
+
+    def _opened_for(self, sock, channel, exc_info, elapsed):
+        """
+        Hand the result of a channel open over to the loop.
+
+        Called from `ChannelOpener` threads.
+        """
+        with self._lock:
+            finished = self.finished.is_set()
+            if not finished:
+                self._opened.append((sock, channel, exc_info, elapsed))
+        if finished:
+            # Nobody's going to use these anymore.
+            if channel is not None:
+                channel.close()
+            if sock is not None:
+                sock.close()
+            return
+        self._wake()
+
+    def _finish_open(self, sock, channel, exc_info, elapsed):
+        if channel is None:
+            self.stats.channel_failed()
+        else:
+            self.stats.channel_opened(elapsed)
+        if sock is None:
+            self._spare_opens -= 1
+            if channel is None:
+                # No client is affected; the next one will just wait for its
+                # own channel (and then try replacing this one again.)
+                debug("Unable to pre-open channel to {0}:{1}: {2!r}".format(
+                    self.remote_address[0], self.remote_address[1],
+                    exc_info[1],
+                ))
+            else:
+                self._add_spare(channel)
+            return
+        handshake = self._waiting.pop(sock)
+        if handshake is not None:
+            self._finish_socks(sock, handshake, channel, exc_info)
+        elif channel is None:
+            # E.g. the remote end refused; only this client is affected.
+            self._exceptions.append(ExceptionWrapper({}, *exc_info))
+            sock.close()
+        else:
+            self._start(self._tunnel(channel, sock))
+
+    def _replenish(self):
+        """
+        Start opening spare channels, up to `preopen` of them.
+        """
+        if self.socks or self.remote_address[1] is None:
+            return
+        missing = self.preopen - len(self._spares) - self._spare_opens
+        for _ in range(missing):
+            self._open(None, self.remote_address, self._listening_address)
+
+    def _add_spare(self, channel):
+        self._spares.append(channel)
+        self.stats.spares = len(self._spares)
+        # Readable before use means the destination either hung up (so it's
+        # useless) or greeted us (which the client will see, in due time.)
+        self._selector.register(channel, EVENT_READ, self._spare_readable)
+        self._watched.add(channel)
+
+    def _spare_readable(self, channel, events):
+        self._unwatch(channel)
+        if not channel.recv_ready():
+            self._discard(channel)
+
+    def _unwatch(self, channel):
+        if channel in self._watched:
+            self._watched.remove(channel)
+            self._selector.unregister(channel)
+
+    def _discard(self, channel):
+        self._spares.remove(channel)
+        self.stats.spares = len(self._spares)
+        channel.close()
+
+    def _take_spare(self):
+        """
+        Return a usable spare channel (if any), discarding dead ones.
+        """
+        while self._spares:
+            channel = self._spares[0]
+            self._unwatch(channel)
+            if (
+                getattr(channel, 'closed', False)
+                or getattr(channel, 'eof_received', False)
+            ):
+                self._discard(channel)
+                continue
+            self._spares.pop(0)
+            self.stats.spares = len(self._spares)
+            return channel
+        return None
+
+    def _negotiate(self, sock, events):
+        handshake = self._handshakes[sock]
+        try:
+            data = sock.recv(4096)
+            if not data:
+                # Client gave up before getting anywhere.
+                self._drop(sock)
+                return
+            sock.sendall(handshake.feed(data))
+        except SOCKSError as e:
+            debug("Rejecting SOCKS client: {0}".format(e))
+            self._drop(sock, e.reply)
+            return
+        except socket.error as e:
+            if not _would_block(e):
+                self._drop(sock)
+            return
+        if handshake.address is None:
+            return
+        del self._handshakes[sock]
+        self._selector.unregister(sock)
+        try:
+            src_addr = sock.getpeername()
+        except socket.error:
+            # Client went away in the meantime.
+            sock.close()
+            return
+        self._open(sock, handshake.address, src_addr, handshake)
+
+    def _finish_socks(self, sock, handshake, channel, exc_info):
+        if channel is None:
+            # Not our error, but the client's: tell them (only).
+            msg = "Unable to open SOCKS channel to {0}:{1}: {2!r}"
+            debug(msg.format(
+                handshake.address[0], handshake.address[1], exc_info[1],
+            ))
+            self._hang_up(sock, handshake.reply(False))
+            return
+        try:
+            sock.sendall(handshake.reply(True))
+        except socket.error:
+            # Client went away in the meantime.
+            channel.close()
+            sock.close()
+            return
+        tunnel = self._tunnel(channel, sock)
+        # Eager clients may not have waited for our reply to start talking.
+        tunnel._to_channel = handshake.leftover
+        self._start(tunnel)
 
-        # All we have left to close is our own sock.
-        # TODO: use try/finally?
-        sock.close()
+    def _drop(self, sock, reply=b''):
+        """
+        Hang up on a SOCKS client mid-handshake, sending ``reply`` if any.
+        """
+        del self._handshakes[sock]
+        self._selector.unregister(sock)
+        self._hang_up(sock, reply)
+
+    @staticmethod
+    def _hang_up(sock, reply):
+        try:
+            if reply:
+                sock.sendall(reply)
+        except socket.error:
+            pass
+        finally:
+            sock.close()
+
+    def _tunnel(self, channel, sock):
+        return Tunnel(
+            channel=channel, sock=sock, stats=self.stats, **self.tunnel_kwargs
+        )
 
+    def _start(self, tunnel):
+        self.tunnels.append(tunnel)
+        self._call(tunnel, tunnel.start, self._selector)
 
-class Tunnel(ExceptionHandlingThread):
+
+class Tunnel(object):
     """
     Bidirectionally forward data between an SSH channel and local socket.
+
+    Tunnels don't run on their own: `start` registers both ends with a
+    selector, whose owner (a `TunnelManager`) calls back into the tunnel as
+    they become ready. Data is only read from one end once the other has
+    accepted everything read before, so a slow reader holds up its writer
+    instead of piling up data in memory.
+
+    When one end signals EOF, that is passed on to the other end (once all
+    data has been written to it); the tunnel closes itself once both ends
+    have done so.
     """
-    def __init__(self, channel, sock, finished):
+    def __init__(
+        self,
+        channel,
+        sock,
+        socket_chunk_size=32768,
+        channel_chunk_size=32768,
+        adaptive=False,
+        stats=None,
+    ):
+        """
+        :param channel: The `~paramiko.channel.Channel` to forward data over.
+
+        :param sock: The local socket to forward data from & to.
+
+        :param int socket_chunk_size:
+            Bytes read from ``sock`` at a time. Default: ``32768``.
+
+        :param int channel_chunk_size:
+            Bytes read from ``channel`` at a time. Default: ``32768``.
+
+        :param bool adaptive:
+            When ``True``, the chunk sizes above are just starting points:
+            each time a read fills its whole buffer, the next read's size
+            doubles (up to the channel's receive window), halving again (down
+            to the starting point) when reads come back mostly empty.
+            Additionally, each wakeup keeps reading for as long as data is
+            ready and the other end accepts it (up to a window's worth),
+            rather than reading once. This suits bulk transfers.
+            Default: ``False``.
+
+        :param stats:
+            A `TunnelStats` to also count this tunnel's traffic in, if any.
+        """
         self.channel = channel
         self.sock = sock
-        self.finished = finished
-        self.socket_chunk_size = 1024
-        self.channel_chunk_size = 1024
-        super(Tunnel, self).__init__()
+        self.socket_chunk_size = socket_chunk_size
+        self.channel_chunk_size = channel_chunk_size
+        self.adaptive = adaptive
+        self.stats = stats
+        #: This tunnel's own `Traffic`.
+        self.traffic = Traffic()
+        # When data last started waiting on the channel's send window.
+        self._stalled_since = None
+        self._stalled = 0.0
+        # Current read sizes (which only change when adaptive.)
+        self._socket_read_size = socket_chunk_size
+        self._channel_read_size = channel_chunk_size
+        #: Whether the tunnel has been closed.
+        self.closed = False
+        # Data read from one end, not yet accepted by the other.
+        self._to_channel = b''
+        self._to_sock = b''
+        # Whether each end has signaled EOF.
+        self._sock_eof = False
+        self._channel_eof = False
+        # Whether that EOF has been passed on to the other end.
+        self._channel_shut = False
+        self._sock_shut = False
+        self._selector = None
+        # Events each end is registered for.
+        self._events = {}
 
-    def _run(self):
+    def start(self, selector):
+        """
+        Switch both ends to non-blocking mode & register them with
+        ``selector``.
+        """
+        self._selector = selector
+        self.sock.setblocking(0)
+        self.channel.setblocking(0)
+        self._update()
+
+    @property
+    def blocked(self):
+        """
+        Whether data is waiting for the channel's send window to open up.
+
+        Paramiko offers nothing to wait on for that, so the manager calls
+        `flush` periodically while this is true.
+        """
+        return bool(self._to_channel) and not self.closed
+
+    @property
+    def stalled(self):
+        """
+        Total seconds data has spent waiting for the channel's send window.
+
+        A tunnel stalling for much of its lifetime is sending data faster
+        than the remote end (or the network in between) takes it in.
+        """
+        if self._stalled_since is None:
+            return self._stalled
+        return self._stalled + time.time() - self._stalled_since
+
+    def flush(self):
+        """
+        Retry writing data to the channel.
+        """
+        self._send_channel()
+        self._update()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._stall(False)
+        for end in list(self._events):
+            self._selector.unregister(end)
+        self._events = {}
         try:
-            empty_sock, empty_chan = None, None
-            while not self.finished.is_set():
-                r, w, x = select.select([self.sock, self.channel], [], [], 1)
-                if self.sock in r:
-                    empty_sock = self.read_and_write(
-                        self.sock, self.channel, self.socket_chunk_size
-                    )
-                if self.channel in r:
-                    empty_chan = self.read_and_write(
-                        self.channel, self.sock, self.channel_chunk_size
-                    )
-                if empty_sock or empty_chan:
-                    break
-        finally:
             self.channel.close()
+        finally:
             self.sock.close()
 
-    def read_and_write(self, reader, writer, chunk_size):
+    def on_sock(self, sock, events):
+        if events & EVENT_WRITE:
+            self._send_sock()
+        if events & EVENT_READ:
+            budget = self._budget()
+            while not (self._to_channel or self._sock_eof or self.closed):
+                size = self._socket_read_size
+                data = self.read(self.sock, size)
+                if data == b'':
+                    self._sock_eof = True
+                elif data:
+                    self._to_channel = data
+                    self._send_channel()
+                    self._socket_read_size = self._resize(
+                        size, len(data), self.socket_chunk_size,
+                    )
+                    budget -= len(data)
+                if not (data and self.adaptive and budget > 0):
+                    break
+        self._update()
+
+    def on_channel(self, channel, events):
+        budget = self._budget()
+        while not (self._to_sock or self._channel_eof or self.closed):
+            size = self._channel_read_size
+            data = self.read(self.channel, size)
+            if data == b'':
+                self._channel_eof = True
+            elif data:
+                self._to_sock = data
+                self._send_sock()
+                self._channel_read_size = self._resize(
+                    size, len(data), self.channel_chunk_size,
+                )
+                budget -= len(data)
+            if not (data and self.adaptive and budget > 0):
+                break
+        self._update()
+
+    def _budget(self):
+        """
+        Most bytes to read per direction & wakeup (and per read) when
+        adaptive: the channel's receive window.
+        """
+        window = getattr(self.channel, 'in_window_size', None)
+        if isinstance(window, int) and window > 0:
+            return window
+        return max_chunk_size
+
+    def _resize(self, size, received, base):
         """
-        Read ``chunk_size`` from ``reader``, writing result to ``writer``.
+        Return the size of the next read, after one of ``size`` bytes got
+        ``received`` bytes.
+        """
+        if not self.adaptive:
+            return size
+        if received >= size:
+            return max(min(size * 2, self._budget()), base)
+        if received < size // 4:
+            return max(size // 2, base)
+        return size
+
+    def read(self, reader, chunk_size):
+        """
+        Read up to ``chunk_size`` bytes from ``reader``.
 
-        Returns ``None`` if successful, or ``True`` if the read was empty.
+        Returns ``b''`` at EOF, or ``None`` if no data was ready after all.
         """
-        data = reader.recv(chunk_size)
-        if len(data) == 0:
-            return True
-        writer.sendall(data)
+        try:
+            return reader.recv(chunk_size)
+        # Channels time out, sockets raise EAGAIN.
+        except socket.timeout:
+            return None
+        except socket.error as e:
+            if _would_block(e):
+                return None
+            # Abrupt disconnects are just a rude form of EOF.
+            if _hung_up(e):
+                return b''
+            raise
+
+    def _send_channel(self):
+        while self._to_channel and self.channel.send_ready():
+            try:
+                sent = self.channel.send(self._to_channel)
+            except socket.timeout:
+                return
+            if not sent:
+                # The remote end closed its side; nobody's listening.
+                self._to_channel = b''
+                self._sock_eof = self._channel_shut = True
+                return
+            self._to_channel = self._to_channel[sent:]
+            self._count(sent=sent)
+
+    def _send_sock(self):
+        try:
+            sent = self.sock.send(self._to_sock)
+        except socket.error as e:
+            if _would_block(e):
+                return
+            if _hung_up(e):
+                # The local client went away; nothing left to forward to.
+                self.close()
+                return
+            raise
+        self._to_sock = self._to_sock[sent:]
+        self._count(received=sent)
+
+    def _count(self, sent=0, received=0):
+        for traffic in (self.traffic, self.stats):
+            if traffic is not None:
+                traffic.sent += sent
+                traffic.received += received
+
+    def _stall(self, stalled):
+        if stalled and self._stalled_since is None:
+            self._stalled_since = time.time()
+        elif not stalled and self._stalled_since is not None:
+            self._stalled += time.time() - self._stalled_since
+            self._stalled_since = None
+
+    def _update(self):
+        """
+        Pass on EOFs, close once done, and otherwise (re-)register both ends
+        for the events they now need to wait for.
+        """
+        if self.closed:
+            return
+        if self._sock_eof and not self._to_channel and not self._channel_shut:
+            self._channel_shut = True
+            self.channel.shutdown_write()
+        if self._channel_eof and not self._to_sock and not self._sock_shut:
+            self._sock_shut = True
+            try:
+                self.sock.shutdown(socket.SHUT_WR)
+            except socket.error:
+                # E.g. the other end already hung up entirely.
+                pass
+        if self._channel_shut and self._sock_shut:
+            self.close()
+            return
+        self._stall(bool(self._to_channel))
+        sock_events = 0
+        if not (self._sock_eof or self._to_channel):
+            sock_events |= EVENT_READ
+        if self._to_sock:
+            sock_events |= EVENT_WRITE
+        channel_events = 0
+        if not (self._channel_eof or self._to_sock):
+            channel_events |= EVENT_READ
+        self._register(self.sock, sock_events, self.on_sock)
+        self._register(self.channel, channel_events, self.on_channel)
+
+    def _register(self, end, events, handler):
+        current = self._events.get(end, 0)
+        if events == current:
+            return
+        if not events:
+            self._selector.unregister(end)
+            del self._events[end]
+        elif not current:
+            self._selector.register(end, events, handler)
+            self._events[end] = events
+        else:
+            self._selector.modify(end, events, handler)
+            self._events[end] = events
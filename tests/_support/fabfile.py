@@ -45,3 +45,8 @@ def mutate(c):
 @task
 def expect_mutation(c):
     assert c.foo == 'bar'
+
+
+@task
+def expect_max_workers(c):
+    assert c.config.group.max_workers == 5
@@ -0,0 +1,192 @@
+import os
+import socket
+import sys
+
+from invoke.vendor.six import StringIO
+from mock import patch, Mock
+from spec import Spec, eq_, ok_, raises, skip
+
+from fabric import Connection, Config
+from fabric.exceptions import GroupException
+
+
+# NOTE: fabric.aio uses Python 3.5+ syntax, so everything else here is
+# conditional upon being able to import it.
+if sys.version_info >= (3, 5):
+    import asyncio
+    from invoke.exceptions import UnexpectedExit
+    from fabric.aio import AsyncGroup
+
+
+class _FakeChannel(object):
+    """
+    Stand-in for a Paramiko channel with a real, selectable file descriptor.
+
+    Output is only handed out after `feed` is called (which also marks the
+    descriptor readable), mimicking a channel whose data arrives later.
+    """
+    def __init__(self, stdout=b'', stderr=b'', exited=0, ready=True):
+        self._read_fd, self._write_fd = os.pipe()
+        self.buffers = {'stdout': [], 'stderr': []}
+        self.exited = exited
+        self.closed = False
+        self.output = (stdout, stderr)
+        if ready:
+            self.feed()
+
+    def feed(self):
+        for name, data in zip(('stdout', 'stderr'), self.output):
+            self.buffers[name] = [data, b''] if data else [b'']
+        os.write(self._write_fd, b'!')
+
+    def _recv(self, name):
+        if not self.buffers[name]:
+            raise socket.timeout()
+        return self.buffers[name].pop(0)
+
+    def recv(self, nbytes):
+        return self._recv('stdout')
+
+    def recv_stderr(self, nbytes):
+        return self._recv('stderr')
+
+    def fileno(self):
+        return self._read_fd
+
+    def setblocking(self, value):
+        pass
+
+    def exit_status_ready(self):
+        return True
+
+    def recv_exit_status(self):
+        return self.exited
+
+    def close(self):
+        self.closed = True
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class AsyncGroup_(Spec):
+    def setup(self):
+        if sys.version_info < (3, 5):
+            skip()
+
+    class init:
+        def max_workers_defaults_to_None(self):
+            eq_(AsyncGroup('host').max_workers, None)
+
+        def max_workers_may_come_from_config(self):
+            config = Config(overrides={'group': {'max_workers': 3}})
+            eq_(AsyncGroup('host', config=config).max_workers, 3)
+
+        @raises(ValueError)
+        def max_workers_must_be_positive(self):
+            AsyncGroup('host', max_workers=0)
+
+    class run:
+        @patch('fabric.aio._start')
+        def returns_GroupResult_of_command_output(self, start):
+            channel = _FakeChannel(stdout=b'out\n', stderr=b'err\n')
+            start.return_value = channel
+            cxn = Connection('host')
+            result = _run(AsyncGroup.from_connections([cxn]).run(
+                'command', hide=True,
+            ))[cxn]
+            eq_(result.stdout, 'out\n')
+            eq_(result.stderr, 'err\n')
+            eq_(result.exited, 0)
+            eq_(result.command, 'command')
+            ok_(result.connection is cxn)
+            ok_(channel.closed)
+            start.assert_called_once_with(cxn, 'command', {})
+
+        @patch('fabric.aio._start')
+        def waits_for_output_to_arrive(self, start):
+            channel = _FakeChannel(stdout=b'later', ready=False)
+            start.return_value = channel
+            asyncio.get_event_loop().call_later(0.05, channel.feed)
+            cxn = Connection('host')
+            result = _run(AsyncGroup.from_connections([cxn]).run(
+                'command', hide=True,
+            ))
+            eq_(result[cxn].stdout, 'later')
+
+        @patch('sys.stdout', new_callable=StringIO)
+        @patch('fabric.aio._start')
+        def mirrors_output_unless_hidden(self, start, out):
+            start.side_effect = lambda *args: _FakeChannel(stdout=b'loud')
+            group = AsyncGroup('host')
+            _run(group.run('command'))
+            eq_(out.getvalue(), 'loud')
+            _run(group.run('command', hide='stdout'))
+            eq_(out.getvalue(), 'loud')
+
+        @patch('fabric.aio._start')
+        def passes_env_to_channel_setup(self, start):
+            start.return_value = _FakeChannel()
+            cxn = Connection('host')
+            _run(AsyncGroup.from_connections([cxn]).run(
+                'command', hide=True, env={'FOO': 'bar'},
+            ))
+            start.assert_called_once_with(cxn, 'command', {'FOO': 'bar'})
+
+        @patch('fabric.aio._start')
+        def nonzero_exit_raises_GroupException(self, start):
+            start.return_value = _FakeChannel(exited=1)
+            cxn = Connection('host')
+            try:
+                _run(AsyncGroup.from_connections([cxn]).run(
+                    'command', hide=True,
+                ))
+            except GroupException as e:
+                ok_(isinstance(e.result[cxn], UnexpectedExit))
+                eq_(e.result[cxn].result.exited, 1)
+            else:
+                assert False, "Did not raise GroupException!"
+
+        @patch('fabric.aio._start')
+        def warn_suppresses_nonzero_exit_errors(self, start):
+            start.return_value = _FakeChannel(exited=1)
+            cxn = Connection('host')
+            result = _run(AsyncGroup.from_connections([cxn]).run(
+                'command', hide=True, warn=True,
+            ))
+            eq_(result[cxn].exited, 1)
+
+        @raises(TypeError)
+        def rejects_unsupported_kwargs(self):
+            _run(AsyncGroup('host').run('command', pty=True))
+
+        @patch('fabric.aio._start')
+        def honors_max_workers(self, start):
+            active = []
+            peak = []
+            loop = asyncio.get_event_loop()
+
+            def fake_start(cxn, command, env):
+                channel = _FakeChannel(ready=False)
+                active.append(channel)
+                peak.append(len([x for x in active if not x.closed]))
+                loop.call_soon_threadsafe(loop.call_later, 0.01, channel.feed)
+                return channel
+            start.side_effect = fake_start
+            group = AsyncGroup('host1', 'host2', 'host3', max_workers=1)
+            _run(group.run('command', hide=True))
+            eq_(len(active), 3)
+            eq_(max(peak), 1)
+
+    class get_and_put:
+        def call_Connection_methods_in_executor(self):
+            for method in ('get', 'put'):
+                cxn = Connection('host')
+                setattr(cxn, method, Mock(return_value='transferred'))
+                group = AsyncGroup.from_connections([cxn])
+                result = _run(getattr(group, method)('a', 'b'))
+                eq_(result[cxn], 'transferred')
+                getattr(cxn, method).assert_called_once_with('a', 'b')
@@ -46,7 +46,22 @@ class Config_(Spec):
         eq_(c.sudo.prompt, "[sudo] password: ")
         eq_(c.sudo.password, None)
         eq_(c.connect_kwargs, {})
+        eq_(c.connection_pool.max_per_host, None)
         eq_(c.timeouts.connect, None)
+        eq_(c.transfer.window, None)
+        eq_(c.transfer.block_size, 32768)
+        eq_(c.transfer.protocol, "sftp")
+        eq_(c.transfer.checkpoint_size, 8388608)
+        eq_(c.transfer.memory_map, False)
+        eq_(c.transfer.retries, 0)
+        eq_(c.transfer.channels, 4)
+        eq_(c.transfer.channel_idle_timeout, 60)
+        eq_(c.tunnels.socket_chunk_size, 32768)
+        eq_(c.tunnels.channel_chunk_size, 32768)
+        eq_(c.tunnels.adaptive, False)
+        eq_(c.tunnels.stats_interval, 10)
+        eq_(c.tunnels.open_workers, 4)
+        eq_(c.tunnels.preopen, 0)
         eq_(c.ssh_config_path, None)
 
     def overrides_Invoke_default_for_replace_env(self):
@@ -1,44 +1,164 @@
-from itertools import chain, repeat
+from itertools import repeat
 from invoke.vendor.six import b
 import errno
 from os.path import join
+import pickle
+import select
 import socket
+import threading
 import time
 
 from spec import Spec, eq_, raises, ok_, skip
 from mock import patch, Mock, call, PropertyMock
 from paramiko.client import SSHClient, AutoAddPolicy
-from paramiko import SSHConfig
+from paramiko import ChannelException, SSHConfig
 
 from invoke.config import Config as InvokeConfig
 from invoke.exceptions import ThreadException
 
-from fabric.connection import Connection, Config
+from fabric.connection import Connection, Config, SFTPPool
+from fabric.tunnels import ChannelOpener
 from fabric.util import get_local_user
 
 from _util import support_path
 
 
-def _select_result(obj):
+class _SocketChannel(object):
     """
-    Return iterator/generator suitable for mocking a select.select() call.
+    Stand-in for a Paramiko channel, backed by one end of a socket pair.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def recv(self, count):
+        try:
+            return self.sock.recv(count)
+        except socket.error as e:
+            # Channels time out instead.
+            if e.errno == errno.EAGAIN:
+                raise socket.timeout()
+            raise
+
+    def recv_ready(self):
+        readable = select.select([self.sock], [], [], 0)[0]
+        if not readable:
+            return False
+        try:
+            return bool(self.sock.recv(1, socket.MSG_PEEK))
+        except socket.error:
+            return False
+
+    def send_ready(self):
+        return True
+
+    def send(self, data):
+        try:
+            return self.sock.send(data)
+        except socket.error as e:
+            if e.errno == errno.EAGAIN:
+                raise socket.timeout()
+            raise
+
+    def shutdown_write(self):
+        self.sock.shutdown(socket.SHUT_WR)
+
+    def close(self):
+        self.sock.close()
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _connect(port):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.settimeout(5)
+    return sock
+
+
+def _read_all(sock):
+    data = b''
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def _open_channels(Client, channels=None):
+    """
+    Make the mock transport open `_SocketChannel` instances.
 
-    Specifically one that has a single initial return value of ``obj``, and
-    then empty results thereafter.
+    ``channels`` gives the types of the channels opened, in order (exception
+    instances are raised instead.)
 
-    If ``obj`` is an exception, it will be used as the sole initial
-    ``side_effect`` (as opposed to a return value among tuples).
+    :returns:
+        The mock transport, and a list which fills up with the remote end
+        (socket) of each channel opened.
+    """
+    channels = iter(channels or repeat(_SocketChannel))
+    transport = Client.return_value.get_transport.return_value
+    remote_ends = []
+
+    def open_channel(kind, dest, src):
+        channel = next(channels)
+        if isinstance(channel, Exception):
+            raise channel
+        ours, theirs = socket.socketpair()
+        theirs.settimeout(5)
+        remote_ends.append(theirs)
+        return channel(ours)
+    transport.open_channel.side_effect = open_channel
+    return transport, remote_ends
+
+
+def _opener_threads():
+    return sum(
+        1 for x in threading.enumerate()
+        if x.name == ChannelOpener.thread_name
+    )
+
+
+def _forwarding_threads():
     """
-    # select.select() returns three N-tuples. Have it just act like a single
-    # read event happened, then quiet after. So chain a single-item iterable to
-    # a repeat(). (Mock has no built-in way to do this apparently.)
-    initial = [(obj,), tuple(), tuple()]
-    if (
-        isinstance(obj, Exception)
-        or (isinstance(obj, type) and issubclass(obj, Exception))
-    ):
-        initial = obj
-    return chain([initial], repeat([tuple(), tuple(), tuple()]))
+    Count live threads, other than those opening channels in the background.
+    """
+    return threading.active_count() - _opener_threads()
+
+
+def _eventually(check):
+    """
+    Wait for ``check()`` to become true, as another thread gets to it.
+    """
+    deadline = time.time() + 5
+    while not check():
+        if time.time() > deadline:
+            raise AssertionError("Timed out waiting for {0!r}!".format(check))
+        time.sleep(0.001)
+
+
+def _wait_for(items, count):
+    """
+    Wait for ``items`` to be filled with ``count`` values by another thread.
+    """
+    deadline = time.time() + 5
+    while len(items) < count:
+        if time.time() > deadline:
+            raise AssertionError("Only got {0} of {1}!".format(
+                len(items), count,
+            ))
+        time.sleep(0.001)
+    return items
 
 
 class Connection_(Spec):
@@ -873,6 +993,136 @@ class Connection_(Spec):
             second = cxn.sftp()
             ok_(second is sentinel1, err.format(second))
 
+    class sftp_pool:
+        def _pool(self, SSHClient, **kwargs):
+            client = SSHClient.return_value
+            client.open_sftp.side_effect = lambda: Mock()
+            cxn = Connection('host')
+            return cxn, SFTPPool(cxn, **kwargs)
+
+        @patch('fabric.connection.SSHClient')
+        def sized_by_config(self, SSHClient):
+            config = Config(overrides={
+                'transfer': {'channels': 3, 'channel_idle_timeout': 5},
+            })
+            pool = Connection('host', config=config).sftp_pool
+            eq_(pool.size, 3)
+            eq_(pool.idle_timeout, 5)
+
+        @raises(ValueError)
+        def size_must_be_positive(self):
+            SFTPPool(Mock(), size=0)
+
+        @patch('fabric.connection.SSHClient')
+        def first_lease_is_connections_own_channel(self, SSHClient):
+            cxn, pool = self._pool(SSHClient, size=2)
+            ok_(pool.acquire() is cxn.sftp())
+
+        @patch('fabric.connection.SSHClient')
+        def concurrent_leases_get_their_own_channels(self, SSHClient):
+            cxn, pool = self._pool(SSHClient, size=2)
+            first, second = pool.acquire(), pool.acquire()
+            ok_(first is not second)
+            eq_(len(pool), 2)
+
+        @patch('fabric.connection.SSHClient')
+        def extra_channels_open_the_connection(self, SSHClient):
+            cxn, pool = self._pool(SSHClient, size=2)
+            cxn._sftp = Mock()
+            pool.acquire()
+            pool.acquire()
+            ok_(SSHClient.return_value.connect.called)
+            eq_(SSHClient.return_value.open_sftp.call_count, 1)
+
+        @patch('fabric.connection.SSHClient')
+        def leased_channels_are_never_shared(self, SSHClient):
+            cxn, pool = self._pool(SSHClient, size=2)
+            first, second = pool.acquire(), pool.acquire()
+            ok_(first is not second)
+            ok_(pool.acquire(blocking=False) is None)
+            pool.release(first)
+            ok_(pool.acquire(blocking=False) is first)
+            eq_(SSHClient.return_value.open_sftp.call_count, 2)
+
+        @patch('fabric.connection.SSHClient')
+        def full_pool_waits_for_a_release(self, SSHClient):
+            cxn, pool = self._pool(SSHClient)
+            first = pool.acquire()
+            leased = []
+            waiter = threading.Thread(
+                target=lambda: leased.append(pool.acquire()),
+            )
+            waiter.start()
+            time.sleep(0.05)
+            eq_(leased, [])
+            pool.release(first)
+            waiter.join(5)
+            eq_(leased, [first])
+
+        @patch('fabric.connection.SSHClient')
+        def released_channels_are_reused(self, SSHClient):
+            cxn, pool = self._pool(SSHClient, size=2)
+            pool.acquire()
+            second = pool.acquire()
+            pool.release(second)
+            ok_(pool.acquire() is second)
+            eq_(SSHClient.return_value.open_sftp.call_count, 2)
+
+        @patch('fabric.connection.SSHClient')
+        def idle_extra_channels_expire(self, SSHClient):
+            cxn, pool = self._pool(SSHClient, size=2, idle_timeout=0)
+            first, second = pool.acquire(), pool.acquire()
+            pool.release(second)
+            pool.release(first)
+            time.sleep(0.01)
+            pool.prune()
+            second.close.assert_called_once_with()
+            ok_(not first.close.called)
+            eq_(len(pool), 1)
+
+        @patch('fabric.connection.SSHClient')
+        def broken_channels_are_discarded(self, SSHClient):
+            cxn, pool = self._pool(SSHClient)
+            first = pool.acquire()
+            pool.release(first, broken=True)
+            first.close.assert_called_once_with()
+            ok_(cxn._sftp is None)
+            ok_(pool.acquire() is not first)
+
+        @patch('fabric.connection.SSHClient')
+        @raises(ValueError)
+        def releasing_unknown_channels_is_an_error(self, SSHClient):
+            cxn, pool = self._pool(SSHClient)
+            pool.release(Mock())
+
+        def pickles_without_its_channels(self):
+            # E.g. for handing unopened connections to other processes.
+            cxn = Connection('host')
+            cxn.sftp_pool._channels.append(['channel', 0, None])
+            clone = pickle.loads(pickle.dumps(cxn))
+            eq_(len(clone.sftp_pool), 0)
+            ok_(clone.sftp_pool.connection is clone)
+
+        @patch('fabric.connection.SSHClient')
+        def releasing_after_close_is_harmless(self, SSHClient):
+            cxn, pool = self._pool(SSHClient, size=2)
+            first, second = pool.acquire(), pool.acquire()
+            pool.close()
+            pool.release(first)
+            pool.release(second, broken=True)
+            ok_(second.close.called)
+            ok_(not first.close.called)
+            ok_(pool.acquire() is first)
+
+        @patch('fabric.connection.SSHClient')
+        def close_closes_extra_channels(self, SSHClient):
+            cxn, pool = self._pool(SSHClient, size=2)
+            first, second = pool.acquire(), pool.acquire()
+            pool.close()
+            second.close.assert_called_once_with()
+            ok_(not first.close.called)
+            eq_(len(pool), 0)
+
     class get:
         @patch('fabric.connection.Transfer')
         def calls_Transfer_get(self, Transfer):
@@ -892,105 +1142,137 @@ class Connection_(Spec):
             Transfer.return_value.put.assert_called_with('meh')
 
     class forward_local:
-        @patch('fabric.tunnels.select')
-        @patch('fabric.tunnels.socket.socket')
-        @patch('fabric.connection.SSHClient')
-        def _forward_local(self, kwargs, Client, mocket, select):
-            # Tease out bits of kwargs for use in the mocking/expecting.
-            # But leave it alone for raw passthru to the API call itself.
-            # TODO: unhappy with how much this apes the real code & its sig...
-            local_port = kwargs['local_port']
-            remote_port = kwargs.get('remote_port', local_port)
-            local_host = kwargs.get('local_host', 'localhost')
-            remote_host = kwargs.get('remote_host', 'localhost')
-            # These aren't part of the real sig, but this is easier than trying
-            # to reconcile the mock decorators + optional-value kwargs. meh.
-            tunnel_exception = kwargs.pop('tunnel_exception', None)
-            listener_exception = kwargs.pop('listener_exception', False)
-            # Mock setup
-            client = Client.return_value
-            listener_sock = Mock(name='listener_sock')
-            if listener_exception:
-                listener_sock.bind.side_effect = listener_exception
-            data = b("Some data")
-            tunnel_sock = Mock(name='tunnel_sock', recv=lambda n: data)
-            local_addr = Mock()
-            transport = client.get_transport.return_value
-            channel = transport.open_channel.return_value
-            # socket.socket is only called once directly
-            mocket.return_value = listener_sock
-            # The 2nd socket is obtained via an accept() (which should only
-            # fire once & raise EAGAIN after)
-            listener_sock.accept.side_effect = chain(
-                [(tunnel_sock, local_addr)],
-                repeat(socket.error(errno.EAGAIN, "nothing yet")),
+        def _forward(self, Client, channels=None, config=None, **kwargs):
+            """
+            Set up forwarding of a free local port.
+
+            :returns:
+                The port, the mock transport, a list which fills up with the
+                remote end (socket) of each channel opened, and the
+                contextmanager.
+            """
+            transport, remote_ends = _open_channels(Client, channels)
+            port = _free_port()
+            cxn = Connection('host', config=config)
+            forward = cxn.forward_local(port, **kwargs)
+            return port, transport, remote_ends, forward
+
+        def _pump(self, Client, **kwargs):
+            """
+            Send 1 MiB from the remote end of a tunnel to its local client.
+
+            :returns: The sizes of each read from the channel.
+            """
+            sizes = []
+
+            class Recording(_SocketChannel):
+                def recv(self, count):
+                    sizes.append(count)
+                    return super(Recording, self).recv(count)
+            port, transport, remote_ends, forward = self._forward(
+                Client, channels=repeat(Recording), **kwargs
             )
-            obj = tunnel_sock if tunnel_exception is None else tunnel_exception
-            select.select.side_effect = _select_result(obj)
-            with Connection('host').forward_local(**kwargs):
-                # Make sure we give listener thread enough time to boot up :(
-                # Otherwise we might assert before it does things. (NOTE:
-                # doesn't need to be much, even at 0.01s, 0/100 trials failed
-                # (vs 45/100 with no sleep)
-                time.sleep(0.015)
-                eq_(client.connect.call_args[1]['hostname'], 'host')
-                listener_sock.setsockopt.assert_called_once_with(
-                    socket.SOL_SOCKET, socket.SO_REUSEADDR, 1
-                )
-                listener_sock.setblocking.assert_called_once_with(0)
-                listener_sock.bind.assert_called_once_with(
-                    (local_host, local_port)
+            data = b'x' * (1024 * 1024)
+            with forward:
+                client = _connect(port)
+                remote = _wait_for(remote_ends, 1)[0]
+                sender = threading.Thread(target=remote.sendall, args=(data,))
+                sender.start()
+                received = b''
+                while len(received) < len(data):
+                    received += client.recv(65536)
+                sender.join()
+                eq_(received, data)
+            return sizes
+
+        @patch('fabric.connection.SSHClient')
+        def forwards_local_port_to_remote_end(self, Client):
+            port, transport, remote_ends, forward = self._forward(
+                Client, remote_port=4321, remote_host='db',
+            )
+            with forward:
+                eq_(Client.return_value.connect.call_args[1]['hostname'], 'host') # noqa
+                client = _connect(port)
+                client.sendall(b'ping')
+                remote = _wait_for(remote_ends, 1)[0]
+                eq_(remote.recv(4), b'ping')
+                remote.sendall(b'pong')
+                eq_(client.recv(4), b'pong')
+                transport.open_channel.assert_called_once_with(
+                    'direct-tcpip', ('db', 4321), client.getsockname(),
                 )
-                if not listener_exception:
-                    listener_sock.listen.assert_called_once_with(1)
-                    transport.open_channel.assert_called_once_with(
-                        'direct-tcpip',
-                        (remote_host, remote_port),
-                        local_addr,
-                    )
-                # Local write to tunnel_sock is implied by its mocked-out
-                # recv() call above...
-                # NOTE: don't assert if explodey; we want to mimic "the only
-                # error that occurred was within the thread" behavior being
-                # tested by thread-exception-handling tests
-                if not (tunnel_exception or listener_exception):
-                    channel.sendall.assert_called_once_with(data)
-            # Shutdown, with another sleep because threads.
-            time.sleep(0.015)
-            if not listener_exception:
-                tunnel_sock.close.assert_called_once_with()
-                channel.close.assert_called_once_with()
-                listener_sock.close.assert_called_once_with()
-
-        def forwards_local_port_to_remote_end(self):
-            self._forward_local({'local_port': 1234})
-
-        def distinct_remote_port(self):
-            self._forward_local({
-                'local_port': 1234,
-                'remote_port': 4321,
-            })
+            # Shutdown closes both ends of the tunnel.
+            eq_(client.recv(4), b'')
+            eq_(remote.recv(4), b'')
 
-        def non_localhost_listener(self):
-            self._forward_local({
-                'local_port': 1234,
-                'local_host': 'nearby_local_host',
-            })
+        @patch('fabric.connection.SSHClient')
+        def remote_port_defaults_to_local_port(self, Client):
+            port, transport, remote_ends, forward = self._forward(Client)
+            with forward:
+                _connect(port)
+                _wait_for(remote_ends, 1)
+            eq_(transport.open_channel.call_args[0][1], ('localhost', port))
 
-        def non_remote_localhost_connection(self):
-            self._forward_local({
-                'local_port': 1234,
-                'remote_host': 'nearby_remote_host',
-            })
+        @patch('fabric.connection.SSHClient')
+        def passes_on_half_closes(self, Client):
+            port, transport, remote_ends, forward = self._forward(Client)
+            with forward:
+                client = _connect(port)
+                client.sendall(b'request')
+                client.shutdown(socket.SHUT_WR)
+                remote = _wait_for(remote_ends, 1)[0]
+                eq_(_read_all(remote), b'request')
+                remote.sendall(b'response')
+                remote.shutdown(socket.SHUT_WR)
+                eq_(_read_all(client), b'response')
+
+        @patch('fabric.connection.SSHClient')
+        def many_tunnels_share_one_thread(self, Client):
+            port, transport, remote_ends, forward = self._forward(Client)
+            threads = _forwarding_threads()
+            with forward:
+                clients = [_connect(port) for _ in range(20)]
+                for index, client in enumerate(clients):
+                    client.sendall(b(str(index).zfill(2)))
+                received = set(x.recv(2) for x in _wait_for(remote_ends, 20))
+                eq_(received, set(b(str(x).zfill(2)) for x in range(20)))
+                eq_(_forwarding_threads(), threads + 1)
+                ok_(_opener_threads() <= 4)
+
+        @patch('fabric.connection.SSHClient')
+        def moves_more_data_than_fits_in_socket_buffers(self, Client):
+            port, transport, remote_ends, forward = self._forward(Client)
+            data = b'x' * (4 * 1024 * 1024)
+            with forward:
+                client = _connect(port)
+                sender = threading.Thread(target=client.sendall, args=(data,))
+                sender.start()
+                remote = _wait_for(remote_ends, 1)[0]
+                received = b''
+                while len(received) < len(data):
+                    received += remote.recv(65536)
+                sender.join()
+                eq_(received, data)
 
-        def _thread_error(self, which):
+        @patch('fabric.connection.SSHClient')
+        def tunnel_errors_bubble_up(self, Client):
             class Sentinel(Exception):
                 pass
+
+            class Exploding(_SocketChannel):
+                def recv(self, count):
+                    raise Sentinel
+            port, transport, remote_ends, forward = self._forward(
+                Client, channels=[Exploding, _SocketChannel],
+            )
             try:
-                self._forward_local({
-                    'local_port': 1234,
-                    '{0}_exception'.format(which): Sentinel,
-                })
+                with forward:
+                    _connect(port)
+                    # Explode upon the channel becoming readable
+                    _wait_for(remote_ends, 1)[0].sendall(b'boom')
+                    # Other tunnels keep working.
+                    _connect(port).sendall(b'ping')
+                    eq_(_wait_for(remote_ends, 2)[1].recv(4), b'ping')
             except ThreadException as e:
                 # NOTE: ensures that we're getting what we expected and not
                 # some deeper, test-bug related error
@@ -999,44 +1281,369 @@ class Connection_(Spec):
                 err = "Expected wrapped exception to be Sentinel, was {0}"
                 ok_(inner.type is Sentinel, err.format(inner.type.__name__))
             else:
-                # no exception happened :( implies the thread went boom but
+                # no exception happened :( implies the tunnel went boom but
                 # nobody noticed
-                err = "Failed to get ThreadException on {0} error"
-                assert False, err.format(which)
+                assert False, "Failed to get ThreadException on tunnel error"
 
-        def tunnel_errors_bubble_up(self):
-            self._thread_error('tunnel')
+        @patch('fabric.connection.SSHClient')
+        def chunk_sizes_come_from_config(self, Client):
+            config = Config(overrides={'tunnels': {'channel_chunk_size': 999}})
+            sizes = self._pump(Client, config=config)
+            eq_(set(sizes), {999})
 
-        def tunnel_manager_errors_bubble_up(self):
-            self._thread_error('listener')
+        @patch('fabric.connection.SSHClient')
+        def chunk_sizes_may_be_given_per_forward(self, Client):
+            eq_(set(self._pump(Client, channel_chunk_size=1000)), {1000})
 
-        # TODO: these require additional refactoring of _forward_local to be
-        # more like the decorators in _util
-        def multiple_tunnels_can_be_open_at_once(self):
-            skip()
+        @patch('fabric.connection.SSHClient')
+        def adaptive_reads_grow_while_data_keeps_arriving(self, Client):
+            sizes = self._pump(Client, channel_chunk_size=1024, adaptive=True)
+            ok_(min(sizes) >= 1024)
+            ok_(max(sizes) > 1024)
+
+        @patch('fabric.connection.SSHClient')
+        @raises(ValueError)
+        def chunk_sizes_must_be_positive(self, Client):
+            with Connection('host').forward_local(1234, socket_chunk_size=0):
+                pass
+
+        @patch('fabric.tunnels.TunnelManager._listen')
+        @patch('fabric.connection.SSHClient')
+        def tunnel_manager_errors_bubble_up(self, Client, _listen):
+            class Sentinel(Exception):
+                pass
+            _listen.side_effect = Sentinel
+            try:
+                with Connection('host').forward_local(1234):
+                    pass
+            except ThreadException as e:
+                eq_(len(e.exceptions), 1)
+                ok_(e.exceptions[0].type is Sentinel)
+            else:
+                assert False, "Failed to get ThreadException on listener error" # noqa
+
+        @patch('fabric.connection.SSHClient')
+        def bind_errors_raise_before_the_body_runs(self, Client):
+            taken = socket.socket()
+            taken.bind(('localhost', 0))
+            taken.listen(1)
+            body = Mock()
+            try:
+                with Connection('host').forward_local(
+                    taken.getsockname()[1],
+                ):
+                    body()
+            except ThreadException as e:
+                eq_(len(e.exceptions), 1)
+                ok_(issubclass(e.exceptions[0].type, socket.error))
+            else:
+                assert False, "Failed to get ThreadException on bind error"
+            finally:
+                taken.close()
+            ok_(not body.called)
+
+        @patch('fabric.connection.SSHClient')
+        def channel_open_failures_only_affect_their_client(self, Client):
+            port, transport, remote_ends, forward = self._forward(
+                Client,
+                channels=[
+                    ChannelException(2, 'Connect failed'), _SocketChannel,
+                ],
+            )
+            try:
+                with forward as stats:
+                    eq_(_connect(port).recv(4), b'')
+                    _connect(port).sendall(b'ping')
+                    eq_(_wait_for(remote_ends, 1)[0].recv(4), b'ping')
+            except ThreadException as e:
+                eq_(len(e.exceptions), 1)
+                ok_(e.exceptions[0].type is ChannelException)
+            else:
+                assert False, "Failed to get ThreadException on open failure"
+            eq_(stats.failed, 1)
+            eq_(stats.opened, 1)
+
+        @patch('fabric.connection.SSHClient')
+        def opens_channels_concurrently(self, Client):
+            port, transport, remote_ends, forward = self._forward(Client)
+            # Each open only returns once three are underway at once.
+            underway = []
+            all_underway = threading.Event()
+            open_channel = transport.open_channel.side_effect
+
+            def slow_open_channel(*args):
+                underway.append(args)
+                if len(underway) == 3:
+                    all_underway.set()
+                all_underway.wait(5)
+                return open_channel(*args)
+            transport.open_channel.side_effect = slow_open_channel
+            with forward:
+                clients = [_connect(port) for _ in range(3)]
+                for client in clients:
+                    client.sendall(b'ping')
+                for remote in _wait_for(remote_ends, 3):
+                    eq_(remote.recv(4), b'ping')
+            ok_(all_underway.is_set())
+
+        @patch('fabric.connection.SSHClient')
+        def slow_channel_opens_dont_hold_up_other_tunnels(self, Client):
+            port, transport, remote_ends, forward = self._forward(Client)
+            release = threading.Event()
+            open_channel = transport.open_channel.side_effect
+
+            def open_channel_once_released(*args):
+                if remote_ends:
+                    release.wait(5)
+                return open_channel(*args)
+            transport.open_channel.side_effect = open_channel_once_released
+            with forward:
+                client = _connect(port)
+                remote = _wait_for(remote_ends, 1)[0]
+                # This one's channel won't open until we say so...
+                _connect(port)
+                _eventually(lambda: transport.open_channel.call_count == 2)
+                # ...but the first tunnel carries on regardless.
+                client.sendall(b'ping')
+                eq_(remote.recv(4), b'ping')
+                release.set()
+
+        @patch('fabric.connection.SSHClient')
+        def preopens_channels_for_new_clients(self, Client):
+            port, transport, remote_ends, forward = self._forward(
+                Client, preopen=2,
+            )
+            with forward as stats:
+                _eventually(lambda: stats.spares == 2)
+                spares = list(_wait_for(remote_ends, 2))
+                client = _connect(port)
+                client.sendall(b'ping')
+                eq_(spares[0].recv(4), b'ping')
+                # The spare used up gets replaced.
+                _wait_for(remote_ends, 3)
+                _eventually(lambda: stats.spares == 2)
+            # Spares were opened on behalf of the listening socket.
+            eq_(
+                transport.open_channel.call_args_list[0][0],
+                ('direct-tcpip', ('localhost', port), ('127.0.0.1', port)),
+            )
+            eq_(stats.opened, 3)
+            # And closed on exit, used or not.
+            for remote in remote_ends:
+                eq_(remote.recv(4), b'')
+
+        @patch('fabric.connection.SSHClient')
+        def spares_closed_by_the_remote_end_are_dropped(self, Client):
+            port, transport, remote_ends, forward = self._forward(
+                Client, preopen=1,
+            )
+            with forward as stats:
+                _eventually(lambda: stats.spares == 1)
+                _wait_for(remote_ends, 1)[0].close()
+                _eventually(lambda: stats.spares == 0)
+                _connect(port).sendall(b'ping')
+                eq_(_wait_for(remote_ends, 2)[1].recv(4), b'ping')
+
+        @patch('fabric.connection.SSHClient')
+        def spares_with_data_waiting_are_kept(self, Client):
+            # E.g. for protocols where the server speaks first.
+            port, transport, remote_ends, forward = self._forward(
+                Client, preopen=1,
+            )
+            with forward as stats:
+                _eventually(lambda: stats.spares == 1)
+                _wait_for(remote_ends, 1)[0].sendall(b'hello')
+                time.sleep(0.01)
+                eq_(_connect(port).recv(5), b'hello')
+
+        @patch('fabric.connection.SSHClient')
+        @raises(ValueError)
+        def open_workers_must_be_positive(self, Client):
+            with Connection('host').forward_local(1234, open_workers=0):
+                pass
+
+        @patch('fabric.connection.SSHClient')
+        def yields_traffic_stats(self, Client):
+            port, transport, remote_ends, forward = self._forward(Client)
+            with forward as stats:
+                client = _connect(port)
+                client.sendall(b'ping')
+                remote = _wait_for(remote_ends, 1)[0]
+                eq_(remote.recv(4), b'ping')
+                remote.sendall(b'pong!')
+                eq_(client.recv(5), b'pong!')
+                tunnel = stats.tunnels[0]
+            eq_(stats.sent, 4)
+            eq_(stats.received, 5)
+            eq_((tunnel.traffic.sent, tunnel.traffic.received), (4, 5))
+            eq_(stats.opened, 1)
+            eq_(stats.failed, 0)
+            eq_(stats.open_latency.count, 1)
+            # Closed tunnels are no longer listed, but still counted.
+            eq_(stats.active, 0)
+
+        @patch('fabric.connection.SSHClient')
+        def calls_stats_callback_periodically(self, Client):
+            reports = []
+            port, transport, remote_ends, forward = self._forward(
+                Client, stats_callback=reports.append, stats_interval=0.01,
+            )
+            with forward as stats:
+                _connect(port).sendall(b'ping')
+                _wait_for(remote_ends, 1)[0].recv(4)
+                _wait_for(reports, 3)
+            ok_(all(x is stats for x in reports))
+            ok_(stats.recent_sent_rate is not None)
+
+        @patch('fabric.connection.SSHClient')
+        def stats_callback_errors_bubble_up(self, Client):
+            class Sentinel(Exception):
+                pass
+            calls = []
+
+            def callback(stats):
+                calls.append(stats)
+                raise Sentinel
+            port, transport, remote_ends, forward = self._forward(
+                Client, stats_callback=callback, stats_interval=0.01,
+            )
+            try:
+                with forward:
+                    _wait_for(calls, 1)
+                    time.sleep(0.05)
+            except ThreadException as e:
+                ok_(e.exceptions[0].type is Sentinel)
+            else:
+                assert False, "Failed to get ThreadException on callback error" # noqa
+            # No further calls after the first error.
+            eq_(len(calls), 1)
+
+        @patch('fabric.connection.SSHClient')
+        @raises(ValueError)
+        def stats_interval_must_be_positive(self, Client):
+            with Connection('host').forward_local(1234, stats_interval=0):
+                pass
+
+    class forward_dynamic:
+        def _forward(self, Client, channels=None):
+            """
+            Set up a SOCKS proxy on a free local port.
+
+            :returns:
+                The port, the mock transport, a list which fills up with the
+                remote end (socket) of each channel opened, and the
+                contextmanager.
+            """
+            transport, remote_ends = _open_channels(Client, channels)
+            port = _free_port()
+            forward = Connection('host').forward_dynamic(port)
+            return port, transport, remote_ends, forward
+
+        def _socks5(self, port, host=b'app1', dest_port=80):
+            client = _connect(port)
+            client.sendall(b'\x05\x01\x00')
+            eq_(client.recv(2), b'\x05\x00')
+            client.sendall(
+                b'\x05\x01\x00\x03' + bytes(bytearray([len(host)])) + host
+                + bytes(bytearray([dest_port >> 8, dest_port & 0xff]))
+            )
+            return client
+
+        @patch('fabric.connection.SSHClient')
+        def connects_socks5_clients_to_requested_destination(self, Client):
+            port, transport, remote_ends, forward = self._forward(Client)
+            with forward:
+                client = self._socks5(port, b'app1', 8080)
+                eq_(client.recv(10), b'\x05\x00\x00\x01' + b'\x00' * 6)
+                client.sendall(b'ping')
+                remote = _wait_for(remote_ends, 1)[0]
+                eq_(remote.recv(4), b'ping')
+                remote.sendall(b'pong')
+                eq_(client.recv(4), b'pong')
+                transport.open_channel.assert_called_once_with(
+                    'direct-tcpip', ('app1', 8080), client.getsockname(),
+                )
+            # Shutdown closes both ends of the tunnel.
+            eq_(client.recv(4), b'')
+            eq_(remote.recv(4), b'')
+
+        @patch('fabric.connection.SSHClient')
+        def connects_socks4a_clients_sending_data_early(self, Client):
+            port, transport, remote_ends, forward = self._forward(Client)
+            with forward:
+                client = _connect(port)
+                client.sendall(
+                    b'\x04\x01\x00\x50\x00\x00\x00\x01me\x00app2\x00ping'
+                )
+                eq_(client.recv(8), b'\x00\x5a' + b'\x00' * 6)
+                eq_(_wait_for(remote_ends, 1)[0].recv(4), b'ping')
+                eq_(transport.open_channel.call_args[0][1], ('app2', 80))
+
+        @patch('fabric.connection.SSHClient')
+        def unreachable_destinations_only_fail_their_request(self, Client):
+            port, transport, remote_ends, forward = self._forward(
+                Client,
+                channels=[
+                    ChannelException(2, 'Connect failed'), _SocketChannel,
+                ],
+            )
+            # No ThreadException on exit: refusals are the client's business.
+            with forward:
+                client = self._socks5(port, b'down')
+                eq_(client.recv(10), b'\x05\x01\x00\x01' + b'\x00' * 6)
+                eq_(client.recv(4), b'')
+                self._socks5(port, b'up').sendall(b'ping')
+                eq_(_wait_for(remote_ends, 1)[0].recv(4), b'ping')
+
+        @patch('fabric.connection.SSHClient')
+        def rejects_clients_requiring_authentication(self, Client):
+            port, transport, remote_ends, forward = self._forward(Client)
+            with forward:
+                client = _connect(port)
+                # Username/password only.
+                client.sendall(b'\x05\x01\x02')
+                eq_(client.recv(2), b'\x05\xff')
+                eq_(client.recv(2), b'')
+            ok_(not transport.open_channel.called)
+
+        @patch('fabric.connection.SSHClient')
+        def closes_clients_mid_handshake_on_exit(self, Client):
+            port, transport, remote_ends, forward = self._forward(Client)
+            with forward:
+                client = _connect(port)
+                client.sendall(b'\x05\x01\x00')
+                eq_(client.recv(2), b'\x05\x00')
+            eq_(client.recv(2), b'')
+
+        @patch('fabric.connection.SSHClient')
+        def many_clients_share_one_thread(self, Client):
+            port, transport, remote_ends, forward = self._forward(Client)
+            threads = _forwarding_threads()
+            with forward:
+                clients = [self._socks5(port) for _ in range(20)]
+                for index, client in enumerate(clients):
+                    client.recv(10)
+                    client.sendall(b(str(index).zfill(2)))
+                received = set(x.recv(2) for x in _wait_for(remote_ends, 20))
+                eq_(received, set(b(str(x).zfill(2)) for x in range(20)))
+                eq_(_forwarding_threads(), threads + 1)
+                ok_(_opener_threads() <= 4)
 
     class forward_remote:
-        @patch('fabric.connection.socket.socket')
-        @patch('fabric.tunnels.select')
-        @patch('fabric.connection.SSHClient')
-        def _forward_remote(self, kwargs, Client, select, mocket):
-            # TODO: unhappy with how much this duplicates of the code under
-            # test, re: sig/default vals
-            # Set up parameter values/defaults
-            remote_port = kwargs['remote_port']
+        @patch('fabric.connection.SSHClient')
+        def _forward_remote(self, kwargs, Client):
+            # A local server for the forward to connect to.
+            server = socket.socket()
+            server.bind(('127.0.0.1', 0))
+            server.listen(5)
+            server.settimeout(5)
+            port = server.getsockname()[1]
+            kwargs['local_host'] = '127.0.0.1'
+            if kwargs.setdefault('remote_port', port) != port:
+                kwargs['local_port'] = port
             remote_host = kwargs.get('remote_host', '127.0.0.1')
-            local_port = kwargs.get('local_port', remote_port)
-            local_host = kwargs.get('local_host', 'localhost')
-            # Mock/etc setup, anything that can be prepped before the forward
-            # occurs (which is most things)
-            tun_socket = mocket.return_value
             cxn = Connection('host')
-            # Channel that will yield data when read from
-            chan = Mock()
-            chan.recv.return_value = "data"
-            # And make select() yield it as being ready once, when called
-            select.select.side_effect = _select_result(chan)
-            with cxn.forward_remote(**kwargs):
+            with cxn.forward_remote(**kwargs) as stats:
                 # At this point Connection.open() has run and generated a
                 # Transport mock for us (because SSHClient is mocked). Let's
                 # first make sure we asked it for the port forward...
@@ -1046,56 +1653,68 @@ class Connection_(Spec):
                 # _parse_channel_open() and suchlike :(
                 call = cxn.transport.request_port_forward.call_args_list[0]
                 eq_(call[1]['address'], remote_host)
-                eq_(call[1]['port'], remote_port)
-                # Pretend the Transport called our callback with mock Channel
-                call[1]['handler'](chan, tuple(), tuple())
-                # Then have to sleep a bit to make sure we give the tunnel
-                # created by that callback to spin up; otherwise ~5% of the
-                # time we exit the contextmanager so fast, the tunnel's "you're
-                # done!" flag is set before it even gets a chance to select()
-                # once.
-                time.sleep(0.01)
-                # And make sure we hooked up to the local socket OK
-                tup = (local_host, local_port)
-                tun_socket.connect.assert_called_once_with(tup)
-            # Expect that our socket got written to by the tunnel (due to the
-            # above-setup select() and channel mocking). Need to do this after
-            # tunnel shutdown or we risk thread ordering issues.
-            tun_socket.sendall.assert_called_once_with("data")
-            # Ensure we closed down the mock socket
-            mocket.return_value.close.assert_called_once_with()
+                eq_(call[1]['port'], kwargs['remote_port'])
+                # Pretend the Transport called our callback with a channel
+                ours, theirs = socket.socketpair()
+                theirs.settimeout(5)
+                call[1]['handler'](_SocketChannel(ours), tuple(), tuple())
+                # And make sure we hooked up to the local server OK
+                local, _ = server.accept()
+                local.settimeout(5)
+                theirs.sendall(b'data')
+                eq_(local.recv(4), b'data')
+                local.sendall(b'back')
+                eq_(theirs.recv(4), b'back')
+            server.close()
+            # Ensure we closed down the tunnel
+            eq_(local.recv(4), b'')
+            eq_(theirs.recv(4), b'')
             # And that the transport canceled the port forward on the remote
             # end.
             eq_(cxn.transport.cancel_port_forward.call_count, 1)
+            # Connecting to the local port counts as opening the tunnel.
+            eq_((stats.opened, stats.open_latency.count), (1, 1))
+            eq_((stats.sent, stats.received), (4, 4))
 
         def forwards_remote_port_to_local_end(self):
-            self._forward_remote({'remote_port': 1234})
+            self._forward_remote({})
 
         def distinct_local_port(self):
-            self._forward_remote({
-                'remote_port': 1234,
-                'local_port': 4321,
-            })
-
-        def non_localhost_connections(self):
-            self._forward_remote({
-                'remote_port': 1234,
-                'local_host': 'nearby_local_host',
-            })
+            self._forward_remote({'remote_port': 1234})
 
         def remote_non_localhost_listener(self):
-            self._forward_remote({
-                'remote_port': 1234,
-                'remote_host': '192.168.1.254',
-            })
+            self._forward_remote({'remote_host': '192.168.1.254'})
 
-        # TODO: these require additional refactoring of _forward_remote to be
-        # more like the decorators in _util
-        def multiple_tunnels_can_be_open_at_once(self):
-            skip()
+        @patch('fabric.connection.SSHClient')
+        def tunnel_manager_errors_bubble_up(self, Client):
+            class Sentinel(Exception):
+                pass
 
-        def tunnel_errors_bubble_up(self):
-            skip()
+            def explode(stats):
+                raise Sentinel
+            cxn = Connection('host')
+            try:
+                with cxn.forward_remote(
+                    1234,
+                    local_port=_free_port(),
+                    stats_callback=explode,
+                    stats_interval=0.01,
+                ):
+                    time.sleep(0.1)
+            except ThreadException as e:
+                eq_(len(e.exceptions), 1)
+                ok_(e.exceptions[0].type is Sentinel)
+            else:
+                assert False, "Failed to get ThreadException on callback error" # noqa
+            # The forward is still cancelled.
+            eq_(cxn.transport.cancel_port_forward.call_count, 1)
 
-        def listener_errors_bubble_up(self):
-            skip()
+        @patch('fabric.connection.SSHClient')
+        def channels_arriving_after_shutdown_are_closed(self, Client):
+            cxn = Connection('host')
+            with cxn.forward_remote(1234, local_port=_free_port()):
+                handler = cxn.transport.request_port_forward.call_args[1]['handler'] # noqa
+            channel = Mock()
+            with patch('fabric.connection.socket.socket'):
+                handler(channel, tuple(), tuple())
+            channel.close.assert_called_once_with()
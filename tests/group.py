@@ -1,9 +1,24 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from invoke.exceptions import ThreadException
+from invoke.util import ExceptionHandlingThread
+from invoke.vendor.six.moves.queue import Queue
+
+from invoke.vendor.six import StringIO
 from mock import Mock, patch, call
 from spec import Spec, eq_, ok_, raises
 
-from fabric import Connection, Group, SerialGroup, ThreadingGroup, GroupResult
-from fabric.group import thread_worker
+from fabric import (
+    Config, Connection, ConnectionPool, Group, SerialGroup, ThreadingGroup,
+    ProcessPoolGroup, GroupResult, Result,
+)
+from fabric.group import thread_worker, pool_worker, process_worker
 from fabric.exceptions import GroupException
+from fabric.transfer import Result as TransferResult
 
 
 class Group_(Spec):
@@ -17,6 +32,75 @@ class Group_(Spec):
             eq_(g[0].host, 'foo')
             eq_(g[1].host, 'bar')
 
+        def passes_kwargs_to_Connection(self):
+            g = Group('foo', 'bar', user='admin')
+            eq_(g[0].user, 'admin')
+            eq_(g[1].user, 'admin')
+
+        def may_draw_connections_from_a_pool(self):
+            pool = ConnectionPool()
+            cxn = pool.acquire('foo')
+            pool.release(cxn)
+            g = Group('foo', 'bar', pool=pool)
+            ok_(g[0] is cxn)
+            ok_(g.pool is pool)
+            eq_(len(pool), 2)
+
+        def acquires_repeated_hosts_from_a_pool_once(self):
+            pool = ConnectionPool(max_per_host=1)
+            groups = []
+            # Leasing 'foo' twice would wait forever on ourselves.
+            builder = threading.Thread(target=lambda: groups.append(
+                Group('foo', 'bar', 'foo', pool=pool),
+            ))
+            builder.daemon = True
+            builder.start()
+            builder.join(5)
+            ok_(groups, "Group blocked on its own lease!")
+            eq_([x.host for x in groups[0]], ['foo', 'bar'])
+            eq_(len(pool), 2)
+
+        def releases_leases_if_acquiring_fails(self):
+            pool = ConnectionPool(max_per_host=1)
+            acquire = pool.acquire
+
+            def flaky(host, **kwargs):
+                if host == 'bar':
+                    raise RuntimeError("nope")
+                return acquire(host, **kwargs)
+            pool.acquire = flaky
+            try:
+                Group('foo', 'bar', pool=pool)
+            except RuntimeError:
+                pass
+            else:
+                assert False, "Did not raise RuntimeError!"
+            # 'foo' went back into the pool, so it's free to lease again.
+            ok_(acquire('foo', timeout=1).host == 'foo')
+
+    class close:
+        def closes_member_connections(self):
+            cxns = [Mock(), Mock()]
+            Group.from_connections(cxns).close()
+            for cxn in cxns:
+                cxn.close.assert_called_once_with()
+
+        def releases_pooled_connections_instead(self):
+            pool = ConnectionPool()
+            g = Group('foo', 'bar', pool=pool)
+            for cxn in g:
+                cxn.close = Mock()
+            g.close()
+            for cxn in g:
+                ok_(not cxn.close.called)
+            ok_(pool.acquire('foo') is g[0])
+
+        def works_as_contextmanager(self):
+            cxn = Mock()
+            with Group.from_connections([cxn]):
+                pass
+            cxn.close.assert_called_once_with()
+
     class from_connections:
         def inits_from_iterable_of_Connections(self):
             g = Group.from_connections((Connection('foo'), Connection('bar')))
@@ -36,6 +120,153 @@ class Group_(Spec):
         def not_implemented_in_base_class(self):
             Group().run()
 
+    class run_iter:
+        @raises(NotImplementedError)
+        def not_implemented_in_base_class(self):
+            next(Group().run_iter())
+
+    class get:
+        @raises(NotImplementedError)
+        def not_implemented_in_base_class(self):
+            Group('host').get('file')
+
+        def defaults_local_path_to_per_host_directories(self):
+            cxns = [Mock(name=x) for x in ('host1', 'host2')]
+            SerialGroup.from_connections(cxns).get('/var/log/syslog')
+            for cxn in cxns:
+                cxn.get.assert_called_once_with(
+                    '/var/log/syslog', local=os.path.join('{host}', 'syslog'),
+                )
+
+        def single_connection_keeps_Transfer_default(self):
+            cxn = Mock(name='host1')
+            SerialGroup.from_connections([cxn]).get('file')
+            cxn.get.assert_called_once_with('file', local=None)
+
+        @raises(ValueError)
+        def refuses_to_clobber_one_local_path(self):
+            Group('host1', 'host2').get('file', 'file')
+
+        def allows_templated_local_paths(self):
+            cxns = [Connection(x) for x in ('host1', 'host2')]
+            for cxn in cxns:
+                cxn.get = Mock()
+            SerialGroup.from_connections(cxns).get('file', 'x-{host}')
+            for cxn in cxns:
+                cxn.get.assert_called_once_with('file', local='x-{host}')
+
+        @raises(ValueError)
+        def refuses_shared_file_like_objects(self):
+            Group('host1', 'host2').get('file', StringIO())
+
+    class put:
+        @raises(NotImplementedError)
+        def not_implemented_in_base_class(self):
+            Group('host').put('file')
+
+        def gives_each_connection_own_copy_of_file_like_objects(self):
+            cxns = [Mock(name=x) for x in ('host1', 'host2')]
+            received = []
+
+            def put(local, remote):
+                received.append(local)
+                return local.read()
+            for cxn in cxns:
+                cxn.put.side_effect = put
+            fd = StringIO(u"contents")
+            fd.seek(3)
+            result = ThreadingGroup.from_connections(cxns).put(fd, 'remote')
+            eq_(fd.tell(), 3)
+            eq_(set(result.values()), set([u"contents"]))
+            ok_(received[0] is not received[1])
+
+    class broadcast:
+        def setup(self):
+            fd, self.local = tempfile.mkstemp()
+            os.write(fd, b'data')
+            os.close(fd)
+            os.chmod(self.local, 0o640)
+            self.cxns = [Mock(name='host{0}'.format(x)) for x in range(7)]
+            for cxn in self.cxns:
+                cxn.put.return_value = Mock(remote='/abs/remote')
+            self.relays = []
+
+        def teardown(self):
+            os.remove(self.local)
+
+        def _relay(self, source, targets, remote, digest, mode, timeout):
+            self.relays.append((source, list(targets)))
+            eq_(remote, '/abs/remote')
+            eq_(digest, hashlib.sha256(b'data').hexdigest())
+            eq_(mode, 0o640)
+            return [4] * len(targets)
+
+        @patch('fabric.group.relay')
+        def uploads_to_seeds_and_relays_to_others_in_rounds(self, relay):
+            relay.side_effect = self._relay
+            c = self.cxns
+            result = Group.from_connections(c).broadcast(
+                self.local, 'remote', fanout=2,
+            )
+            c[0].put.assert_called_once_with(
+                self.local, 'remote', preserve_mode=True,
+            )
+            for cxn in c[1:]:
+                ok_(not cxn.put.called)
+            eq_(sorted(self.relays, key=lambda x: c.index(x[1][0])), [
+                (c[0], [c[1], c[2]]),
+                (c[0], [c[3], c[4]]),
+                (c[1], [c[5], c[6]]),
+            ])
+            eq_(set(result), set(c))
+            eq_(result[c[6]].size, 4)
+            ok_(result[c[6]].connection is c[6])
+
+        @patch('fabric.group.relay')
+        def may_use_several_seeds(self, relay):
+            relay.side_effect = self._relay
+            c = self.cxns
+            Group.from_connections(c).broadcast(
+                self.local, 'remote', seeds=3, fanout=1,
+            )
+            eq_(sum(x.put.call_count for x in c), 3)
+            eq_([x[0] for x in self.relays].count(c[0]), 2)
+
+        @patch('fabric.group.relay')
+        def failed_copies_are_not_relayed_from(self, relay):
+            def fail_one(source, targets, *args):
+                self.relays.append((source, list(targets)))
+                return [IOError('nope') if x is self.cxns[1] else 4 for x in targets] # noqa
+            relay.side_effect = fail_one
+            try:
+                Group.from_connections(self.cxns[:4]).broadcast(
+                    self.local, 'remote', fanout=1,
+                )
+            except GroupException as e:
+                ok_(isinstance(e.result[self.cxns[1]], IOError))
+                eq_(e.result[self.cxns[3]].size, 4)
+            else:
+                assert False, "Did not raise GroupException!"
+            for source, _ in self.relays:
+                ok_(source is not self.cxns[1])
+
+        @patch('fabric.group.relay')
+        def seed_failure_fails_everything(self, relay):
+            self.cxns[0].put.side_effect = IOError('nope')
+            try:
+                Group.from_connections(self.cxns[:3]).broadcast(
+                    self.local, 'remote',
+                )
+            except GroupException as e:
+                eq_(len(e.result.failed), 3)
+            else:
+                assert False, "Did not raise GroupException!"
+            ok_(not relay.called)
+
+        @raises(ValueError)
+        def rejects_file_like_objects(self):
+            Group('host').broadcast(StringIO(), 'remote')
+
 
 def _make_serial_tester(cxns, index, args, kwargs):
     args = args[:]
@@ -103,6 +334,66 @@ class SerialGroup_(Spec):
             eq_(result.succeeded, expected)
             eq_(result.failed, {})
 
+    class run_iter:
+        def yields_connection_result_pairs_in_order(self):
+            cxns = [Mock(name=x) for x in ('host1', 'host2')]
+            g = SerialGroup.from_connections(cxns)
+            eq_(
+                list(g.run_iter("command", hide=True)),
+                [(x, x.run.return_value) for x in cxns],
+            )
+            for cxn in cxns:
+                cxn.run.assert_called_once_with("command", hide=True)
+
+        def is_lazy(self):
+            cxns = [Mock(name=x) for x in ('host1', 'host2')]
+            results = SerialGroup.from_connections(cxns).run_iter("command")
+            next(results)
+            ok_(not cxns[1].run.called)
+
+        def yields_exceptions_instead_of_raising(self):
+            cxns = [Mock(name=x) for x in ('host1', 'host2')]
+            onoz = Exception("onoz")
+            cxns[0].run.side_effect = onoz
+            g = SerialGroup.from_connections(cxns)
+            eq_(
+                list(g.run_iter("command")),
+                [(cxns[0], onoz), (cxns[1], cxns[1].run.return_value)],
+            )
+
+
+class SerialGroup_transfers(Spec):
+    def put_and_get_call_Connection_methods_in_order(self):
+        for method in ('put', 'get'):
+            cxns = [Mock(name=x) for x in ('host1', 'host2')]
+            calls = []
+            for cxn in cxns:
+                getattr(cxn, method).side_effect = \
+                    lambda *a, **k: calls.append(len(calls)) or len(calls)
+            g = SerialGroup.from_connections(cxns)
+            result = getattr(g, method)('a', '{host}/b')
+            eq_(calls, [0, 1])
+            eq_([result[x] for x in cxns], [1, 2])
+
+    def failures_raise_GroupException(self):
+        cxns = [Mock(name=x) for x in ('host1', 'host2')]
+        onoz = IOError("onoz")
+        cxns[0].put.side_effect = onoz
+        try:
+            SerialGroup.from_connections(cxns).put('file')
+        except GroupException as e:
+            eq_(e.result.failed, {cxns[0]: onoz})
+            ok_(cxns[1].put.called)
+        else:
+            assert False, "Did not raise GroupException!"
+
+
+def _slow_run(delay, value):
+    def run(*args, **kwargs):
+        time.sleep(delay)
+        return value
+    return run
+
 
 class ThreadingGroup_(Spec):
     def setup(self):
@@ -110,6 +401,34 @@ class ThreadingGroup_(Spec):
         self.args = ("command",)
         self.kwargs = {'hide': True, 'warn': True}
 
+    class init:
+        "__init__"
+        def max_workers_defaults_to_None(self):
+            eq_(ThreadingGroup('host1').max_workers, None)
+
+        def accepts_max_workers(self):
+            eq_(ThreadingGroup('host1', max_workers=4).max_workers, 4)
+
+        def max_workers_honors_given_config(self):
+            config = Config(overrides={'group': {'max_workers': 3}})
+            g = ThreadingGroup('host1', config=config)
+            eq_(g.max_workers, 3)
+            ok_(g[0].config is config)
+
+        def explicit_max_workers_wins_over_config(self):
+            config = Config(overrides={'group': {'max_workers': 3}})
+            g = ThreadingGroup('host1', config=config, max_workers=7)
+            eq_(g.max_workers, 7)
+
+        @raises(ValueError)
+        def max_workers_must_be_positive(self):
+            ThreadingGroup('host1', max_workers=0)
+
+        def from_connections_accepts_max_workers(self):
+            g = ThreadingGroup.from_connections(self.cxns, max_workers=2)
+            eq_(g.max_workers, 2)
+            eq_(len(g), 3)
+
     class run:
         @patch('fabric.group.Queue')
         @patch('fabric.group.ExceptionHandlingThread')
@@ -219,3 +538,354 @@ class ThreadingGroup_(Spec):
             eq_(result, expected)
             eq_(result.succeeded, expected)
             eq_(result.failed, {})
+
+        class with_max_workers:
+            @patch(
+                'fabric.group.ExceptionHandlingThread',
+                wraps=ExceptionHandlingThread,
+            )
+            def starts_at_most_max_workers_threads(self, Thread):
+                cxns = [Mock(host=x) for x in ('host1', 'host2', 'host3')]
+                g = ThreadingGroup.from_connections(cxns, max_workers=2)
+                g.run("whatever")
+                eq_(Thread.call_count, 2)
+                eq_(Thread.call_args[1]['target'], pool_worker)
+
+            @patch(
+                'fabric.group.ExceptionHandlingThread',
+                wraps=ExceptionHandlingThread,
+            )
+            def never_starts_more_threads_than_hosts(self, Thread):
+                cxns = [Mock(host='host1')]
+                g = ThreadingGroup.from_connections(cxns, max_workers=10)
+                g.run("whatever")
+                eq_(Thread.call_count, 1)
+
+            def runs_on_every_host_and_returns_results_mapping(self):
+                cxns = [Mock(name=str(x)) for x in range(10)]
+                g = ThreadingGroup.from_connections(cxns, max_workers=3)
+                result = g.run("whatever", hide=True)
+                ok_(isinstance(result, GroupResult))
+                expected = {}
+                for cxn in cxns:
+                    cxn.run.assert_called_once_with("whatever", hide=True)
+                    expected[cxn] = cxn.run.return_value
+                eq_(result, expected)
+
+            def errors_are_captured_per_host(self):
+                cxns = [Mock(host=x) for x in ('host1', 'host2', 'host3')]
+
+                class OhNoz(Exception):
+                    pass
+                onoz = OhNoz()
+                cxns[1].run.side_effect = onoz
+                g = ThreadingGroup.from_connections(cxns, max_workers=1)
+                try:
+                    g.run("whatever")
+                except GroupException as e:
+                    result = e.result
+                else:
+                    assert False, "Did not raise GroupException!"
+                eq_(result.failed, {cxns[1]: onoz})
+                eq_(len(result.succeeded), 2)
+
+    class run_iter:
+        def yields_results_in_order_of_completion(self):
+            slow, fast = Mock(name='slow'), Mock(name='fast')
+            slow.run.side_effect = _slow_run(0.2, 'slow result')
+            fast.run.return_value = 'fast result'
+            g = ThreadingGroup.from_connections([slow, fast])
+            eq_(
+                list(g.run_iter("command")),
+                [(fast, 'fast result'), (slow, 'slow result')],
+            )
+
+        def yields_exceptions_instead_of_raising(self):
+            cxns = [Mock(name=x) for x in ('host1', 'host2')]
+            onoz = Exception("onoz")
+            cxns[0].run.side_effect = onoz
+            g = ThreadingGroup.from_connections(cxns)
+            eq_(dict(g.run_iter("command")), {
+                cxns[0]: onoz,
+                cxns[1]: cxns[1].run.return_value,
+            })
+
+        def honors_max_workers(self):
+            cxns = [Mock(name=str(x)) for x in range(5)]
+            g = ThreadingGroup.from_connections(cxns, max_workers=2)
+            eq_(len(list(g.run_iter("command"))), 5)
+
+        def closing_early_skips_connections_not_yet_started(self):
+            cxns = [Mock(name=str(x)) for x in range(5)]
+            for cxn in cxns:
+                cxn.run.side_effect = _slow_run(0.05, 'result')
+            g = ThreadingGroup.from_connections(cxns, max_workers=1)
+            results = g.run_iter("command")
+            next(results)
+            results.close()
+            ran = [x for x in cxns if x.run.called]
+            ok_(len(ran) < len(cxns), "Every connection was run!")
+
+        @raises(ThreadException)
+        def dead_workers_raise_ThreadException(self):
+            cxn = Mock(name='host1')
+            cxn.run.side_effect = SystemExit
+            list(ThreadingGroup.from_connections([cxn]).run_iter("command"))
+
+
+class ThreadingGroup_transfers(Spec):
+    def put_runs_concurrently(self):
+        cxns = [Mock(name=str(x)) for x in range(3)]
+        for cxn in cxns:
+            cxn.put.side_effect = _slow_run(0.1, 'done')
+        start = time.time()
+        result = ThreadingGroup.from_connections(cxns).put('file', 'remote')
+        ok_(time.time() - start < 0.25, "Uploads appear to be serial!")
+        eq_(list(result.values()), ['done'] * 3)
+        for cxn in cxns:
+            cxn.put.assert_called_once_with('file', 'remote')
+
+    def get_honors_max_workers(self):
+        cxns = [Mock(name=str(x)) for x in range(4)]
+        g = ThreadingGroup.from_connections(cxns, max_workers=2)
+        with patch(
+            'fabric.group.ExceptionHandlingThread',
+            wraps=ExceptionHandlingThread,
+        ) as Thread:
+            g.get('file', '{host}-file')
+        eq_(Thread.call_count, 2)
+        for cxn in cxns:
+            cxn.get.assert_called_once_with('file', local='{host}-file')
+
+    def failures_raise_GroupException(self):
+        cxns = [Mock(name=x) for x in ('host1', 'host2')]
+        onoz = IOError("onoz")
+        cxns[1].get.side_effect = onoz
+        try:
+            ThreadingGroup.from_connections(cxns).get('file', '{host}')
+        except GroupException as e:
+            eq_(e.result.failed, {cxns[1]: onoz})
+        else:
+            assert False, "Did not raise GroupException!"
+
+
+class pool_worker_(Spec):
+    def calls_given_method(self):
+        cxns, queue = Queue(), Queue()
+        cxn = Mock(name='host1')
+        cxns.put(cxn)
+        pool_worker(cxns, queue, ("file",), {}, method='put')
+        cxn.put.assert_called_once_with("file")
+        ok_(not cxn.run.called)
+
+    def drains_connection_queue(self):
+        cxns, queue = Queue(), Queue()
+        hosts = [Mock(name=x) for x in ('host1', 'host2')]
+        for cxn in hosts:
+            cxns.put(cxn)
+        pool_worker(cxns, queue, ("command",), {'warn': True})
+        ok_(cxns.empty())
+        for cxn in hosts:
+            cxn.run.assert_called_once_with("command", warn=True)
+            eq_(queue.get(block=False), (cxn, cxn.run.return_value))
+
+
+def _result(cxn, stdout):
+    return Result(
+        stdout=stdout,
+        stderr='',
+        command='command',
+        shell='',
+        env={},
+        exited=0,
+        pty=False,
+        hide=(),
+        connection=cxn,
+    )
+
+
+class _InlinePool(object):
+    """
+    Stand-in for multiprocessing.Pool which works in-process.
+    """
+    instances = []
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.terminated = False
+        self.instances.append(self)
+
+    def imap_unordered(self, func, iterable):
+        return map(func, iterable)
+
+    def terminate(self):
+        self.terminated = True
+
+    def join(self):
+        pass
+
+
+class ProcessPoolGroup_(Spec):
+    def setup(self):
+        self.cxns = [Connection(x) for x in ('host1', 'host2', 'host3')]
+        _InlinePool.instances = []
+
+    class init:
+        "__init__"
+        def processes_defaults_to_None(self):
+            eq_(ProcessPoolGroup('host1').processes, None)
+
+        def accepts_processes_and_max_workers(self):
+            g = ProcessPoolGroup('host1', processes=4, max_workers=2)
+            eq_(g.processes, 4)
+            eq_(g.max_workers, 2)
+
+        @raises(ValueError)
+        def processes_must_be_positive(self):
+            ProcessPoolGroup('host1', processes=0)
+
+    class run:
+        @patch('fabric.group.Pool', _InlinePool)
+        def shards_connections_across_processes(self):
+            g = ProcessPoolGroup.from_connections(self.cxns, processes=2)
+            with patch('fabric.group.process_worker') as worker:
+                worker.return_value = []
+                g.run("command")
+            eq_(_InlinePool.instances[0].processes, 2)
+            shards = [x[0][0] for x in worker.call_args_list]
+            eq_(shards, [
+                [(0, self.cxns[0]), (2, self.cxns[2])],
+                [(1, self.cxns[1])],
+            ])
+            ok_(_InlinePool.instances[0].terminated)
+
+        @patch('fabric.group.cpu_count', return_value=8)
+        @patch('fabric.group.Pool', _InlinePool)
+        def never_uses_more_processes_than_connections(self, cpu_count):
+            cxns = self.cxns
+            for cxn in cxns:
+                cxn.run = Mock(return_value='result')
+            ProcessPoolGroup.from_connections(cxns).run("command")
+            eq_(_InlinePool.instances[0].processes, 3)
+
+        @patch('fabric.group.Pool', _InlinePool)
+        def merges_results_into_GroupResult(self):
+            for cxn in self.cxns:
+                cxn.run = Mock(return_value=_result(None, cxn.host))
+            g = ProcessPoolGroup.from_connections(self.cxns, processes=2)
+            result = g.run("command", hide=True)
+            ok_(isinstance(result, GroupResult))
+            for cxn in self.cxns:
+                eq_(result[cxn].stdout, cxn.host)
+                ok_(result[cxn].connection is cxn)
+                cxn.run.assert_called_once_with("command", hide=True)
+
+        @patch('fabric.group.Pool', _InlinePool)
+        def raises_GroupException_with_failures(self):
+            onoz = Exception("onoz")
+            for cxn in self.cxns:
+                cxn.run = Mock(return_value='ok')
+            self.cxns[1].run.side_effect = onoz
+            g = ProcessPoolGroup.from_connections(self.cxns, processes=2)
+            try:
+                g.run("command")
+            except GroupException as e:
+                eq_(e.result.failed, {self.cxns[1]: onoz})
+                eq_(len(e.result.succeeded), 2)
+            else:
+                assert False, "Did not raise GroupException!"
+
+        @raises(ValueError)
+        def refuses_open_connections(self):
+            cxn = self.cxns[0]
+            cxn.transport = Mock(active=True)
+            ProcessPoolGroup.from_connections([cxn]).run("command")
+
+        def empty_groups_do_nothing(self):
+            eq_(ProcessPoolGroup().run("command"), {})
+
+        @patch('fabric.group.Pool', _InlinePool)
+        def put_and_get_are_sharded_too(self):
+            for cxn in self.cxns:
+                cxn.put = Mock(return_value='put')
+                cxn.get = Mock(return_value='got')
+            g = ProcessPoolGroup.from_connections(self.cxns, processes=2)
+            eq_(set(g.put('file').values()), set(['put']))
+            eq_(set(g.get('file').values()), set(['got']))
+            for cxn in self.cxns:
+                cxn.put.assert_called_once_with('file')
+
+        def works_with_real_processes(self):
+            # NOTE: relies on fork() so the children see the patched method.
+            def run(self, command, **kwargs):
+                return _result(self, "{0} on {1}".format(command, self.host))
+            with patch.object(Connection, 'run', run):
+                g = ProcessPoolGroup.from_connections(self.cxns, processes=2)
+                result = g.run("command")
+            for cxn in self.cxns:
+                eq_(result[cxn].stdout, "command on {0}".format(cxn.host))
+                ok_(result[cxn].connection is cxn)
+
+
+class process_worker_(Spec):
+    def returns_detached_results_by_index(self):
+        cxns = [Connection('host1'), Connection('host2')]
+        for cxn in cxns:
+            cxn.run = Mock(return_value=_result(cxn, cxn.host))
+        results = dict(process_worker(
+            list(zip((4, 7), cxns)), ("command",), {}, None,
+        ))
+        eq_(sorted(results), [4, 7])
+        eq_(results[4].stdout, 'host1')
+        eq_(results[4].connection, None)
+
+    def replaces_unpicklable_results(self):
+        cxn = Connection('host1')
+        cxn.run = Mock(side_effect=Exception(lambda: None))
+        results = process_worker([(0, cxn)], ("command",), {}, None)
+        ok_(isinstance(results[0][1], RuntimeError))
+
+
+def _transfer(cxn, size, elapsed, **kwargs):
+    return TransferResult(
+        local='local', orig_local='local', remote='remote',
+        orig_remote='remote', connection=cxn, size=size, elapsed=elapsed,
+        **kwargs
+    )
+
+
+class GroupResult_(Spec):
+    class transfers:
+        def setup(self):
+            self.cxns = [Connection('host1'), Connection('host2')]
+            self.results = GroupResult()
+            self.results[self.cxns[0]] = _transfer(
+                self.cxns[0], 100, 1.0, round_trips=4, retries=1,
+            )
+            self.results[self.cxns[1]] = _transfer(
+                self.cxns[1], 100, 4.0, round_trips=6,
+            )
+
+        def sums_sizes_round_trips_and_retries(self):
+            summary = self.results.transfers
+            eq_(summary.size, 200)
+            eq_(summary.round_trips, 10)
+            eq_(summary.retries, 1)
+            eq_(summary.skipped, 0)
+
+        def throughput_spans_longest_transfer(self):
+            summary = self.results.transfers
+            eq_(summary.elapsed, 4.0)
+            eq_(summary.throughput, 50)
+
+        def identifies_slowest_result(self):
+            slowest = self.results.transfers.slowest
+            ok_(slowest.connection is self.cxns[1])
+
+        def unknown_values_make_totals_unknown(self):
+            self.results[self.cxns[1]].round_trips = None
+            eq_(self.results.transfers.round_trips, None)
+
+        def ignores_failures(self):
+            self.results[Connection('host3')] = Exception("oh no")
+            eq_(len(self.results.transfers.results), 2)
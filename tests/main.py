@@ -12,7 +12,7 @@ from fabric.config import Config
 from fabric.main import program as fab_program
 from fabric.exceptions import NothingToDo
 
-from _util import expect, mock_remote, Session, IntegrationSpec
+from _util import expect, mock_remote, Command, Session, IntegrationSpec
 
 
 _support = os.path.join(os.path.dirname(__file__), '_support')
@@ -37,6 +37,13 @@ Invoke .+
         def exposes_hosts_flag_in_help(self):
             expect("--help", "-H STRING, --hosts=STRING", test=assert_contains)
 
+        def exposes_max_workers_flag_in_help(self):
+            expect("--help", "--max-workers", test=assert_contains)
+
+        def max_workers_flag_sets_group_config(self):
+            with cd(_support):
+                fab_program.run("fab --max-workers 5 expect_max_workers")
+
         @mock_remote(Session('myhost', cmd='whoami'))
         def executes_remainder_as_anonymous_task(self, chan):
             # All useful asserts re: host connection & command exec are
@@ -61,6 +68,7 @@ Available tasks:
   build
   deploy
   expect_from_env
+  expect_max_workers
   expect_mutation
   expect_mutation_to_fail
   expect_vanilla_Context
@@ -130,6 +138,20 @@ Available tasks:
             with cd(_support):
                 fab_program.run("fab -H host1,host2 basic_run")
 
+        def multiple_tasks_against_one_host_share_a_connection(self):
+            session = Session('myhost', commands=[
+                Command('nope'), Command('whoami'),
+            ])
+            session.generate_mocks()
+            # Every Connection gets the same mock client, so only actual reuse
+            # of an open Connection avoids a second connect() (which the
+            # sanity check would reject).
+            with patch('fabric.connection.SSHClient') as Client:
+                Client.return_value = session.client
+                with cd(_support):
+                    fab_program.run("fab -H myhost basic_run -- whoami")
+            session.sanity_check()
+
         @mock_remote(
             Session('host1', cmd='whoami'),
             Session('host2', cmd='whoami'),
@@ -0,0 +1,191 @@
+from threading import Thread
+import time
+
+from mock import patch, Mock
+from spec import Spec, eq_, ok_, raises
+
+from fabric import Connection, ConnectionPool
+
+
+class ConnectionPool_(Spec):
+    class init:
+        "__init__"
+        def limits_default_to_None(self):
+            pool = ConnectionPool()
+            eq_(pool.max_per_host, None)
+            eq_(pool.max_size, None)
+            eq_(pool.idle_timeout, None)
+
+        def starts_empty(self):
+            eq_(len(ConnectionPool()), 0)
+
+    class from_config:
+        def uses_connection_pool_settings(self):
+            config = Mock(connection_pool={
+                'max_per_host': 2,
+                'max_size': 10,
+                'idle_timeout': 30,
+            })
+            pool = ConnectionPool.from_config(config)
+            eq_(pool.max_per_host, 2)
+            eq_(pool.max_size, 10)
+            eq_(pool.idle_timeout, 30)
+
+        def tolerates_configs_lacking_the_settings(self):
+            pool = ConnectionPool.from_config(object())
+            eq_(pool.max_per_host, None)
+
+    class key:
+        def extends_identity_with_gateway_and_connect_kwargs(self):
+            key = ConnectionPool.key
+            plain = Connection('host')
+            eq_(key(plain), key(Connection('host')))
+            others = (
+                Connection('otherhost'),
+                Connection('host', gateway='nc %h %p'),
+                Connection('host', connect_kwargs={'key_filename': ['a']}),
+            )
+            for other in others:
+                ok_(key(plain) != key(other))
+
+    class acquire:
+        def returns_Connection_for_given_host(self):
+            cxn = ConnectionPool().acquire('user@host:2222')
+            ok_(isinstance(cxn, Connection))
+            eq_(cxn.host, 'host')
+            eq_(cxn.user, 'user')
+            eq_(cxn.port, 2222)
+
+        def passes_kwargs_to_Connection(self):
+            cxn = ConnectionPool().acquire('host', user='admin')
+            eq_(cxn.user, 'admin')
+
+        def reuses_released_connections(self):
+            pool = ConnectionPool()
+            first = pool.acquire('host')
+            pool.release(first)
+            ok_(pool.acquire('host') is first)
+            eq_(len(pool), 1)
+
+        def does_not_reuse_leased_connections(self):
+            pool = ConnectionPool()
+            first = pool.acquire('host')
+            ok_(pool.acquire('host') is not first)
+            eq_(len(pool), 2)
+
+        def does_not_reuse_connections_with_different_key(self):
+            pool = ConnectionPool()
+            pool.release(pool.acquire('host'))
+            other = pool.acquire('host', user='someoneelse')
+            eq_(other.user, 'someoneelse')
+            eq_(len(pool), 2)
+
+        @raises(RuntimeError)
+        def max_per_host_blocks_until_timeout(self):
+            pool = ConnectionPool(max_per_host=1)
+            pool.acquire('host')
+            pool.acquire('host', timeout=0.01)
+
+        def max_per_host_waits_for_release(self):
+            pool = ConnectionPool(max_per_host=1)
+            first = pool.acquire('host')
+
+            def release_later():
+                time.sleep(0.05)
+                pool.release(first)
+            thread = Thread(target=release_later)
+            thread.start()
+            second = pool.acquire('host', timeout=5)
+            thread.join()
+            ok_(second is first)
+
+        def max_per_host_only_counts_same_key(self):
+            pool = ConnectionPool(max_per_host=1)
+            pool.acquire('host1')
+            pool.acquire('host2', timeout=0)
+
+        def max_size_evicts_least_recently_used_idle_connection(self):
+            pool = ConnectionPool(max_size=2)
+            one, two = pool.acquire('host1'), pool.acquire('host2')
+            one.close, two.close = Mock(), Mock()
+            pool.release(one)
+            pool.release(two)
+            pool.acquire('host3')
+            one.close.assert_called_once_with()
+            ok_(not two.close.called)
+            eq_(len(pool), 2)
+
+        @raises(RuntimeError)
+        def max_size_blocks_when_nothing_is_idle(self):
+            pool = ConnectionPool(max_size=1)
+            pool.acquire('host1')
+            pool.acquire('host2', timeout=0.01)
+
+        def idle_timeout_expires_stale_connections(self):
+            pool = ConnectionPool(idle_timeout=0.01)
+            first = pool.acquire('host')
+            first.close = Mock()
+            pool.release(first)
+            time.sleep(0.02)
+            ok_(pool.acquire('host') is not first)
+            first.close.assert_called_once_with()
+
+        @raises(RuntimeError)
+        def refuses_when_closed(self):
+            pool = ConnectionPool()
+            pool.close()
+            pool.acquire('host')
+
+    class release:
+        @raises(ValueError)
+        def rejects_foreign_connections(self):
+            ConnectionPool().release(Connection('host'))
+
+        def closes_connection_if_pool_closed_meanwhile(self):
+            pool = ConnectionPool()
+            cxn = pool.acquire('host')
+            cxn.close = Mock()
+            pool.close()
+            pool.release(cxn)
+            cxn.close.assert_called_once_with()
+            eq_(len(pool), 0)
+
+    class connection:
+        def acquires_and_releases(self):
+            pool = ConnectionPool()
+            with pool.connection('host') as cxn:
+                ok_(isinstance(cxn, Connection))
+            ok_(pool.acquire('host') is cxn)
+
+    class prune:
+        def closes_only_expired_connections(self):
+            pool = ConnectionPool(idle_timeout=0.05)
+            old = pool.acquire('host1')
+            old.close = Mock()
+            pool.release(old)
+            time.sleep(0.06)
+            new = pool.acquire('host2')
+            new.close = Mock()
+            pool.release(new)
+            pool.prune()
+            old.close.assert_called_once_with()
+            ok_(not new.close.called)
+            eq_(len(pool), 1)
+
+    class close:
+        @patch('fabric.connection.SSHClient')
+        def closes_idle_connections(self, Client):
+            pool = ConnectionPool()
+            cxn = pool.acquire('host')
+            cxn.open()
+            pool.release(cxn)
+            pool.close()
+            Client.return_value.close.assert_called_once_with()
+            eq_(len(pool), 0)
+
+        def works_as_contextmanager(self):
+            with ConnectionPool() as pool:
+                cxn = pool.acquire('host')
+                cxn.close = Mock()
+                pool.release(cxn)
+            cxn.close.assert_called_once_with()
@@ -1,11 +1,23 @@
-from invoke.vendor.six import StringIO
+import os
+import shutil
+import hashlib
+import mmap
+import stat
+import struct
+import tarfile
+import tempfile
+import zlib
 
-from mock import Mock, call
+from invoke.vendor.six import BytesIO, StringIO
+
+from mock import ANY, Mock, call, patch
 from spec import Spec, ok_, eq_, raises
-from paramiko import SFTPAttributes
+from paramiko import SFTPAttributes, SSHException
 
 from fabric import Connection
-from fabric.transfer import Transfer
+from fabric.transfer import (
+    Transfer, interpolate, relay, _Progress, _chunks, _delta, _parallel,
+)
 
 from _util import mock_sftp
 
@@ -88,6 +100,34 @@ class Transfer_(Spec):
             def remote_arg_cannot_be_empty_string(self, sftp, transfer):
                 transfer.get('')
 
+        class local_path_interpolation:
+            @mock_sftp()
+            def fills_in_connection_attributes(self, sftp, transfer):
+                cxn = transfer.connection
+                transfer.get('file', local='{user}@{host}:{port}/file')
+                expected = '/local/{0}@host:22/file'.format(cxn.user)
+                sftp.get.assert_called_with(
+                    localpath=expected,
+                    remotepath='/remote/file',
+                )
+
+            @mock_sftp(expose_os=True)
+            def creates_missing_parent_directory(
+                self, sftp, transfer, mock_os
+            ):
+                mock_os.path.dirname.side_effect = os.path.dirname
+                mock_os.path.isdir.return_value = False
+                transfer.get('file', local='{host}/file')
+                mock_os.makedirs.assert_called_once_with('/local/host')
+
+            @mock_sftp(expose_os=True)
+            def only_creates_directories_when_interpolating(
+                self, sftp, transfer, mock_os
+            ):
+                mock_os.path.isdir.return_value = False
+                transfer.get('file', local='dir/file')
+                ok_(not mock_os.makedirs.called)
+
         class file_like_local_paths:
             "file-like local paths"
             @mock_sftp()
@@ -133,6 +173,80 @@ class Transfer_(Spec):
                 transfer.get('file', local='meh', preserve_mode=False)
                 ok_(not mock_os.chmod.called)
 
+        class pipelined:
+            def setup(self):
+                self.attrs = SFTPAttributes()
+                self.attrs.st_mode = 0o100640
+                self.attrs.st_size = 10
+
+            def _handle(self, sftp):
+                handle = sftp.open.return_value.__enter__.return_value
+                handle.stat.return_value = self.attrs
+                batches = []
+
+                def readv(chunks):
+                    batches.append(list(chunks))
+                    return [b'x' * length for _, length in chunks]
+                handle.readv.side_effect = readv
+                return handle, batches
+
+            @mock_sftp()
+            def reads_in_windows_of_blocks(self, sftp, transfer):
+                handle, batches = self._handle(sftp)
+                fd = BytesIO()
+                transfer.get('file', local=fd, window=2, block_size=3)
+                sftp.open.assert_called_once_with('/remote/file', 'rb')
+                eq_(batches, [[(0, 3), (3, 3)], [(6, 3), (9, 1)]])
+                eq_(fd.getvalue(), b'x' * 10)
+                ok_(not sftp.getfo.called)
+
+            @mock_sftp()
+            def uses_config_settings_by_default(self, sftp, transfer):
+                handle, batches = self._handle(sftp)
+                config = transfer.connection.config
+                config.transfer.window = 1
+                config.transfer.block_size = 5
+                transfer.get('file', local=BytesIO())
+                eq_(batches, [[(0, 5)], [(5, 5)]])
+
+            @mock_sftp()
+            def not_used_by_default(self, sftp, transfer):
+                transfer.get('file', local=BytesIO())
+                ok_(sftp.getfo.called)
+                ok_(not sftp.open.called)
+
+            @mock_sftp(expose_os=True)
+            def uses_single_stat_for_size_and_mode(
+                self, sftp, transfer, mock_os
+            ):
+                self._handle(sftp)
+                with patch('fabric.transfer.open', create=True) as fake_open:
+                    transfer.get('file', local='meh', window=4)
+                fake_open.assert_called_once_with('/local/meh', 'wb')
+                mock_os.chmod.assert_called_once_with('/local/meh', 0o640)
+                ok_(not sftp.stat.called)
+
+            @mock_sftp()
+            def records_size_and_throughput(self, sftp, transfer):
+                self._handle(sftp)
+                result = transfer.get('file', local=BytesIO(), window=4)
+                eq_(result.size, 10)
+                ok_(result.elapsed >= 0)
+                result.elapsed = 2
+                eq_(result.throughput, 5)
+
+            @mock_sftp()
+            @raises(IOError)
+            def raises_IOError_on_short_reads(self, sftp, transfer):
+                handle, _ = self._handle(sftp)
+                handle.readv.side_effect = lambda chunks: [b'x']
+                transfer.get('file', local=BytesIO(), window=4)
+
+            @mock_sftp()
+            @raises(ValueError)
+            def window_must_be_positive(self, sftp, transfer):
+                transfer.get('file', local=BytesIO(), window=0)
+
 
     class put:
         class basics:
@@ -242,3 +356,1548 @@ class Transfer_(Spec):
             ):
                 transfer.put('file', preserve_mode=False)
                 ok_(not sftp.chmod.called)
+
+        class pipelined:
+            def _handle(self, sftp):
+                handle = sftp.open.return_value.__enter__.return_value
+                writes = []
+                handle.write.side_effect = lambda data: writes.append(
+                    (data, handle.set_pipelined.call_args[0][0]),
+                )
+                return handle, writes
+
+            @mock_sftp()
+            def waits_for_acknowledgement_every_window_writes(
+                self, sftp, transfer
+            ):
+                handle, writes = self._handle(sftp)
+                fd = BytesIO(b'abcdefghij')
+                transfer.put(fd, remote='file', window=2, block_size=3)
+                sftp.open.assert_called_once_with('/remote/file', 'wb', 0)
+                # Every 2nd write, and the final write, is not pipelined.
+                eq_(writes, [
+                    (b'abc', True),
+                    (b'def', False),
+                    (b'ghi', True),
+                    (b'j', False),
+                ])
+                ok_(not sftp.putfo.called)
+                eq_(fd.tell(), 0)
+
+            @mock_sftp()
+            def encodes_text(self, sftp, transfer):
+                handle, writes = self._handle(sftp)
+                transfer.put(StringIO(u'abc'), remote='file', window=2)
+                eq_(writes, [(b'abc', False)])
+
+            @mock_sftp()
+            def uses_config_settings_by_default(self, sftp, transfer):
+                handle, writes = self._handle(sftp)
+                config = transfer.connection.config
+                config.transfer.window = 1
+                config.transfer.block_size = 4
+                transfer.put(BytesIO(b'abcdef'), remote='file')
+                eq_(writes, [(b'abcd', False), (b'ef', False)])
+
+            @mock_sftp(expose_os=True)
+            def chmods_open_handle_instead_of_path(
+                self, sftp, transfer, mock_os
+            ):
+                handle, writes = self._handle(sftp)
+                mock_os.stat.return_value.st_mode = 0o100640
+                with patch('fabric.transfer.open', create=True) as fake_open:
+                    fake_open.return_value.__enter__.return_value = BytesIO(
+                        b'data',
+                    )
+                    result = transfer.put('file', window=4)
+                fake_open.assert_called_once_with('/local/file', 'rb')
+                handle.chmod.assert_called_once_with(0o640)
+                ok_(not sftp.chmod.called)
+                ok_(not sftp.stat.called)
+                eq_(result.size, 4)
+
+            @mock_sftp()
+            def not_used_by_default(self, sftp, transfer):
+                transfer.put(BytesIO(b'data'), remote='file')
+                ok_(sftp.putfo.called)
+                ok_(not sftp.open.called)
+
+
+def _attrs(mode, filename=None, size=0, mtime=0):
+    attrs = SFTPAttributes()
+    attrs.st_mode = mode
+    attrs.st_size = size
+    attrs.st_atime = attrs.st_mtime = mtime
+    attrs.filename = filename
+    return attrs
+
+
+class recursive_transfers(Spec):
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.patchers = [
+            patch('fabric.connection.SSHClient'),
+            # NOTE: mock_sftp never un-mocks os, so make sure it's real.
+            patch('fabric.transfer.os', os),
+        ]
+        self.Client = self.patchers[0].start()
+        self.patchers[1].start()
+        self.sftp = self.Client.return_value.open_sftp.return_value
+        self.sftp.sock.closed = False
+        self.transfer = Transfer(Connection('host'))
+
+    def teardown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _path(self, *parts):
+        return os.path.join(self.tmpdir, *parts)
+
+    class put:
+        def setup(self):
+            os.makedirs(self._path('src', 'b', 'c'))
+            os.mkdir(self._path('src', 'a'))
+            for parts in (('z',), ('a', 'x'), ('b', 'c', 'y')):
+                with open(self._path('src', *parts), 'w') as fd:
+                    fd.write('data')
+            os.chmod(self._path('src', 'a'), 0o750)
+
+        def creates_directories_parents_first(self):
+            self.transfer.put(self._path('src'), '/dest', recursive=True)
+            created = [x[0][0] for x in self.sftp.mkdir.call_args_list]
+            eq_(set(created), set([
+                '/dest', '/dest/a', '/dest/b', '/dest/b/c',
+            ]))
+            for path in created:
+                parent = os.path.dirname(path)
+                if parent in created:
+                    ok_(created.index(parent) < created.index(path))
+
+        def uploads_every_file(self):
+            result = self.transfer.put(
+                self._path('src'), '/dest', recursive=True,
+            )
+            eq_(
+                sorted(x[1]['remotepath'] for x in self.sftp.put.call_args_list), # noqa
+                ['/dest/a/x', '/dest/b/c/y', '/dest/z'],
+            )
+            eq_(len(result.files), 3)
+            eq_(result.size, 12)
+            eq_(result.remote, '/dest')
+
+        def defaults_remote_to_local_directory_name(self):
+            self.sftp.getcwd.return_value = '/remote'
+            self.transfer.put(self._path('src') + os.sep, recursive=True)
+            self.sftp.mkdir.assert_any_call('/remote/src')
+
+        def preserves_directory_modes_afterwards(self):
+            self.transfer.put(self._path('src'), '/dest', recursive=True)
+            self.sftp.chmod.assert_any_call('/dest/a', 0o750)
+
+        def tolerates_existing_directories(self):
+            self.sftp.mkdir.side_effect = IOError
+            self.sftp.stat.return_value = _attrs(stat.S_IFDIR | 0o755)
+            self.transfer.put(self._path('src'), '/dest', recursive=True)
+            eq_(self.sftp.put.call_count, 3)
+
+        @raises(IOError)
+        def errors_if_directory_path_is_a_file(self):
+            self.sftp.mkdir.side_effect = IOError
+            self.sftp.stat.return_value = _attrs(stat.S_IFREG | 0o644)
+            self.transfer.put(self._path('src'), '/dest', recursive=True)
+
+        def uses_given_number_of_sftp_channels(self):
+            self.Client.return_value.open_sftp.side_effect = lambda: Mock()
+            self.transfer.put(
+                self._path('src'), '/dest', recursive=True, workers=3,
+            )
+            # One for Connection.sftp(), two extra, which go back to the pool.
+            eq_(self.Client.return_value.open_sftp.call_count, 3)
+            eq_(len(self.transfer.connection.sftp_pool), 3)
+
+        def workers_are_capped_by_channels(self):
+            self.Client.return_value.open_sftp.side_effect = lambda: Mock()
+            self.transfer.connection.sftp_pool.size = 2
+            self.transfer.put(
+                self._path('src'), '/dest', recursive=True, workers=3,
+            )
+            eq_(self.Client.return_value.open_sftp.call_count, 2)
+
+        @raises(ValueError)
+        def requires_a_directory(self):
+            self.transfer.put(self._path('src', 'z'), '/dest', recursive=True)
+
+        @raises(ValueError)
+        def rejects_file_like_objects(self):
+            self.transfer.put(StringIO(), '/dest', recursive=True)
+
+    class get:
+        def setup(self):
+            tree = {
+                '/src': [
+                    _attrs(stat.S_IFREG | 0o600, 'z', size=1),
+                    _attrs(stat.S_IFDIR | 0o750, 'a'),
+                    _attrs(stat.S_IFLNK | 0o777, 'link'),
+                ],
+                '/src/a': [_attrs(stat.S_IFREG | 0o644, 'x', size=2)],
+            }
+            self.sftp.stat.return_value = _attrs(stat.S_IFDIR | 0o755)
+            self.sftp.listdir_attr.side_effect = lambda path: tree[path]
+
+            def get(remotepath, localpath):
+                with open(localpath, 'w') as fd:
+                    fd.write(remotepath)
+            self.sftp.get.side_effect = get
+
+        def downloads_tree(self):
+            result = self.transfer.get('/src/', self._path('dest'), recursive=True) # noqa
+            with open(self._path('dest', 'a', 'x')) as fd:
+                eq_(fd.read(), '/src/a/x')
+            ok_(os.path.exists(self._path('dest', 'z')))
+            ok_(not os.path.exists(self._path('dest', 'link')))
+            eq_(len(result.files), 2)
+            eq_(result.size, 3)
+
+        def preserves_modes_from_listings(self):
+            self.transfer.get('/src', self._path('dest'), recursive=True)
+
+            def mode(*parts):
+                return stat.S_IMODE(os.stat(self._path(*parts)).st_mode)
+            eq_(mode('dest', 'z'), 0o600)
+            eq_(mode('dest', 'a'), 0o750)
+            eq_(mode('dest'), 0o755)
+            # Only the root was stat'd; everything else came from listings.
+            self.sftp.stat.assert_called_once_with('/src')
+
+        @raises(ValueError)
+        def requires_a_directory(self):
+            self.sftp.stat.return_value = _attrs(stat.S_IFREG | 0o644)
+            self.transfer.get('/src', self._path('dest'), recursive=True)
+
+
+class _FakeChannel(object):
+    """
+    Session channel stand-in recording stdin & replaying stdout/stderr.
+    """
+    def __init__(self, stdout=b'', stderr=b'', exited=0):
+        self.stdin = BytesIO()
+        self.stdout = BytesIO(stdout)
+        self.stderr = BytesIO(stderr)
+        self.exited = exited
+        self.command = None
+        self.timeout = None
+        self.closed = False
+
+    def exec_command(self, command):
+        self.command = command
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def sendall(self, data):
+        self.stdin.write(data)
+
+    def recv(self, nbytes):
+        return self.stdout.read(nbytes)
+
+    def recv_stderr(self, nbytes):
+        return self.stderr.read(nbytes)
+
+    def shutdown_write(self):
+        pass
+
+    def recv_exit_status(self):
+        return self.exited
+
+    def close(self):
+        self.closed = True
+
+
+class tar_transfers(Spec):
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # NOTE: mock_sftp never un-mocks os, so make sure it's real.
+        self.patcher = patch('fabric.transfer.os', os)
+        self.patcher.start()
+        self.cxn = Connection('host')
+        self.cxn.sftp = Mock()
+        self.transfer = Transfer(self.cxn)
+
+    def teardown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _path(self, *parts):
+        return os.path.join(self.tmpdir, *parts)
+
+    def _tarball(self, members, mode='w'):
+        data = BytesIO()
+        archive = tarfile.open(fileobj=data, mode=mode)
+        for name, content in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0o640
+            archive.addfile(info, BytesIO(content))
+        archive.close()
+        return data.getvalue()
+
+    class put:
+        def setup(self):
+            os.makedirs(self._path('src', 'a'))
+            with open(self._path('src', 'a', 'x'), 'w') as fd:
+                fd.write('data')
+            self.channel = _FakeChannel()
+            self.cxn.create_session = Mock(return_value=self.channel)
+
+        def streams_archive_into_remote_tar(self):
+            result = self.transfer.put(
+                self._path('src'), '/dest dir', recursive=True,
+                protocol='tar',
+            )
+            eq_(
+                self.channel.command,
+                "mkdir -p '/dest dir' && tar -x -f - -C '/dest dir' -p",
+            )
+            self.channel.stdin.seek(0)
+            archive = tarfile.open(fileobj=self.channel.stdin)
+            eq_(archive.extractfile('./a/x').read(), b'data')
+            eq_(result.size, len(self.channel.stdin.getvalue()))
+            ok_(self.channel.closed)
+            ok_(not self.cxn.sftp.called)
+
+        def may_compress_with_gzip(self):
+            self.transfer.put(
+                self._path('src'), '/dest', recursive=True, protocol='tar',
+                compress='gzip', preserve_mode=False,
+            )
+            eq_(self.channel.command, "mkdir -p /dest && tar -x -f - -C /dest -z") # noqa
+            self.channel.stdin.seek(0)
+            archive = tarfile.open(fileobj=self.channel.stdin, mode='r:gz')
+            ok_('./a/x' in archive.getnames())
+
+        def protocol_may_come_from_config(self):
+            self.cxn.config.transfer.protocol = 'tar'
+            self.transfer.put(self._path('src'), '/dest', recursive=True)
+            ok_(self.channel.command.startswith('mkdir -p /dest'))
+
+        @raises(IOError)
+        def nonzero_exit_raises_IOError(self):
+            self.channel.exited = 2
+            self.transfer.put(
+                self._path('src'), '/dest', recursive=True, protocol='tar',
+            )
+
+        @raises(ValueError)
+        def requires_a_directory(self):
+            self.transfer.put(
+                self._path('src', 'a', 'x'), '/dest', recursive=True,
+                protocol='tar',
+            )
+
+        @raises(ValueError)
+        def rejects_codecs_tar_lacks(self):
+            self.transfer.put(
+                self._path('src'), '/dest', recursive=True, protocol='tar',
+                compress='lz4',
+            )
+
+        @raises(ValueError)
+        def rejects_unknown_protocols(self):
+            self.transfer.put(
+                self._path('src'), '/dest', recursive=True, protocol='nope',
+            )
+
+        def rejects_sftp_only_options(self):
+            for kwargs in (
+                {'window': 8},
+                {'delta': True},
+                {'skip_unchanged': True},
+                {'resume': True},
+                {'retries': 2},
+                {'memory_map': True},
+            ):
+                try:
+                    self.transfer.put(
+                        self._path('src'), '/dest', recursive=True,
+                        protocol='tar', **kwargs
+                    )
+                except ValueError as e:
+                    ok_(list(kwargs)[0] in str(e), str(e))
+                else:
+                    assert False, "Accepted {0!r}!".format(kwargs)
+            ok_(not self.cxn.create_session.called)
+
+    class get:
+        def extracts_remote_tar_output(self):
+            data = self._tarball([('./a/x', b'data'), ('./z', b'zz')])
+            channel = _FakeChannel(stdout=data)
+            self.cxn.create_session = Mock(return_value=channel)
+            result = self.transfer.get(
+                '/src', self._path('dest'), recursive=True, protocol='tar',
+            )
+            eq_(channel.command, "tar -c -f - -C /src .")
+            with open(self._path('dest', 'a', 'x')) as fd:
+                eq_(fd.read(), 'data')
+            mode = stat.S_IMODE(os.stat(self._path('dest', 'z')).st_mode)
+            eq_(mode, 0o640)
+            eq_(result.size, len(data))
+            ok_(not self.cxn.sftp.called)
+
+        def may_decompress_gzip(self):
+            data = self._tarball([('./z', b'zz')], mode='w:gz')
+            channel = _FakeChannel(stdout=data)
+            self.cxn.create_session = Mock(return_value=channel)
+            self.transfer.get(
+                '/src', self._path('dest'), recursive=True, protocol='tar',
+                compress='gzip',
+            )
+            eq_(channel.command, "tar -c -f - -C /src -z .")
+            ok_(os.path.exists(self._path('dest', 'z')))
+
+        def skips_unsafe_members(self):
+            data = self._tarball([
+                ('../escape', b'no'), ('/abs', b'no'), ('ok', b'yes'),
+            ])
+            self.cxn.create_session = Mock(
+                return_value=_FakeChannel(stdout=data),
+            )
+            self.transfer.get(
+                '/src', self._path('dest'), recursive=True, protocol='tar',
+            )
+            eq_(os.listdir(self._path('dest')), ['ok'])
+            ok_(not os.path.exists(self._path('escape')))
+
+        def rejects_sftp_only_options(self):
+            self.cxn.create_session = Mock()
+            for kwargs in (
+                {'window': 8},
+                {'skip_unchanged': True},
+                {'resume': True},
+                {'retries': 2},
+            ):
+                try:
+                    self.transfer.get(
+                        '/src', self._path('dest'), recursive=True,
+                        protocol='tar', **kwargs
+                    )
+                except ValueError as e:
+                    ok_(list(kwargs)[0] in str(e), str(e))
+                else:
+                    assert False, "Accepted {0!r}!".format(kwargs)
+            ok_(not self.cxn.create_session.called)
+
+        def skips_links_leading_outside(self):
+            outside = self._path('outside')
+            os.mkdir(outside)
+            data = BytesIO()
+            archive = tarfile.open(fileobj=data, mode='w')
+            for name, kind, linkname in (
+                ('evil', tarfile.SYMTYPE, outside),
+                ('sneaky', tarfile.SYMTYPE, '../outside'),
+                ('hard', tarfile.LNKTYPE, '../outside/file'),
+                ('inner', tarfile.SYMTYPE, 'ok'),
+            ):
+                info = tarfile.TarInfo(name)
+                info.type = kind
+                info.linkname = linkname
+                archive.addfile(info)
+            for name in ('evil/pwned', 'sneaky/pwned', 'ok'):
+                info = tarfile.TarInfo(name)
+                info.size = 2
+                archive.addfile(info, BytesIO(b'no'))
+            archive.close()
+            self.cxn.create_session = Mock(
+                return_value=_FakeChannel(stdout=data.getvalue()),
+            )
+            self.transfer.get(
+                '/src', self._path('dest'), recursive=True, protocol='tar',
+            )
+            for name in ('evil', 'sneaky', 'hard'):
+                ok_(not os.path.islink(self._path('dest', name)), name)
+                ok_(not os.path.isfile(self._path('dest', name)), name)
+            ok_(os.path.islink(self._path('dest', 'inner')))
+            eq_(os.listdir(outside), [])
+
+        def remote_failure_explains_empty_stream(self):
+            self.cxn.create_session = Mock(return_value=_FakeChannel(
+                stderr=b'tar: /src: Cannot open', exited=2,
+            ))
+            try:
+                self.transfer.get(
+                    '/src', self._path('dest'), recursive=True,
+                    protocol='tar',
+                )
+            except IOError as e:
+                ok_('Cannot open' in str(e))
+            else:
+                assert False, "Did not raise IOError!"
+
+
+def _signature(data, block_size):
+    return [
+        (
+            zlib.adler32(data[i:i + block_size]) & 0xffffffff,
+            hashlib.md5(data[i:i + block_size]).hexdigest(),
+        )
+        for i in range(0, len(data), block_size)
+    ]
+
+
+def _apply(old, ops, block_size):
+    new = b''
+    for op, value in ops:
+        if op == 'C':
+            index, count = value
+            new += old[index * block_size:(index + count) * block_size]
+        else:
+            new += value
+    return new
+
+
+class delta_(Spec):
+    def setup(self):
+        self.old = bytes(bytearray(x * 7 % 251 for x in range(5000)))
+
+    def identical_data_is_one_copy(self):
+        ops = list(_delta(self.old, _signature(self.old, 64), 64))
+        eq_(ops, [('C', (0, 79))])
+
+    def finds_blocks_at_shifted_offsets(self):
+        new = self.old[:1000] + b'inserted' + self.old[1000:]
+        ops = list(_delta(new, _signature(self.old, 64), 64))
+        eq_(_apply(self.old, ops, 64), new)
+        literal = sum(len(x[1]) for x in ops if x[0] == 'L')
+        ok_(literal < 64 * 2, literal)
+
+    def handles_unrelated_and_empty_data(self):
+        for new in (b'', b'something else entirely' * 10):
+            ops = list(_delta(new, _signature(self.old, 64), 64))
+            eq_(_apply(self.old, ops, 64), new)
+
+    def splits_long_literals(self):
+        new = b'x' * 100
+        ops = list(_delta(new, [], 8, literal_size=30))
+        eq_(_apply(b'', ops, 8), new)
+        ok_(max(len(x[1]) for x in ops) <= 30)
+
+    class put:
+        def setup(self):
+            self.tmpdir = tempfile.mkdtemp()
+            self.patchers = [
+                patch('fabric.connection.SSHClient'),
+                # NOTE: mock_sftp never un-mocks os, so make sure it's real.
+                patch('fabric.transfer.os', os),
+            ]
+            Client = self.patchers[0].start()
+            self.patchers[1].start()
+            self.sftp = Client.return_value.open_sftp.return_value
+            self.local = os.path.join(self.tmpdir, 'file')
+            self.new = self.old[:2000] + b'changed' + self.old[2000:]
+            with open(self.local, 'wb') as fd:
+                fd.write(self.new)
+            os.chmod(self.local, 0o640)
+            self.cxn = Connection('host')
+            self.transfer = Transfer(self.cxn)
+
+        def teardown(self):
+            for patcher in self.patchers:
+                patcher.stop()
+            shutil.rmtree(self.tmpdir)
+
+        def _signature_channel(self, block_size=32768):
+            lines = [
+                '{0} {1}\n'.format(*x)
+                for x in _signature(self.old, block_size)
+            ]
+            return _FakeChannel(stdout=''.join(lines).encode('ascii'))
+
+        def sends_only_changes(self):
+            channels = [self._signature_channel(512), _FakeChannel()]
+            self.cxn.create_session = Mock(side_effect=channels)
+            result = self.transfer.put(
+                self.local, '/remote/file', delta=True, block_size=512,
+            )
+            for channel in channels:
+                ok_("/remote/file 512" in channel.command)
+            ok_(channels[1].command.endswith(" 640"))
+            stream = channels[1].stdin.getvalue()
+            # Walk the instruction stream & rebuild the file from it.
+            ops, pos = [], 0
+            while stream[pos:pos + 1] != b'E':
+                if stream[pos:pos + 1] == b'C':
+                    ops.append(('C', struct.unpack('>QQ', stream[pos + 1:pos + 17]))) # noqa
+                    pos += 17
+                else:
+                    length, = struct.unpack('>Q', stream[pos + 1:pos + 9])
+                    ops.append(('L', stream[pos + 9:pos + 9 + length]))
+                    pos += 9 + length
+            eq_(_apply(self.old, ops, 512), self.new)
+            eq_(stream[pos + 1:], hashlib.md5(self.new).hexdigest().encode())
+            eq_(result.size, len(self.new))
+            eq_(result.sent, len(stream))
+            ok_(result.sent < len(self.new) / 2)
+            ok_(not self.sftp.put.called)
+
+        def keeps_remote_mode_unless_preserving(self):
+            channels = [self._signature_channel(), _FakeChannel()]
+            self.cxn.create_session = Mock(side_effect=channels)
+            self.transfer.put(
+                self.local, '/remote/file', delta=True, preserve_mode=False,
+            )
+            ok_(channels[1].command.endswith(" -"))
+
+        def falls_back_to_full_upload_when_remote_is_missing(self):
+            self.cxn.create_session = Mock(
+                return_value=_FakeChannel(stdout=b'missing\n'),
+            )
+            result = self.transfer.put(self.local, '/remote/file', delta=True)
+            self.sftp.put.assert_called_once_with(
+                localpath=self.local, remotepath='/remote/file',
+            )
+            eq_(self.cxn.create_session.call_count, 1)
+            eq_(result.sent, None)
+
+        def accepts_file_like_objects(self):
+            channels = [self._signature_channel(), _FakeChannel()]
+            self.cxn.create_session = Mock(side_effect=channels)
+            fd = BytesIO(self.old)
+            fd.seek(10)
+            result = self.transfer.put(fd, '/remote/file', delta=True)
+            eq_(fd.tell(), 10)
+            eq_(result.size, len(self.old))
+            # Only a single copy instruction, plus the end marker & checksum.
+            eq_(result.sent, 17 + 1 + 32)
+
+        @raises(IOError)
+        def remote_failure_raises_IOError(self):
+            self.cxn.create_session = Mock(
+                return_value=_FakeChannel(stderr=b'boom', exited=1),
+            )
+            self.transfer.put(self.local, '/remote/file', delta=True)
+
+
+class skip_unchanged_(Spec):
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.patchers = [
+            patch('fabric.connection.SSHClient'),
+            # NOTE: mock_sftp never un-mocks os, so make sure it's real.
+            patch('fabric.transfer.os', os),
+        ]
+        Client = self.patchers[0].start()
+        self.patchers[1].start()
+        self.sftp = Client.return_value.open_sftp.return_value
+        self.local = os.path.join(self.tmpdir, 'file')
+        with open(self.local, 'wb') as fd:
+            fd.write(b'data')
+        os.utime(self.local, (1000000, 1000000))
+        self.cxn = Connection('host')
+        self.transfer = Transfer(self.cxn)
+
+    def teardown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _remote(self, size=4, mtime=1000000):
+        self.sftp.stat.return_value = _attrs(
+            stat.S_IFREG | 0o644, size=size, mtime=mtime,
+        )
+
+    def put_skips_files_with_same_size_and_mtime(self):
+        self._remote()
+        result = self.transfer.put(
+            self.local, '/remote/file', skip_unchanged=True,
+        )
+        ok_(result.skipped)
+        eq_(result.size, 0)
+        ok_(not self.sftp.put.called)
+
+    def put_uploads_other_files_and_syncs_their_mtime(self):
+        for size, mtime in ((4, 1000001), (5, 1000000)):
+            self._remote(size=size, mtime=mtime)
+            result = self.transfer.put(
+                self.local, '/remote/file', skip_unchanged='mtime',
+            )
+            ok_(not result.skipped)
+            self.sftp.put.assert_called_with(
+                localpath=self.local, remotepath='/remote/file',
+            )
+            eq_(self.sftp.utime.call_args[0][1][1], 1000000)
+
+    def put_uploads_missing_files(self):
+        self.sftp.stat.side_effect = IOError
+        result = self.transfer.put(
+            self.local, '/remote/file', skip_unchanged=True,
+        )
+        ok_(not result.skipped)
+        ok_(self.sftp.put.called)
+
+    def hash_mode_compares_contents(self):
+        self._remote(mtime=0)
+        for digest, skipped in (
+            hashlib.sha256(b'data').hexdigest(), True,
+        ), ('0' * 64, False):
+            channel = _FakeChannel(stdout=digest.encode('ascii') + b'\n')
+            self.cxn.create_session = Mock(return_value=channel)
+            result = self.transfer.put(
+                self.local, '/remote/file', skip_unchanged='hash',
+            )
+            eq_(channel.stdin.getvalue(), b'/remote/file')
+            eq_(result.skipped, skipped)
+        eq_(self.sftp.put.call_count, 1)
+
+    def get_skips_files_with_same_size_and_mtime(self):
+        self._remote()
+        result = self.transfer.get(
+            '/remote/file', self.local, skip_unchanged=True,
+        )
+        ok_(result.skipped)
+        ok_(not self.sftp.get.called)
+
+    def get_syncs_mtime_of_downloads(self):
+        self._remote(mtime=2000000)
+        result = self.transfer.get(
+            '/remote/file', self.local, skip_unchanged=True,
+        )
+        ok_(not result.skipped)
+        ok_(self.sftp.get.called)
+        eq_(os.stat(self.local).st_mtime, 2000000)
+
+    def recursive_put_lists_each_directory_once(self):
+        os.makedirs(os.path.join(self.tmpdir, 'src', 'sub'))
+        for name in ('a', 'b', os.path.join('sub', 'c')):
+            path = os.path.join(self.tmpdir, 'src', name)
+            with open(path, 'wb') as fd:
+                fd.write(b'data')
+            os.utime(path, (1000000, 1000000))
+        self.sftp.listdir_attr.side_effect = lambda path: {
+            '/dest': [_attrs(stat.S_IFREG, 'a', size=4, mtime=1000000)],
+            '/dest/sub': [_attrs(stat.S_IFREG, 'c', size=4, mtime=5)],
+        }[path]
+        result = self.transfer.put(
+            os.path.join(self.tmpdir, 'src'), '/dest', recursive=True,
+            skip_unchanged=True,
+        )
+        eq_(self.sftp.listdir_attr.call_count, 2)
+        skipped = [x.remote for x in result.files if x.skipped]
+        eq_(skipped, ['/dest/a'])
+        eq_(
+            sorted(x[0][0] for x in self.sftp.utime.call_args_list),
+            ['/dest/b', '/dest/sub/c'],
+        )
+
+    def recursive_get_uses_listing_attributes(self):
+        self.sftp.stat.return_value = _attrs(stat.S_IFDIR | 0o755)
+        self.sftp.listdir_attr.return_value = [
+            _attrs(stat.S_IFREG | 0o644, 'file', size=4, mtime=1000000),
+            _attrs(stat.S_IFREG | 0o644, 'other', size=4, mtime=1000000),
+        ]
+        self.sftp.get.side_effect = lambda remotepath, localpath: open(
+            localpath, 'w',
+        ).close()
+        result = self.transfer.get(
+            '/src', self.tmpdir, recursive=True, skip_unchanged=True,
+        )
+        eq_([x.skipped for x in result.files], [True, False])
+        self.sftp.get.assert_called_once_with(
+            remotepath='/src/other',
+            localpath=os.path.join(self.tmpdir, 'other'),
+        )
+        self.sftp.stat.assert_called_once_with('/src')
+
+    @raises(ValueError)
+    def rejects_file_like_objects(self):
+        self.transfer.put(BytesIO(), '/remote/file', skip_unchanged=True)
+
+    @raises(ValueError)
+    def rejects_unknown_modes(self):
+        self.transfer.put(self.local, '/remote/file', skip_unchanged='size')
+
+
+class resumable_(Spec):
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.patchers = [
+            patch('fabric.connection.SSHClient'),
+            # NOTE: mock_sftp never un-mocks os, so make sure it's real.
+            patch('fabric.transfer.os', os),
+        ]
+        Client = self.patchers[0].start()
+        self.patchers[1].start()
+        self.sftp = Client.return_value.open_sftp.return_value
+        self.handle = self.sftp.open.return_value.__enter__.return_value
+        self.data = bytes(bytearray(x % 256 for x in range(1000)))
+        self.local = os.path.join(self.tmpdir, 'file')
+        self.cxn = Connection('host')
+        self.cxn.config.transfer.checkpoint_size = 300
+        self.transfer = Transfer(self.cxn)
+
+    def teardown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _digest_channel(self, data):
+        digest = hashlib.sha256(data).hexdigest().encode('ascii')
+        channel = _FakeChannel(stdout=digest + b'\n')
+        self.cxn.create_session = Mock(return_value=channel)
+        return channel
+
+    class get:
+        def setup(self):
+            self.handle.stat.return_value = _attrs(
+                stat.S_IFREG | 0o640, size=len(self.data),
+            )
+            self.handle.readv.side_effect = lambda chunks: [
+                self.data[x:x + size] for x, size in chunks
+            ]
+
+        def continues_verified_partial_download(self):
+            with open(self.local + '.part', 'wb') as fd:
+                fd.write(self.data[:450])
+            channel = self._digest_channel(self.data[:450])
+            result = self.transfer.get(
+                '/remote/file', self.local, resume=True, block_size=100,
+            )
+            ok_(channel.command.endswith(" 450"))
+            eq_(channel.stdin.getvalue(), b'/remote/file')
+            eq_(result.checkpoints, [450, 750, 1000])
+            eq_(self.handle.readv.call_args_list[0][0][0][0], (450, 100))
+            with open(self.local, 'rb') as fd:
+                eq_(fd.read(), self.data)
+            ok_(not os.path.exists(self.local + '.part'))
+            eq_(stat.S_IMODE(os.stat(self.local).st_mode), 0o640)
+
+        def restarts_if_partial_download_mismatches(self):
+            with open(self.local + '.part', 'wb') as fd:
+                fd.write(b'garbage')
+            self._digest_channel(b'something else')
+            result = self.transfer.get(
+                '/remote/file', self.local, resume=True,
+            )
+            eq_(result.checkpoints, [0, 300, 600, 900, 1000])
+            with open(self.local, 'rb') as fd:
+                eq_(fd.read(), self.data)
+
+        def starts_afresh_without_remote_commands(self):
+            self.cxn.create_session = Mock()
+            result = self.transfer.get(
+                '/remote/file', self.local, resume=True,
+            )
+            eq_(result.checkpoints[0], 0)
+            ok_(not self.cxn.create_session.called)
+
+        @raises(ValueError)
+        def rejects_file_like_objects(self):
+            self.transfer.get('/remote/file', BytesIO(), resume=True)
+
+    class put:
+        def setup(self):
+            with open(self.local, 'wb') as fd:
+                fd.write(self.data)
+            os.chmod(self.local, 0o640)
+            self.written = BytesIO()
+            self.handle.seek.side_effect = self.written.seek
+            self.handle.write.side_effect = self.written.write
+
+        def continues_verified_partial_upload(self):
+            self.sftp.stat.return_value = _attrs(stat.S_IFREG, size=450)
+            self._digest_channel(self.data[:450])
+            result = self.transfer.put(
+                self.local, '/remote/file', resume=True, block_size=100,
+            )
+            self.sftp.stat.assert_called_once_with('/remote/file.part')
+            self.sftp.open.assert_called_once_with(
+                '/remote/file.part', 'r+b', 0,
+            )
+            eq_(self.written.getvalue()[450:], self.data[450:])
+            eq_(result.checkpoints, [450, 650, 950, 1000])
+            # Only checkpoints wait for the server's acknowledgements.
+            eq_(
+                [x[0][0] for x in self.handle.set_pipelined.call_args_list],
+                [True, False, True, True, False, False],
+            )
+            self.handle.chmod.assert_called_once_with(0o640)
+            self.sftp.posix_rename.assert_called_once_with(
+                '/remote/file.part', '/remote/file',
+            )
+
+        def restarts_if_partial_upload_mismatches(self):
+            self.sftp.stat.return_value = _attrs(stat.S_IFREG, size=450)
+            self._digest_channel(b'something else')
+            result = self.transfer.put(
+                self.local, '/remote/file', resume=True,
+            )
+            self.sftp.open.assert_called_once_with(
+                '/remote/file.part', 'wb', 0,
+            )
+            eq_(self.written.getvalue(), self.data)
+            eq_(result.checkpoints[0], 0)
+
+        @raises(ValueError)
+        def cannot_be_combined_with_delta(self):
+            self.transfer.put(
+                self.local, '/remote/file', resume=True, delta=True,
+            )
+
+
+class scp_transfers(Spec):
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # NOTE: mock_sftp never un-mocks os, so make sure it's real.
+        self.patcher = patch('fabric.transfer.os', os)
+        self.patcher.start()
+        self.cxn = Connection('host')
+        self.cxn.sftp = Mock()
+        self.transfer = Transfer(self.cxn)
+        self.local = os.path.join(self.tmpdir, 'file')
+
+    def teardown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _channel(self, stdout, **kwargs):
+        channel = _FakeChannel(stdout=stdout, **kwargs)
+        self.cxn.create_session = Mock(return_value=channel)
+        return channel
+
+    class put:
+        def setup(self):
+            with open(self.local, 'wb') as fd:
+                fd.write(b'data')
+            os.chmod(self.local, 0o640)
+            os.utime(self.local, (1000, 2000))
+
+        def drives_remote_scp_sink(self):
+            channel = self._channel(b'\0' * 4)
+            result = self.transfer.put(
+                self.local, '/remote/file', protocol='scp',
+            )
+            eq_(channel.command, "scp -t -p /remote/file")
+            eq_(
+                channel.stdin.getvalue(),
+                b'T2000 0 1000 0\nC0640 4 file\ndata\0',
+            )
+            eq_(result.size, 4)
+            eq_(result.remote, '/remote/file')
+            ok_(not self.cxn.sftp.called)
+
+        def reports_progress(self):
+            self._channel(b'\0' * 4)
+            progress = Mock()
+            self.transfer.put(
+                self.local, '/remote/file', protocol='scp', progress=progress,
+            )
+            progress.assert_called_once_with(4, 4)
+
+        def skips_times_and_mode_unless_preserving(self):
+            channel = self._channel(b'\0' * 3)
+            self.transfer.put(
+                self.local, 'file', protocol='scp', preserve_mode=False,
+            )
+            eq_(channel.command, "scp -t file")
+            eq_(channel.stdin.getvalue(), b'C0644 4 file\ndata\0')
+
+        def uploads_file_like_objects(self):
+            channel = self._channel(b'\0' * 3)
+            fd = StringIO(u'text')
+            fd.seek(2)
+            result = self.transfer.put(fd, '/remote/name', protocol='scp')
+            eq_(channel.stdin.getvalue(), b'C0644 4 name\ntext\0')
+            eq_(result.size, 4)
+            eq_(fd.tell(), 2)
+
+        def remote_errors_raise_IOError(self):
+            self._channel(b'\0\1scp: /remote: Permission denied\n', exited=1)
+            try:
+                self.transfer.put(self.local, '/remote/file', protocol='scp')
+            except IOError as e:
+                ok_('Permission denied' in str(e))
+            else:
+                assert False, "Did not raise IOError!"
+
+        @raises(ValueError)
+        def recursion_is_not_supported(self):
+            self.transfer.put(
+                self.tmpdir, '/remote', protocol='scp', recursive=True,
+            )
+
+        def rejects_sftp_only_options(self):
+            for kwargs in (
+                {'resume': True},
+                {'skip_unchanged': True},
+                {'delta': True},
+                {'window': 8},
+                {'retries': 2},
+            ):
+                try:
+                    self.transfer.put(
+                        self.local, '/remote/file', protocol='scp', **kwargs
+                    )
+                except ValueError as e:
+                    ok_(list(kwargs)[0] in str(e), str(e))
+                else:
+                    assert False, "Accepted {0!r}!".format(kwargs)
+
+        @raises(EOFError)
+        def ignores_configured_retries(self):
+            self.cxn.config.transfer.retries = 3
+            channel = self._channel(b'\0' * 4)
+            channel.sendall = Mock(side_effect=EOFError)
+            try:
+                self.transfer.put(self.local, '/remote/file', protocol='scp')
+            finally:
+                eq_(self.cxn.create_session.call_count, 1)
+
+    class get:
+        def drives_remote_scp_source(self):
+            channel = self._channel(b'C0604 4 file\ndata\0')
+            result = self.transfer.get(
+                '/remote/file', self.local, protocol='scp',
+            )
+            eq_(channel.command, "scp -f /remote/file")
+            eq_(channel.stdin.getvalue(), b'\0\0\0')
+            with open(self.local, 'rb') as fd:
+                eq_(fd.read(), b'data')
+            eq_(stat.S_IMODE(os.stat(self.local).st_mode), 0o604)
+            eq_(result.size, 4)
+            ok_(not self.cxn.sftp.called)
+
+        def config_may_select_scp(self):
+            self.cxn.config.transfer.protocol = 'scp'
+            self._channel(b'C0604 4 file\ndata\0')
+            fd = BytesIO()
+            self.transfer.get('/remote/file', fd)
+            eq_(fd.getvalue(), b'data')
+
+        def remote_errors_raise_IOError(self):
+            self._channel(b'\1scp: /remote/file: No such file\n', exited=1)
+            try:
+                self.transfer.get('/remote/file', self.local, protocol='scp')
+            except IOError as e:
+                ok_('No such file' in str(e))
+            else:
+                assert False, "Did not raise IOError!"
+
+        def rejects_sftp_only_options(self):
+            for kwargs in (
+                {'resume': True},
+                {'skip_unchanged': True},
+                {'window': 8},
+                {'retries': 2},
+            ):
+                try:
+                    self.transfer.get(
+                        '/remote/file', self.local, protocol='scp', **kwargs
+                    )
+                except ValueError as e:
+                    ok_(list(kwargs)[0] in str(e), str(e))
+                else:
+                    assert False, "Accepted {0!r}!".format(kwargs)
+
+
+class compressed_transfers(Spec):
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # NOTE: mock_sftp never un-mocks os, so make sure it's real.
+        self.patcher = patch('fabric.transfer.os', os)
+        self.patcher.start()
+        self.cxn = Connection('host')
+        self.cxn.sftp = Mock()
+        self.transfer = Transfer(self.cxn)
+        self.local = os.path.join(self.tmpdir, 'file')
+        self.data = b'repetitive ' * 1000
+
+    def teardown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _channel(self, stdout=b'', **kwargs):
+        channel = _FakeChannel(stdout=stdout, **kwargs)
+        self.cxn.create_session = Mock(return_value=channel)
+        return channel
+
+    class put:
+        def setup(self):
+            with open(self.local, 'wb') as fd:
+                fd.write(self.data)
+            os.chmod(self.local, 0o640)
+
+        def pipes_gzip_stream_into_remote_decompressor(self):
+            channel = self._channel()
+            result = self.transfer.put(
+                self.local, '/remote file', compress='gzip',
+            )
+            eq_(
+                channel.command,
+                "(gzip -d -c) > '/remote file' && chmod 640 '/remote file'",
+            )
+            sent = channel.stdin.getvalue()
+            eq_(zlib.decompress(sent, 31), self.data)
+            eq_(result.size, len(self.data))
+            eq_(result.compressed, len(sent))
+            ok_(result.compressed < result.size)
+            ok_(not self.cxn.sftp.called)
+
+        def true_means_gzip_and_mode_may_be_skipped(self):
+            channel = self._channel()
+            self.transfer.put(
+                self.local, 'file', compress=True, preserve_mode=False,
+            )
+            eq_(channel.command, "(gzip -d -c) > file")
+
+        def zlib_needs_only_remote_python(self):
+            channel = self._channel()
+            self.transfer.put(self.local, '/remote', compress='zlib')
+            ok_('exec "$PY" -c' in channel.command)
+            ok_(channel.command.endswith(
+                " d) > /remote && chmod 640 /remote",
+            ))
+            eq_(zlib.decompress(channel.stdin.getvalue()), self.data)
+
+        def uploads_file_like_objects(self):
+            channel = self._channel()
+            fd = StringIO(u'text')
+            fd.seek(2)
+            result = self.transfer.put(fd, '/remote', compress='gzip')
+            eq_(channel.command, "(gzip -d -c) > /remote")
+            eq_(zlib.decompress(channel.stdin.getvalue(), 31), b'text')
+            eq_(result.size, 4)
+            eq_(fd.tell(), 2)
+
+        def remote_errors_raise_IOError(self):
+            self._channel(stderr=b'cannot create /remote', exited=2)
+            try:
+                self.transfer.put(self.local, '/remote', compress='gzip')
+            except IOError as e:
+                ok_('cannot create' in str(e))
+            else:
+                assert False, "Did not raise IOError!"
+
+        @raises(ValueError)
+        def rejects_unknown_codecs(self):
+            self.transfer.put(self.local, '/remote', compress='nope')
+
+        @raises(ValueError)
+        def recursion_requires_tar(self):
+            self.transfer.put(
+                self.tmpdir, '/remote', recursive=True, compress='gzip',
+            )
+
+        def rejects_incompatible_options(self):
+            for kwargs in (
+                {'protocol': 'scp'},
+                {'resume': True},
+                {'skip_unchanged': True},
+                {'delta': True},
+                {'window': 8},
+                {'retries': 2},
+            ):
+                try:
+                    self.transfer.put(
+                        self.local, '/remote', compress='gzip', **kwargs
+                    )
+                except ValueError as e:
+                    ok_(list(kwargs)[0] in str(e), str(e))
+                else:
+                    assert False, "Accepted {0!r}!".format(kwargs)
+
+    class get:
+        def decompresses_remote_compressor_output(self):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            stream = compressor.compress(self.data) + compressor.flush()
+            channel = self._channel(stream)
+            self.cxn.sftp.return_value.stat.return_value = _attrs(
+                stat.S_IFREG | 0o604,
+            )
+            result = self.transfer.get(
+                '/remote file', self.local, compress='gzip',
+            )
+            eq_(channel.command, "(gzip -c) < '/remote file'")
+            with open(self.local, 'rb') as fd:
+                eq_(fd.read(), self.data)
+            eq_(stat.S_IMODE(os.stat(self.local).st_mode), 0o604)
+            eq_(result.size, len(self.data))
+            eq_(result.compressed, len(stream))
+
+        def file_like_objects_need_no_sftp(self):
+            channel = self._channel(zlib.compress(b'data'))
+            fd = BytesIO()
+            result = self.transfer.get('/remote', fd, compress='zlib')
+            ok_(channel.command.endswith(" c) < /remote"))
+            eq_(fd.getvalue(), b'data')
+            eq_(result.size, 4)
+            ok_(not self.cxn.sftp.called)
+
+        def remote_errors_raise_IOError(self):
+            self._channel(stderr=b'cannot open /remote', exited=2)
+            try:
+                self.transfer.get('/remote', self.local, compress='gzip')
+            except IOError as e:
+                ok_('cannot open' in str(e))
+            else:
+                assert False, "Did not raise IOError!"
+
+        def rejects_incompatible_options(self):
+            for kwargs in (
+                {'protocol': 'scp'},
+                {'resume': True},
+                {'skip_unchanged': True},
+                {'window': 8},
+                {'retries': 2},
+            ):
+                try:
+                    self.transfer.get(
+                        '/remote', self.local, compress='gzip', **kwargs
+                    )
+                except ValueError as e:
+                    ok_(list(kwargs)[0] in str(e), str(e))
+                else:
+                    assert False, "Accepted {0!r}!".format(kwargs)
+
+
+class metrics_(Spec):
+    @mock_sftp()
+    def plain_transfers_hand_progress_to_paramiko(self, sftp, transfer):
+        progress = Mock()
+        fd = BytesIO()
+        transfer.get('file', local=fd, progress=progress)
+        sftp.getfo.assert_called_with(
+            remotepath='/remote/file', fl=fd, callback=progress,
+        )
+
+    @mock_sftp()
+    def pipelined_transfers_report_progress(self, sftp, transfer):
+        handle = sftp.open.return_value.__enter__.return_value
+        handle.stat.return_value = _attrs(stat.S_IFREG | 0o640, size=10)
+        handle.readv.side_effect = lambda chunks: [
+            b'x' * length for _, length in chunks
+        ]
+        calls = []
+        transfer.get(
+            'file', local=BytesIO(), window=2, block_size=4,
+            progress=lambda *args: calls.append(args),
+        )
+        eq_(calls, [(4, 10), (8, 10), (10, 10)])
+
+    @mock_sftp()
+    def counts_sftp_requests_as_round_trips(self, sftp, transfer):
+        sftp.request_number = 5
+
+        def get(**kwargs):
+            sftp.request_number += 3
+        sftp.get.side_effect = get
+        result = transfer.get('file', preserve_mode=False)
+        eq_(result.round_trips, 3)
+        eq_(result.retries, 0)
+
+    @mock_sftp()
+    def retries_connection_failures_on_fresh_sftp_session(
+        self, sftp, transfer
+    ):
+        sftp.put.side_effect = [EOFError(), None]
+        result = transfer.put('file', preserve_mode=False, retries=2)
+        eq_(result.retries, 1)
+        eq_(sftp.put.call_count, 2)
+        sftp.close.assert_called_once_with()
+        eq_(transfer.connection.client.open_sftp.call_count, 2)
+
+    @mock_sftp()
+    def retries_errors_from_closed_channels(self, sftp, transfer):
+        sftp.sock.closed = True
+        sftp.put.side_effect = [IOError("Socket is closed"), None]
+        eq_(transfer.put('file', preserve_mode=False, retries=1).retries, 1)
+
+    @mock_sftp()
+    def retries_may_come_from_config(self, sftp, transfer):
+        sftp.put.side_effect = [SSHException(), None]
+        transfer.connection.config.transfer.retries = 1
+        eq_(transfer.put('file', preserve_mode=False).retries, 1)
+
+    @mock_sftp()
+    def gives_up_after_given_retries(self, sftp, transfer):
+        sftp.put.side_effect = SSHException("Server connection dropped")
+        try:
+            transfer.put('file', preserve_mode=False, retries=1)
+        except SSHException:
+            eq_(sftp.put.call_count, 2)
+        else:
+            assert False, "Did not raise SSHException!"
+
+    @mock_sftp()
+    @raises(EOFError)
+    def does_not_retry_by_default(self, sftp, transfer):
+        sftp.put.side_effect = [EOFError(), None]
+        transfer.put('file', preserve_mode=False)
+
+    @mock_sftp()
+    @raises(IOError)
+    def does_not_retry_server_errors(self, sftp, transfer):
+        sftp.sock.closed = False
+        sftp.put.side_effect = [IOError("No such file"), None]
+        transfer.put('file', preserve_mode=False, retries=3)
+
+    @mock_sftp()
+    @raises(EOFError)
+    def does_not_retry_downloads_into_file_like_objects(
+        self, sftp, transfer
+    ):
+        sftp.getfo.side_effect = [EOFError(), None]
+        transfer.get('file', local=BytesIO(), retries=3)
+
+    @mock_sftp()
+    @raises(ValueError)
+    def retries_may_not_be_negative(self, sftp, transfer):
+        transfer.put('file', retries=-1)
+
+    def combines_concurrent_progress_reports(self):
+        calls = []
+        progress = _Progress(lambda *args: calls.append(args), 10)
+        first, second = progress.file('a'), progress.file('b')
+        first(3, 5)
+        second(4, 5)
+        first(5, 5)
+        eq_(calls, [(3, 10), (7, 10), (9, 10)])
+
+
+class remote_cwd(Spec):
+    @mock_sftp()
+    def home_is_normalized_once_per_connection(self, sftp, transfer):
+        sftp.getcwd.return_value = None
+        sftp.normalize.return_value = '/home/user'
+        transfer.get('one', local=BytesIO())
+        Transfer(transfer.connection).put(BytesIO(), 'two')
+        sftp.normalize.assert_called_once_with('.')
+        sftp.getfo.assert_called_once_with(
+            remotepath='/home/user/one', fl=ANY,
+        )
+        eq_(sftp.putfo.call_args[1]['remotepath'], '/home/user/two')
+
+    @mock_sftp()
+    def chdir_takes_precedence(self, sftp, transfer):
+        sftp.getcwd.return_value = None
+        sftp.normalize.return_value = '/home/user'
+        transfer.get('one', local=BytesIO())
+        sftp.getcwd.return_value = '/elsewhere'
+        transfer.get('two', local=BytesIO())
+        eq_(sftp.getfo.call_args[1]['remotepath'], '/elsewhere/two')
+
+    @mock_sftp()
+    def pooled_channels_defer_to_connections_chdir(self, sftp, transfer):
+        sftp.getcwd.return_value = '/elsewhere'
+        transfer.connection.sftp()
+        pooled = Mock()
+        pooled.getcwd.return_value = None
+        eq_(transfer._cwd(pooled), '/elsewhere')
+        ok_(not pooled.normalize.called)
+
+    class resolve:
+        @mock_sftp()
+        def joins_relative_paths_onto_cwd(self, sftp, transfer):
+            eq_(
+                transfer.resolve(['a', '/b', 'c/d']),
+                ['/remote/a', '/b', '/remote/c/d'],
+            )
+
+        @mock_sftp()
+        def absolute_paths_need_no_sftp(self, sftp, transfer):
+            eq_(transfer.resolve(['/a', '/b']), ['/a', '/b'])
+            ok_(not transfer.connection.client.open_sftp.called)
+
+        @mock_sftp()
+        def may_canonicalize_remotely_in_one_command(self, sftp, transfer):
+            channel = _FakeChannel(stdout=b'/real/a\0/b\0')
+            transfer.connection.create_session = Mock(return_value=channel)
+            eq_(
+                transfer.resolve(['a', '/x/../b'], realpath=True),
+                ['/real/a', '/b'],
+            )
+            eq_(channel.stdin.getvalue(), b'/remote/a\0/x/../b')
+            ok_('exec "$PY" -c' in channel.command)
+
+
+class pooled_channels(Spec):
+    @mock_sftp()
+    def transfers_lease_channels_from_connections_pool(self, sftp, transfer):
+        pool = transfer.connection.sftp_pool
+        pool.acquire = Mock(wraps=pool.acquire)
+        pool.release = Mock(wraps=pool.release)
+        transfer.put('file', preserve_mode=False)
+        pool.acquire.assert_called_once_with()
+        pool.release.assert_called_once_with(sftp, broken=False)
+
+    @mock_sftp()
+    def broken_channels_are_not_handed_back(self, sftp, transfer):
+        pool = transfer.connection.sftp_pool
+        pool.release = Mock(wraps=pool.release)
+        sftp.put.side_effect = [EOFError(), None]
+        transfer.put('file', preserve_mode=False, retries=1)
+        eq_(
+            pool.release.call_args_list,
+            [call(sftp, broken=True), call(sftp, broken=False)],
+        )
+
+    @mock_sftp()
+    def channels_are_returned_even_on_errors(self, sftp, transfer):
+        sftp.put.side_effect = IOError("No such file")
+        sftp.sock.closed = False
+        try:
+            transfer.put('file', preserve_mode=False)
+        except IOError:
+            pass
+        eq_(transfer.connection.sftp_pool._channels, [[sftp, 0, ANY]])
+
+
+class chunks_(Spec):
+    def setup(self):
+        # NOTE: mock_sftp never un-mocks os, so make sure it's real.
+        self.patcher = patch('fabric.transfer.os', os)
+        self.patcher.start()
+        self.fd = tempfile.TemporaryFile()
+        self.fd.write(b'0123456789')
+        self.fd.seek(0)
+
+    def teardown(self):
+        self.fd.close()
+        self.patcher.stop()
+
+    def reads_chunks_by_default(self):
+        chunks = list(_chunks(self.fd, 4))
+        eq_(chunks, [b'0123', b'4567', b'89'])
+        ok_(all(isinstance(x, bytes) for x in chunks))
+
+    def encodes_text(self):
+        eq_(list(_chunks(StringIO(u'text'), 3)), [b'tex', b't'])
+
+    def may_slice_memory_mapping_instead(self):
+        chunks = list(_chunks(self.fd, 4, memory_map=True))
+        ok_(all(isinstance(x, memoryview) for x in chunks[:-1]))
+        # The last one is a copy, so it doesn't pin the mapping.
+        ok_(isinstance(chunks[-1], bytes))
+        eq_([bytes(x) for x in chunks], [b'0123', b'4567', b'89'])
+
+    def memory_mapping_starts_at_current_position(self):
+        self.fd.seek(6)
+        chunks = _chunks(self.fd, 4, memory_map=True)
+        eq_([bytes(x) for x in chunks], [b'6789'])
+
+    def memory_mapping_is_closed_once_chunks_are_gone(self):
+        mappings = []
+        real = mmap.mmap
+
+        def record(*args, **kwargs):
+            mappings.append(real(*args, **kwargs))
+            return mappings[-1]
+        with patch('fabric.transfer.mmap.mmap', side_effect=record):
+            sizes = [len(x) for x in _chunks(self.fd, 4, memory_map=True)]
+        eq_(sizes, [4, 4, 2])
+        ok_(mappings[0].closed)
+
+    def memory_mapping_handles_empty_files(self):
+        with tempfile.TemporaryFile() as fd:
+            eq_(list(_chunks(fd, 4, memory_map=True)), [])
+
+    @patch('fabric.connection.SSHClient')
+    def put_writes_memoryviews(self, Client):
+        sftp = Client.return_value.open_sftp.return_value
+        handle = sftp.open.return_value.__enter__.return_value
+        written = []
+        handle.write.side_effect = lambda data: written.append(
+            (type(data), bytes(data)),
+        )
+        path = os.path.join(tempfile.mkdtemp(), 'file')
+        try:
+            with open(path, 'wb') as fd:
+                fd.write(b'0123456789')
+            result = Transfer(Connection('host')).put(
+                path, '/remote', memory_map=True, block_size=4,
+            )
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+        eq_(written, [
+            (memoryview, b'0123'), (memoryview, b'4567'), (bytes, b'89'),
+        ])
+        # No window: only the last write waits for acknowledgements.
+        eq_(
+            [x[0][0] for x in handle.set_pipelined.call_args_list],
+            [True, True, False],
+        )
+        eq_(result.size, 10)
+        ok_(not sftp.put.called)
+
+
+class relay_(Spec):
+    def setup(self):
+        self.source = Connection('source')
+        self.sent = []
+
+        def session():
+            channel = _FakeChannel(stdout=b'1000\n')
+            self.sent.append(channel)
+            return channel
+        self.source.create_session = Mock(side_effect=session)
+        self.targets = [
+            Connection('alice@target1'), Connection('bob@target2:2222'),
+        ]
+        for target in self.targets:
+            target.create_session = Mock()
+
+    def sources_ssh_to_each_target(self):
+        result = relay(self.source, self.targets, '/file', 'digest', 0o640)
+        eq_(result, [1000, 1000])
+        commands = sorted(x.command for x in self.sent)
+        for command, expected in zip(commands, (
+            "ssh -o BatchMode=yes -o ConnectTimeout=60 -p 22 -l alice target1 ", # noqa
+            "ssh -o BatchMode=yes -o ConnectTimeout=60 -p 2222 -l bob target2 ", # noqa
+        )):
+            ok_(command.startswith(expected), command)
+            ok_(command.endswith(" /file digest 640' < /file"), command)
+        # Data never flows through the local machine.
+        for target in self.targets:
+            ok_(not target.create_session.called)
+        for channel in self.sent:
+            eq_(channel.stdin.getvalue(), b'')
+            ok_(channel.closed)
+
+    def collects_per_target_errors(self):
+        failing = _FakeChannel(stderr=b'Checksum mismatch', exited=1)
+        self.source.create_session.side_effect = [
+            _FakeChannel(stdout=b'1000\n'), failing,
+        ]
+        result = relay(self.source, self.targets[:1] * 2, '/file', 'digest')
+        ok_(1000 in result)
+        error = [x for x in result if x != 1000][0]
+        ok_(isinstance(error, IOError))
+        ok_('Checksum mismatch' in str(error))
+        ok_(failing.command.endswith(" /file digest -' < /file"))
+
+    def timeout_may_be_left_to_ssh(self):
+        relay(self.source, self.targets[:1], '/file', 'digest', timeout=None)
+        ok_('ConnectTimeout' not in self.sent[0].command)
+
+
+class parallel_(Spec):
+    def returns_results_in_order(self):
+        eq_(_parallel([1, 2], lambda c, x: x * 2, [1, 2, 3]), [2, 4, 6])
+
+    @raises(KeyError)
+    def raises_first_error(self):
+        def boom(client, item):
+            raise KeyError(item)
+        _parallel([1, 2], boom, [1, 2, 3])
+
+
+class interpolate_(Spec):
+    def replaces_known_placeholders(self):
+        cxn = Connection('user@host:2222')
+        eq_(interpolate('{host}/{user}/{port}', cxn), 'host/user/2222')
+
+    def leaves_other_braces_alone(self):
+        eq_(interpolate('{nope}/{host}', Connection('host')), '{nope}/host')
+
+    def passes_through_non_strings(self):
+        fd = StringIO()
+        ok_(interpolate(fd, Connection('host')) is fd)
+        eq_(interpolate(None, Connection('host')), None)
@@ -0,0 +1,232 @@
+import socket
+import threading
+import time
+
+from mock import Mock
+from spec import Spec, eq_, ok_, raises
+
+from fabric.tunnels import (
+    ChannelOpener, Histogram, SOCKSError, SOCKSHandshake, Traffic, Tunnel,
+    TunnelStats,
+)
+
+
+class ChannelOpener_(Spec):
+    def _open(self, opener, count):
+        results = []
+        done = threading.Event()
+
+        def callback(channel, exc_info, elapsed):
+            results.append((channel, exc_info, elapsed))
+            if len(results) == count:
+                done.set()
+        for index in range(count):
+            opener.open(('db', 5432), ('127.0.0.1', index), callback)
+        ok_(done.wait(5))
+        return results
+
+    def opens_direct_tcpip_channels_in_the_background(self):
+        transport = Mock()
+        opener = ChannelOpener(transport)
+        (channel, exc_info, elapsed), = self._open(opener, 1)
+        ok_(channel is transport.open_channel.return_value)
+        eq_(exc_info, None)
+        transport.open_channel.assert_called_once_with(
+            'direct-tcpip', ('db', 5432), ('127.0.0.1', 0),
+        )
+        opener.stop()
+
+    def hands_over_errors(self):
+        transport = Mock()
+        transport.open_channel.side_effect = socket.error
+        (channel, exc_info, elapsed), = self._open(ChannelOpener(transport), 1)
+        eq_(channel, None)
+        ok_(exc_info[0] is socket.error)
+
+    def uses_at_most_workers_threads(self):
+        release = threading.Event()
+        transport = Mock()
+        transport.open_channel.side_effect = lambda *args: release.wait(5)
+        opener = ChannelOpener(transport, workers=2)
+        for _ in range(5):
+            opener.open(None, None, lambda *args: None)
+        # Idle threads of other openers may come & go meanwhile; only count
+        # this one's.
+        eq_(opener._threads, 2)
+        release.set()
+        opener.stop()
+
+    def idle_threads_exit(self):
+        opener = ChannelOpener(Mock(), idle_timeout=0.01)
+        self._open(opener, 3)
+        time.sleep(0.1)
+        eq_(opener._threads, 0)
+
+
+class Histogram_(Spec):
+    def starts_empty(self):
+        histogram = Histogram()
+        eq_(histogram.count, 0)
+        eq_(histogram.mean, None)
+        eq_(histogram.percentile(0.5), None)
+
+    def tracks_count_total_and_extremes(self):
+        histogram = Histogram()
+        for value in (0.003, 0.001, 0.002):
+            histogram.add(value)
+        eq_(histogram.count, 3)
+        eq_(round(histogram.mean, 6), 0.002)
+        eq_((histogram.min, histogram.max), (0.001, 0.003))
+
+    def buckets_by_powers_of_two_milliseconds(self):
+        histogram = Histogram()
+        for value in (0.0005, 0.001, 0.0015, 0.003, 100):
+            histogram.add(value)
+        eq_(histogram.buckets[:3], [2, 1, 1])
+        eq_(histogram.buckets[-1], 1)
+
+    def percentiles_are_bucket_bounds_capped_at_max(self):
+        histogram = Histogram()
+        for value in [0.0015] * 9 + [0.005]:
+            histogram.add(value)
+        eq_(histogram.percentile(0.5), 0.002)
+        eq_(histogram.percentile(0.99), 0.005)
+
+
+class Traffic_(Spec):
+    def samples_recent_rates(self):
+        traffic = Traffic()
+        eq_(traffic.recent_sent_rate, None)
+        traffic.sample(now=traffic.started + 1)
+        traffic.sent, traffic.received = 100, 50
+        traffic.sample(now=traffic.started + 3)
+        eq_(traffic.recent_sent_rate, 50)
+        eq_(traffic.recent_received_rate, 25)
+
+    def tunnel_stats_sample_their_tunnels_too(self):
+        stats = TunnelStats()
+        tunnel = Tunnel(channel=Mock(), sock=Mock(), stats=stats)
+        stats.tunnels.append(tunnel)
+        stats.sample()
+        ok_(tunnel.traffic.recent_sent_rate is not None)
+
+
+class Tunnel_(Spec):
+    def counts_traffic_in_itself_and_stats(self):
+        stats = TunnelStats()
+        channel, sock = Mock(), Mock()
+        channel.send.return_value = 3
+        channel.recv.return_value = b'pong!'
+        sock.recv.return_value = b'abc'
+        sock.send.return_value = 5
+        tunnel = Tunnel(channel=channel, sock=sock, stats=stats)
+        tunnel.start(Mock())
+        tunnel.on_sock(sock, 1)
+        tunnel.on_channel(channel, 1)
+        eq_((tunnel.traffic.sent, tunnel.traffic.received), (3, 5))
+        eq_((stats.sent, stats.received), (3, 5))
+
+    def tracks_time_stalled_on_channel_window(self):
+        channel, sock = Mock(), Mock()
+        channel.send.side_effect = socket.timeout
+        sock.recv.return_value = b'data'
+        tunnel = Tunnel(channel=channel, sock=sock)
+        tunnel.start(Mock())
+        eq_(tunnel.stalled, 0)
+        tunnel.on_sock(sock, 1)
+        time.sleep(0.02)
+        ok_(tunnel.stalled >= 0.02)
+        channel.send.side_effect = None
+        channel.send.return_value = 4
+        tunnel.flush()
+        stalled = tunnel.stalled
+        time.sleep(0.01)
+        eq_(tunnel.stalled, stalled)
+
+
+class SOCKSHandshake_(Spec):
+    class socks4:
+        def parses_address_requests(self):
+            handshake = SOCKSHandshake()
+            request = b'\x04\x01\x00\x16\x0a\x00\x00\x02me\x00'
+            eq_(handshake.feed(request), b'')
+            eq_(handshake.version, 4)
+            eq_(handshake.address, ('10.0.0.2', 22))
+
+        def parses_4a_domain_requests(self):
+            handshake = SOCKSHandshake()
+            handshake.feed(
+                b'\x04\x01\x01\xbb\x00\x00\x00\x01\x00db.internal\x00'
+            )
+            eq_(handshake.address, ('db.internal', 443))
+
+        def keeps_data_sent_after_request(self):
+            handshake = SOCKSHandshake()
+            handshake.feed(b'\x04\x01\x00\x50\x7f\x00\x00\x01\x00GET /')
+            eq_(handshake.leftover, b'GET /')
+
+        @raises(SOCKSError)
+        def rejects_bind_requests(self):
+            SOCKSHandshake().feed(b'\x04\x02\x00\x50\x7f\x00\x00\x01\x00')
+
+        def replies(self):
+            handshake = SOCKSHandshake()
+            handshake.feed(b'\x04\x01\x00\x50\x7f\x00\x00\x01\x00')
+            eq_(handshake.reply(True), b'\x00\x5a' + b'\x00' * 6)
+            eq_(handshake.reply(False), b'\x00\x5b' + b'\x00' * 6)
+
+    class socks5:
+        def greets_then_parses_domain_requests(self):
+            handshake = SOCKSHandshake()
+            eq_(handshake.feed(b'\x05\x02\x02\x00'), b'\x05\x00')
+            eq_(handshake.address, None)
+            handshake.feed(b'\x05\x01\x00\x03\x04app1\x00\x50')
+            eq_(handshake.version, 5)
+            eq_(handshake.address, ('app1', 80))
+
+        def parses_ipv4_requests(self):
+            handshake = SOCKSHandshake()
+            handshake.feed(b'\x05\x01\x00\x05\x01\x00\x01\xc0\xa8\x00\x01\x1f\x90') # noqa
+            eq_(handshake.address, ('192.168.0.1', 8080))
+
+        def parses_ipv6_requests(self):
+            handshake = SOCKSHandshake()
+            ipv6 = b'\x00' * 15 + b'\x01'
+            handshake.feed(b'\x05\x01\x00\x05\x01\x00\x04' + ipv6 + b'\x00P')
+            eq_(handshake.address, ('::1', 80))
+
+        def handles_messages_split_anywhere(self):
+            handshake = SOCKSHandshake()
+            message = b'\x05\x01\x00\x05\x01\x00\x03\x04app1\x00\x50rest'
+            replies = b''
+            for index in range(len(message)):
+                replies += handshake.feed(message[index:index + 1])
+            eq_(replies, b'\x05\x00')
+            eq_(handshake.address, ('app1', 80))
+            eq_(handshake.leftover, b'rest')
+
+        def requires_no_auth_method(self):
+            try:
+                SOCKSHandshake().feed(b'\x05\x01\x02')
+            except SOCKSError as e:
+                eq_(e.reply, b'\x05\xff')
+            else:
+                assert False, "Accepted an unsupported auth method"
+
+        def rejects_non_connect_commands(self):
+            try:
+                SOCKSHandshake().feed(b'\x05\x01\x00\x05\x02\x00\x01' + b'\x00' * 6) # noqa
+            except SOCKSError as e:
+                eq_(e.reply[:2], b'\x05\x07')
+            else:
+                assert False, "Accepted a BIND request"
+
+        def replies(self):
+            handshake = SOCKSHandshake()
+            handshake.feed(b'\x05\x01\x00\x05\x01\x00\x03\x01x\x00\x50')
+            eq_(handshake.reply(True), b'\x05\x00\x00\x01' + b'\x00' * 6)
+            ok_(handshake.reply(False).startswith(b'\x05\x01'))
+
+    @raises(SOCKSError)
+    def rejects_unknown_versions(self):
+        SOCKSHandshake().feed(b'GET / HTTP/1.1\r\n')